@@ -0,0 +1,82 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+
+from artifacts import replace
+
+
+class AlbumManifest(object):
+    """
+    A local copy of which titles are in our Gallery album (and their item
+    names), so checking whether an image has been uploaded doesn't mean
+    listing the whole album again. It's kept in a JSON file between runs,
+    added to as we upload, and only fetched from Gallery again once it's
+    more than ttl seconds old.
+
+    Gallery Remote has no way to ask for just the images added since some
+    time, or a page of an album, so when the manifest does expire the whole
+    album is listed again. That's streamed rather than held in memory, but on
+    a big album it still takes a while: raise ttl rather than lowering it.
+    Images uploaded by something else show up once the manifest expires.
+    """
+    def __init__(self, path, g, album_name, ttl=3600):
+        self.logger = logging.getLogger('mcrender')
+        self.path = path
+        self.g = g
+        self.album_name = album_name
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.items = {}
+        self.fetched = 0
+
+        try:
+            saved = json.load(open(path))
+            if saved['album'] == album_name:
+                self.items = saved['items']
+                self.fetched = saved['fetched']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def _save(self):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        out = os.fdopen(fd, "w")
+        json.dump({'album': self.album_name, 'fetched': self.fetched,
+                   'items': self.items}, out)
+        out.close()
+        replace(tmp, self.path)
+
+    def refresh(self, force=False):
+        with self.lock:
+            if not force and time.time() - self.fetched < self.ttl:
+                return
+
+            self.logger.debug("Fetching the album listing")
+            self.fetched = time.time()
+            self.items = dict((img['title'], img['name']) for img in
+                                  self.g.iter_album_images(self.album_name))
+            self._save()
+
+    def titles(self):
+        with self.lock:
+            self.refresh()
+            return set(self.items)
+
+    def __contains__(self, title):
+        with self.lock:
+            self.refresh()
+            return title in self.items
+
+    def add(self, title, name):
+        """
+        Notes a successful upload
+        """
+        with self.lock:
+            self.items[title] = name
+            self._save()
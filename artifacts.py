@@ -0,0 +1,105 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+import os
+import errno
+import shutil
+import binascii
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+# ioctl asking Linux to make one file share another's blocks (btrfs, XFS)
+FICLONE = 0x40049409
+
+# Why os.link() might fail where a reflink or a copy could still work: across
+# filesystems, too many links, or a filesystem (or OS) without hard links.
+# Anything else, say dst already being there, is a real error.
+_NO_LINK = set([errno.EXDEV, errno.EMLINK, errno.EPERM, errno.EACCES,
+                getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP),
+                errno.EOPNOTSUPP])
+
+
+def reflink(src, dst):
+    """
+    Makes dst, which mustn't exist yet, a copy of src that shares its blocks
+    on disk until either is changed, keeping src's times like
+    shutil.copy2(). Raises OSError (or IOError) where the filesystem can't
+    do that.
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "No reflinks here", dst)
+
+    fsrc = open(src, "rb")
+    try:
+        # O_EXCL: never write into a file that's there already, it could be
+        # another link to src
+        fdst = os.fdopen(os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                                 0666), "wb")
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except (IOError, OSError):
+            fdst.close()
+            os.remove(dst)
+            raise
+        fdst.close()
+    finally:
+        fsrc.close()
+    shutil.copystat(src, dst)
+
+
+def replace(src, dst):
+    """
+    Renames src to dst, replacing dst if it's there already. os.rename()
+    does that everywhere but Windows, where dst has to go first.
+    """
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def _temp_name(dst):
+    return os.path.join(os.path.dirname(dst), ".%s.%s.tmp" % (
+            os.path.basename(dst), binascii.hexlify(os.urandom(4))))
+
+
+def link_or_copy(src, dst):
+    """
+    Makes dst a hard link to src where the filesystem allows it, a reflink
+    where it doesn't but can share the blocks anyway (too many links to src,
+    filesystems without hard links) and a copy where neither works
+    (different filesystems, Windows, ...)
+
+    Whatever's at dst already is replaced, not written into: the new dst is
+    made under a temporary name next to it and renamed into place.
+    """
+    if os.path.exists(dst) and os.path.exists(src) and \
+            hasattr(os.path, 'samefile') and os.path.samefile(src, dst):
+        # Already a link to src; renaming another link over it does nothing
+        return
+
+    tmp = _temp_name(dst)
+    try:
+        try:
+            os.link(src, tmp)
+        except AttributeError:
+            # No os.link() at all (Python 2 on Windows)
+            shutil.copy2(src, tmp)
+        except OSError as e:
+            if e.errno not in _NO_LINK:
+                raise
+            try:
+                reflink(src, tmp)
+            except (IOError, OSError) as e:
+                if e.errno == errno.EEXIST:
+                    raise
+                shutil.copy2(src, tmp)
+
+        replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
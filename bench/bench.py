@@ -0,0 +1,352 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+# Runs mcrender.py over made up backups (see synth.py) with stand-ins for
+# mcobj, Blender and Gallery (see fake_mcobj.py, fake_blender.py and
+# gr2server.py), so a change to the pipeline can be timed without a world,
+# a Blender or a server, and compared release to release. How fast the
+# stand-ins are is up to the options below; the defaults are small enough to
+# run in a minute or so.
+#
+# The report comes from the metrics mcrender.py writes as it goes (see
+# metrics.py): snapshots per hour, percentiles of how long each stage took
+# and each Gallery request, what mcobj and Blender used, and the peak memory
+# of mcrender.py and everything it started. --json saves the same for
+# comparing runs.
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import ConfigParser
+from optparse import OptionParser, OptionGroup
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOP = os.path.dirname(HERE)
+sys.path.insert(0, TOP)
+
+import metrics
+import synth
+from gr2server import GR2Server
+
+PERCENTILES = [50, 90, 99]
+
+
+def percentile(values, p):
+    """
+    The nearest rank p-th percentile of values
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, int(len(values) * p / 100.0 + 0.5) - 1))
+    return values[rank]
+
+
+def summary(values):
+    return dict([('count', len(values)), ('max', max(values or [None]))] +
+                [('p%d' % p, percentile(values, p)) for p in PERCENTILES])
+
+
+def write_fakes(bin_dir):
+    """
+    mcobj and blender in bin_dir, running the stand-ins with this Python
+    """
+    os.makedirs(bin_dir)
+    for name, script in [('mcobj', 'fake_mcobj.py'),
+                         ('blender', 'fake_blender.py')]:
+        path = os.path.join(bin_dir, name)
+        out = open(path, "w")
+        out.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' %
+                  (sys.executable, os.path.join(HERE, script)))
+        out.close()
+        os.chmod(path, 0755)
+
+
+def write_config(path, opts, source, gallery_url):
+    conf = ConfigParser.RawConfigParser()
+    settings = [
+        ('directories', [('source', source), ('raw_backups', 'downloads'),
+                         ('objects', 'objects'), ('images', 'finished'),
+                         ('index', 'index'), ('scratch', 'scratch'),
+                         ('jobs', 'jobs.db'), ('previews', 'previews'),
+                         ('backup_regex', '.*'),
+                         ('backup_suffix', '.tar.gz'),
+                         ('discovery', 'discovery.json'),
+                         ('backup_settle', '0')]),
+        ('blender', [('render_script', os.path.join(TOP, 'obj2png.py')),
+                     ('args', '-b'), ('server', 'yes'),
+                     ('max_frames', '50'), ('max_rss_mb', '0'),
+                     ('skip_unchanged', 'yes')]),
+        ('mcobj', [('args', '-s=%d' % synth.area_chunks(opts.regions)),
+                   ('cache_mb', '0'), ('chunk_index', 'yes'),
+                   ('arrays', 'no'), ('simplify', 'no')]),
+        ('metrics', [('json', 'metrics.jsonl'),
+                     ('prometheus', 'mcrender.prom')]),
+        ('gallery2', [('enabled', gallery_url and 'true' or 'false'),
+                      ('url', gallery_url or 'http://localhost'),
+                      ('user', 'bench'), ('password', 'bench'),
+                      ('albumname', 'mcrender'), ('manifest', 'album.json'),
+                      ('manifest_ttl', '3600'), ('uploads', '2'),
+                      ('upload_retries', '0'), ('upload_max_mb', '0')]),
+    ]
+    for section, options in settings:
+        conf.add_section(section)
+        for option, value in options:
+            conf.set(section, option, value)
+
+    for setting in opts.settings:
+        key, sep, value = setting.partition('=')
+        section, dot, option = key.partition('.')
+        if not (sep and dot):
+            raise ValueError("--set wants SECTION.OPTION=VALUE, not %r" %
+                             setting)
+        if not conf.has_section(section):
+            conf.add_section(section)
+        conf.set(section, option, value)
+
+    out = open(path, "w")
+    conf.write(out)
+    out.close()
+
+
+def read_events(path):
+    events = []
+    if not os.path.exists(path):
+        return events
+    for line in open(path):
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            # The last line of a run that was killed
+            pass
+    return events
+
+
+def report(events, wall, rusage):
+    """
+    Everything worth comparing between runs, out of the metrics events
+    """
+    # Distinct snapshots, so one that's somehow finished twice (or failed
+    # and then made it) isn't counted twice
+    done = {}
+    for e in events:
+        if e['event'] == 'done':
+            done[e['snapshot']] = done.get(e['snapshot']) or \
+                                  e.get('error') is None
+    ok = len([s for s in done if done[s]])
+    result = {
+        'wall_seconds': wall,
+        'snapshots': ok,
+        'failed': len(done) - ok,
+        'snapshots_per_hour': wall and ok * 3600.0 / wall,
+        'peak_rss_bytes': rusage and rusage['maxrss'],
+        'cpu_seconds': rusage and rusage['user'] + rusage['system'],
+        'stages': {},
+        'requests': {},
+        'children': {},
+    }
+
+    for kind, key, into in [('stage', 'stage', 'stages'),
+                            ('request', 'command', 'requests')]:
+        seconds = {}
+        for e in events:
+            if e['event'] == kind:
+                seconds.setdefault(e[key], []).append(e['seconds'])
+        for name, values in seconds.items():
+            result[into][name] = summary(values)
+
+    for e in events:
+        if e['event'] != 'child':
+            continue
+        child = result['children'].setdefault(e['program'],
+                {'runs': 0, 'cpu_seconds': 0.0, 'peak_rss_bytes': 0})
+        child['runs'] += 1
+        child['cpu_seconds'] += e.get('user', 0) + e.get('system', 0)
+        child['peak_rss_bytes'] = max(child['peak_rss_bytes'],
+                                      e.get('maxrss', 0))
+    return result
+
+
+def show(result):
+    def secs(value):
+        return value is None and "-" or "%.3f" % value
+
+    print "%d snapshots (%d failed) in %.1fs: %.1f snapshots/hour" % (
+            result['snapshots'], result['failed'], result['wall_seconds'],
+            result['snapshots_per_hour'])
+    if result['peak_rss_bytes'] is not None:
+        print "Peak RSS %.1f MB, %.1f CPU seconds, mcrender.py and children" % (
+                result['peak_rss_bytes'] / (1024.0 * 1024),
+                result['cpu_seconds'])
+
+    heading = "%-20s %6s" + " %8s" * (len(PERCENTILES) + 1)
+    for title, key in [("Stage", 'stages'), ("Gallery request", 'requests')]:
+        if not result[key]:
+            continue
+        print
+        print heading % tuple([title, "count"] +
+                              ["p%d" % p for p in PERCENTILES] + ["max"])
+        for name, s in sorted(result[key].items()):
+            print heading % tuple([name, s['count']] +
+                                  [secs(s['p%d' % p]) for p in PERCENTILES] +
+                                  [secs(s['max'])])
+
+    if result['children']:
+        print
+        print "%-20s %6s %10s %10s" % ("Program", "runs", "CPU s", "peak MB")
+        for name, c in sorted(result['children'].items()):
+            print "%-20s %6d %10.2f %10.1f" % (name, c['runs'],
+                    c['cpu_seconds'], c['peak_rss_bytes'] / (1024.0 * 1024))
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+            help="Passed on to mcrender.py [default: %default]")
+    parser.add_option("-p", "--pipeline", default=False, action="store_true",
+            help="Passed on to mcrender.py")
+    parser.add_option("--set", dest="settings", action="append", default=[],
+            metavar="SECTION.OPTION=VALUE",
+            help="Change mcrender.py's config, e.g. --set preview.scale=0.25. "
+                 "Can be given more than once")
+    parser.add_option("--workdir",
+            help="Where to run, kept afterwards [default: a temporary "
+                 "directory, removed afterwards]")
+    parser.add_option("--json", dest="json_path",
+            help="Also write the report here, as JSON")
+    parser.add_option("--label", default="",
+            help="Name for this run in the JSON report")
+
+    group = OptionGroup(parser, "Backups", "See synth.py")
+    group.add_option("-n", "--snapshots", type="int", default=10,
+            help="[default: %default]")
+    group.add_option("--regions", type="int", default=2,
+            help="Region files across the world [default: %default]")
+    group.add_option("--chunks", type="int", default=256,
+            help="Chunks in each region file [default: %default]")
+    group.add_option("--chunk-kb", type="float", default=4,
+            help="[default: %default]")
+    group.add_option("--changed", type="float", default=0.1,
+            help="Fraction of the chunks changed between backups "
+                 "[default: %default]")
+    parser.add_option_group(group)
+
+    group = OptionGroup(parser, "Stand-ins",
+            "See fake_mcobj.py, fake_blender.py and gr2server.py")
+    group.add_option("--mcobj-seconds", type="float", default=0.5,
+            help="[default: %default]")
+    group.add_option("--faces", type="int", default=64,
+            help="Quads mcobj writes per chunk [default: %default]")
+    group.add_option("--blender-start", type="float", default=0.5,
+            help="[default: %default]")
+    group.add_option("--blender-seconds", type="float", default=1.0,
+            help="Per full size frame [default: %default]")
+    group.add_option("--png-kb", type="float", default=512,
+            help="[default: %default]")
+    group.add_option("--leak-mb", type="float", default=0,
+            help="What Blender leaks every frame [default: %default]")
+    group.add_option("--no-gallery", dest="gallery", default=True,
+            action="store_false", help="Only render")
+    group.add_option("--gallery-latency", type="float", default=0.05,
+            help="[default: %default]")
+    group.add_option("--gallery-kbps", type="float", default=0,
+            help="Upload bandwidth, 0 for no limit [default: %default]")
+    group.add_option("--album-images", type="int", default=0,
+            help="Images already in the album [default: %default]")
+    parser.add_option_group(group)
+
+    (opts, args) = parser.parse_args()
+    if args:
+        parser.error("No arguments, just options")
+
+    workdir = opts.workdir
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix="mcrender-bench-")
+    elif not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    workdir = os.path.abspath(workdir)
+
+    server = None
+    try:
+        start = time.time()
+        paths, size = synth.generate(os.path.join(workdir, "src"),
+                                     opts.snapshots, opts.regions, opts.chunks,
+                                     opts.chunk_kb, opts.changed)
+        print "Made %d backups of %.1f MB in %.1fs" % (len(paths),
+                size / (1024.0 * 1024), time.time() - start)
+
+        write_fakes(os.path.join(workdir, "bin"))
+        if opts.gallery:
+            server = GR2Server(album_title="mcrender",
+                               images=opts.album_images,
+                               latency=opts.gallery_latency,
+                               kbps=opts.gallery_kbps)
+            server.start()
+        conf_path = os.path.join(workdir, "config.ini")
+        try:
+            write_config(conf_path, opts, os.path.join(workdir, "src"),
+                         server and server.url)
+        except ValueError, e:
+            parser.error(str(e))
+
+        env = dict(os.environ)
+        env['PATH'] = os.path.join(workdir, "bin") + os.pathsep + \
+                      env.get('PATH', '')
+        for name, value in [('BENCH_MCOBJ_SECONDS', opts.mcobj_seconds),
+                            ('BENCH_MCOBJ_FACES', opts.faces),
+                            ('BENCH_BLENDER_START', opts.blender_start),
+                            ('BENCH_BLENDER_SECONDS', opts.blender_seconds),
+                            ('BENCH_BLENDER_LEAK_MB', opts.leak_mb),
+                            ('BENCH_PNG_KB', opts.png_kb)]:
+            env[name] = str(value)
+
+        cmd = [sys.executable, os.path.join(TOP, "mcrender.py"),
+               "-c", conf_path, "-d"]
+        if opts.pipeline:
+            cmd.append("-p")
+        if opts.jobs > 1:
+            cmd.extend(["-j", str(opts.jobs)])
+
+        log = open(os.path.join(workdir, "mcrender.log"), "w")
+        start = time.time()
+        proc = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=log,
+                                stderr=subprocess.STDOUT)
+        if hasattr(os, 'wait4'):
+            rc, rusage = metrics.wait(proc)
+        else:
+            rc, rusage = proc.wait(), None
+        wall = time.time() - start
+        log.close()
+        if rc != 0:
+            print "mcrender.py exited with rc = %d, see %s" % (
+                    rc, os.path.join(workdir, "mcrender.log"))
+
+        result = report(read_events(os.path.join(workdir, "metrics.jsonl")),
+                        wall, rusage)
+        print
+        show(result)
+
+        if opts.json_path:
+            result.update({'label': opts.label, 'rc': rc,
+                           'options': dict(vars(opts)),
+                           'backup_bytes': size})
+            out = open(opts.json_path, "w")
+            json.dump(result, out, indent=2, sort_keys=True)
+            out.close()
+        if rc != 0:
+            sys.exit(1)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        if opts.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+# Stands in for Blender running obj2png.py in the benchmark, on either side of
+# the same protocol: with --batch after "--" it answers READY and then a line
+# starting with OBJ2PNG for every "obj<TAB>png[<TAB>options]" line on stdin,
+# otherwise it renders the .obj at the end of the command line and exits.
+# Every frame gets a .stats.json the way obj2png.py's Phases writes it, and
+# tiles get an uncompressed TGA of their part of the frame and the .json
+# saying where it goes, see render_tile() in obj2png.py.
+# How long it takes and how much it writes are set from the environment:
+#   BENCH_BLENDER_START    seconds to start up and set the scene up [0.5]
+#   BENCH_BLENDER_SECONDS  seconds per full size frame, previews take their
+#                          fraction of it [1.0]
+#   BENCH_BLENDER_LEAK_MB  megabytes kept hold of after every frame [0]
+#   BENCH_PNG_KB           size of every PNG [512]
+
+import os
+import sys
+import json
+import time
+import struct
+
+PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+
+leaked = []
+
+
+def setting(name, default):
+    return float(os.environ.get(name, default))
+
+
+def rss_mb():
+    try:
+        statm = open("/proc/self/statm").read().split()
+        return int(statm[1]) * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024)
+    except (IOError, OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def count_mesh(in_f):
+    vertices = faces = 0
+    for line in open(in_f):
+        if line.startswith("v "):
+            vertices += 1
+        elif line.startswith("f "):
+            faces += 1
+    return vertices, faces
+
+
+def frame_size(base, preview):
+    # The same shape as obj2png.py's frames, a pixel for every 16 units
+    scale = preview or 1.0
+    return (max(1, int(1.42 * 93 * base / 16 * scale)),
+            max(1, int(93 * base / 16 * scale)))
+
+
+def write_png(out_f):
+    size = int(setting("BENCH_PNG_KB", 512) * 1024)
+    f = open(out_f, "wb")
+    f.write(PNG_SIGNATURE)
+    f.write(os.urandom(max(0, size - len(PNG_SIGNATURE))))
+    f.close()
+
+
+def write_tile(out_f, tile, preview):
+    width, height = frame_size(tile['base'], preview)
+    per_unit = width / float(tile['base'])
+    lo, hi = tile['bounds']
+    shift = tile['shift']
+    x0 = max(0, int((lo[0] + shift[0]) * per_unit + width / 2))
+    x1 = min(width, int((hi[0] + shift[0]) * per_unit + width / 2 + 0.999))
+    y0 = max(0, int((lo[2] + shift[2]) * per_unit + height / 2))
+    y1 = min(height, int((hi[2] + shift[2]) * per_unit + height / 2 + 0.999))
+    info = {'x': x0, 'y': y0, 'width': max(0, x1 - x0),
+            'height': max(0, y1 - y0), 'full_width': width,
+            'full_height': height, 'depth': -(lo[0] + lo[2])}
+
+    if info['width'] and info['height']:
+        f = open(out_f, "wb")
+        f.write(struct.pack('<BBB5x4xHHBB', 0, 0, 2, info['width'],
+                            info['height'], 32, 8))
+        f.write("\x80\x80\x80\xff" * (info['width'] * info['height']))
+        f.close()
+
+    sidecar = open(os.path.splitext(out_f)[0] + ".json", "w")
+    json.dump(info, sidecar)
+    sidecar.close()
+    return width, height
+
+
+def render(in_f, out_f, options):
+    phases = {}
+    start = time.time()
+    vertices, faces = count_mesh(in_f)
+    phases['import'] = time.time() - start
+
+    preview = options.get('preview')
+    seconds = setting("BENCH_BLENDER_SECONDS", 1.0) * (preview or 1.0)
+    time.sleep(seconds)
+    phases['render'] = seconds
+
+    start = time.time()
+    if 'bounds' in options:
+        resolution = write_tile(out_f, options, preview)
+    else:
+        resolution = frame_size(256, preview)
+        write_png(out_f)
+    phases['save'] = time.time() - start
+
+    leaked.append("\0" * int(setting("BENCH_BLENDER_LEAK_MB", 0) *
+                             1024 * 1024))
+
+    stats = {'phases': phases, 'dimensions': [0, 0, 0],
+             'vertices': vertices, 'faces': faces,
+             'resolution': list(resolution),
+             'arrays': os.path.exists(os.path.splitext(in_f)[0] + ".npz"),
+             'preview': preview, 'tile': 'bounds' in options}
+    sidecar = open(os.path.splitext(out_f)[0] + ".stats.json", "w")
+    json.dump(stats, sidecar)
+    sidecar.close()
+
+
+def reply(*words):
+    sys.stdout.write("\nOBJ2PNG %s\n" % " ".join(str(w) for w in words))
+    sys.stdout.flush()
+
+
+def serve():
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) < 2:
+            continue
+        options = len(fields) > 2 and json.loads(fields[2]) or {}
+        try:
+            render(fields[0], fields[1], options)
+        except Exception as e:
+            reply("FAIL", str(e).replace("\n", " ") or e.__class__.__name__)
+        else:
+            reply("OK", "%.1f" % rss_mb(), fields[1])
+
+
+def main():
+    time.sleep(setting("BENCH_BLENDER_START", 0.5))
+    script_args = "--" in sys.argv and \
+                  sys.argv[sys.argv.index("--") + 1:] or []
+    if "--batch" in script_args:
+        reply("READY")
+        serve()
+        return
+
+    in_f = os.path.join(os.getcwd(), sys.argv[-1])
+    if not in_f.endswith(".obj"):
+        sys.exit(1)
+    render(in_f, in_f.replace(".obj", ".png"), {})
+
+
+if __name__ == '__main__':
+    main()
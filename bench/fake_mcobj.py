@@ -0,0 +1,96 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+# Stands in for mcobj in the benchmark. Takes the same arguments
+# (... -o foo.obj WORLD), reads the region file headers the way chunkindex.py
+# does and writes a flat grid of quads for every chunk in the area, at a
+# height that changes when the chunk's saved again, along with foo.mtl.
+# How long it takes and how much it writes are set from the environment:
+#   BENCH_MCOBJ_SECONDS  seconds to sleep before writing anything [0.5]
+#   BENCH_MCOBJ_FACES    quads per chunk, rounded down to a square [64]
+#   BENCH_MCOBJ_MB       megabytes to hold on to while it runs [0]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import regions
+import chunkindex
+
+MATERIALS = [("grass", "0.3 0.6 0.2"), ("stone", "0.5 0.5 0.5"),
+             ("sand", "0.9 0.8 0.5"), ("water", "0.2 0.3 0.8")]
+
+
+def chunks(world, bounds):
+    """
+    (chunk x, chunk z, timestamp) of every chunk in the world inside bounds
+    """
+    region_dir = os.path.join(world, "region")
+    for name in sorted(os.listdir(region_dir)):
+        coords = regions.region_coords("region/" + name)
+        if coords is None:
+            continue
+        f = open(os.path.join(region_dir, name), "rb")
+        try:
+            header = f.read(chunkindex.HEADER_SIZE)
+        finally:
+            f.close()
+        for i, stamp in sorted(chunkindex.read_header(header).items()):
+            if bounds is None or chunkindex.in_bounds(coords, i, bounds):
+                yield (coords[0] * regions.CHUNKS_PER_REGION +
+                           i % regions.CHUNKS_PER_REGION,
+                       coords[1] * regions.CHUNKS_PER_REGION +
+                           i // regions.CHUNKS_PER_REGION,
+                       stamp)
+
+
+def write_obj(path, found, faces):
+    side = max(1, int(faces ** 0.5))
+    step = 16.0 / side
+    mtl = os.path.splitext(path)[0] + ".mtl"
+    out = open(path, "w")
+    out.write("mtllib %s\n" % os.path.basename(mtl))
+    count = 0
+    for cx, cz, stamp in found:
+        height = stamp // 3600 % 8
+        out.write("usemtl %s\n" % MATERIALS[(cx + cz) % len(MATERIALS)][0])
+        lines = []
+        for a in range(side + 1):
+            for b in range(side + 1):
+                lines.append("v %g %d %g\n" % (cx * 16 + a * step, height,
+                                               cz * 16 + b * step))
+        for a in range(side):
+            for b in range(side):
+                v = count + a * (side + 1) + b + 1
+                lines.append("f %d %d %d %d\n" % (v, v + 1, v + side + 2,
+                                                  v + side + 1))
+        out.write("".join(lines))
+        count += (side + 1) ** 2
+    out.close()
+
+    out = open(mtl, "w")
+    for name, color in MATERIALS:
+        out.write("newmtl %s\nKd %s\nd 1\n" % (name, color))
+    out.close()
+
+
+def main():
+    args = sys.argv[1:]
+    if "-o" not in args or len(args) < 3:
+        sys.stderr.write("usage: mcobj [options] -o OUT.obj WORLD\n")
+        sys.exit(1)
+    out = args[args.index("-o") + 1]
+    world = args[-1]
+
+    hold = "\0" * int(float(os.environ.get("BENCH_MCOBJ_MB", 0)) * 1024 * 1024)
+    found = list(chunks(world, regions.mcobj_bounds(args, margin=0)))
+    time.sleep(float(os.environ.get("BENCH_MCOBJ_SECONDS", 0.5)))
+    write_obj(out, found, int(os.environ.get("BENCH_MCOBJ_FACES", 64)))
+    del hold
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+# A stand-in for Gallery 2's remote protocol, just enough of it for
+# mcrender.py: login, fetch-albums(-prune), album-properties,
+# fetch-album-images and add-item, over kept-alive HTTP/1.1 the way
+# galleryremote's ConnectionPool talks. There's one album, and uploads are
+# counted and thrown away. Every response can be held up by a fixed latency,
+# and uploads by a bandwidth limit, to look like a server across the internet.
+#
+# Uploading needs a login, whose session can be made to expire after a while.
+# It also stands in for an HTTP proxy (requests for a whole URL are answered as
+# if for its path, and counted) and for a gallery that's moved: anything under
+# /old is redirected to the same place without it. Commands can come as GET
+# query strings too, the way a redirected request arrives.
+
+import os
+import re
+import sys
+import Cookie
+import time
+import random
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+from optparse import OptionParser
+
+ALBUM_NAME = "7"
+MOVED = "/old"
+
+_BOUNDARY_RE = re.compile(r'boundary=("?)([^";]+)\1')
+_NAME_RE = re.compile(r'name="([^"]*)"(?:; *filename="([^"]*)")?')
+
+
+def parse_multipart(body, content_type):
+    """
+    The fields of a multipart/form-data body as {name: value}, and the
+    uploaded file as (field name, filename, size) or None
+    """
+    m = _BOUNDARY_RE.search(content_type)
+    if not m:
+        return {}, None
+    fields = {}
+    upload = None
+    for part in body.split("--" + m.group(2)):
+        head, sep, value = part.partition("\r\n\r\n")
+        if not sep:
+            continue
+        if value.endswith("\r\n"):
+            value = value[:-2]
+        name = _NAME_RE.search(head)
+        if not name:
+            continue
+        if name.group(2) is not None:
+            upload = (name.group(1), name.group(2), len(value))
+        else:
+            fields[name.group(1)] = value
+    return fields, upload
+
+
+class Album(object):
+    """
+    What's in the one album, {item name: title}
+    """
+    def __init__(self, title, images=0):
+        self.title = title
+        self.lock = threading.Lock()
+        self.items = {}
+        self.next_item = 1000
+        self.uploaded = 0
+        for n in range(images):
+            self.add("old-%06d.png" % n, 0)
+
+    def add(self, filename, size):
+        with self.lock:
+            self.next_item += 1
+            name = str(self.next_item)
+            self.items[name] = os.path.basename(filename)
+            self.uploaded += size
+            return name
+
+    def listing(self):
+        with self.lock:
+            return sorted(self.items.items())
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # The headers and body go out together, or waiting on delayed ACKs adds
+    # tens of milliseconds to every request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                                                              *args)
+
+    def _path(self):
+        """
+        The path asked for and its query string, counting requests that came
+        through as if to a proxy
+        """
+        parts = urlparse.urlsplit(self.path)
+        if parts.scheme:
+            with self.server.lock:
+                self.server.proxied += 1
+        return parts.path, parts.query
+
+    def _moved(self, path, query):
+        """
+        Redirects requests under MOVED, returning whether it did
+        """
+        if not path.startswith(MOVED + "/"):
+            return False
+        with self.server.lock:
+            self.server.redirected += 1
+        self.send_response(301)
+        self.send_header("Location", path[len(MOVED):] +
+                                     (query and "?" + query or ""))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return True
+
+    def do_GET(self):
+        start = time.time()
+        path, query = self._path()
+        if self._moved(path, query):
+            return
+        fields = dict(urlparse.parse_qsl(query))
+        self.answer(fields, None, 0, start)
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        start = time.time()
+        body = self.rfile.read(length)
+        path, query = self._path()
+        if self._moved(path, query):
+            return
+        fields, upload = parse_multipart(body,
+                self.headers.getheader('content-type') or "")
+        self.answer(fields, upload, length, start)
+
+    def answer(self, fields, upload, length, start):
+        command = fields.get('g2_form[cmd]', fields.get('cmd'))
+
+        cookie = None
+        if command == 'login':
+            sid = "%032x" % random.getrandbits(128)
+            self.server.sessions[sid] = time.time()
+            cookie = "GALLERYSID=%s; path=/" % sid
+        if command == 'add-item' and not self.logged_in():
+            lines = [('status', '401'), ('status_text', 'No add permission.')]
+        else:
+            lines = self.respond(command, fields, upload)
+
+        # Hold the response up until the latency and the upload's share of
+        # the bandwidth have both gone by
+        wait = self.server.latency
+        if self.server.kbps:
+            wait += length / (self.server.kbps * 1024.0)
+        left = start + wait - time.time()
+        if left > 0:
+            time.sleep(left)
+
+        data = "#__GR2PROTO__\n" + "".join("%s=%s\n" % kv for kv in lines)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(data)))
+        if cookie is not None:
+            self.send_header("Set-Cookie", cookie)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def logged_in(self):
+        cookies = Cookie.SimpleCookie(self.headers.getheader('cookie') or "")
+        if 'GALLERYSID' not in cookies:
+            return False
+        since = self.server.sessions.get(cookies['GALLERYSID'].value)
+        if since is None:
+            return False
+        return not self.server.session_seconds or \
+               time.time() - since < self.server.session_seconds
+
+    def respond(self, command, fields, upload):
+        """
+        The key=value lines of the response to command, as a list of pairs
+        """
+        album = self.server.album
+        if command == 'login':
+            return [('server_version', '2.14'), ('status', '0'),
+                    ('status_text', 'Login successful.'),
+                    ('auth_token', '%012x' % random.getrandbits(48))]
+
+        if command in ('fetch-albums', 'fetch-albums-prune'):
+            return [('album.name.1', ALBUM_NAME),
+                    ('album.title.1', album.title),
+                    ('album.summary.1', ''), ('album.parent.1', '0'),
+                    ('album.perms.add.1', 'true'),
+                    ('album.perms.write.1', 'true'),
+                    ('album_count', '1'), ('can_create_root', 'no'),
+                    ('status', '0'), ('status_text', 'Fetch-albums successful.')]
+
+        if command == 'album-properties':
+            return [('auto_resize', '0'), ('add_to_beginning', 'no'),
+                    ('status', '0'),
+                    ('status_text', 'Album-properties successful.')]
+
+        if command == 'fetch-album-images':
+            lines = []
+            items = album.listing()
+            for n, (name, title) in enumerate(items):
+                n += 1
+                lines.extend([('image.name.%d' % n, name),
+                              ('image.title.%d' % n, title),
+                              ('image.raw_width.%d' % n, '1024'),
+                              ('image.raw_height.%d' % n, '768'),
+                              ('image.raw_filesize.%d' % n, '524288'),
+                              ('image.caption.%d' % n, title),
+                              ('image.hidden.%d' % n, 'no')])
+            lines.extend([('image_count', str(len(items))),
+                          ('baseurl', 'http://localhost/main.php'),
+                          ('status', '0'),
+                          ('status_text', 'Fetch-album-images successful.')])
+            return lines
+
+        if command == 'add-item':
+            if upload is None:
+                return [('status', '303'), ('status_text', 'No file sent.')]
+            filename = fields.get('g2_form[userfile_name]') or upload[1]
+            return [('item_name', album.add(filename, upload[2])),
+                    ('status', '0'), ('status_text', 'Add photo successful.')]
+
+        return [('status', '301'),
+                ('status_text', 'Unknown command %s.' % command)]
+
+
+class GR2Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    The stand-in server, on port (0 for any free one) of localhost. url is
+    what to put in [gallery2] url; Gallery adds /main.php, which is all this
+    answers to anyway. proxied and redirected count the requests that came
+    in through a proxy and were sent elsewhere. Logins expire after
+    session_seconds, if it isn't 0.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, album_title="mcrender", images=0, latency=0,
+                 kbps=0, verbose=False, session_seconds=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.album = Album(album_title, images)
+        self.latency = latency
+        self.kbps = kbps
+        self.verbose = verbose
+        self.sessions = {}
+        self.session_seconds = session_seconds
+        self.lock = threading.Lock()
+        self.proxied = 0
+        self.redirected = 0
+        self.url = "http://127.0.0.1:%d" % self.server_address[1]
+
+    def start(self):
+        """
+        Serves from a thread in the background until shutdown()
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--port", type="int", default=8080,
+            help="[default: %default]")
+    parser.add_option("--album", default="mcrender",
+            help="Title of the album [default: %default]")
+    parser.add_option("--images", type="int", default=0,
+            help="Images already in the album [default: %default]")
+    parser.add_option("--latency", type="float", default=0,
+            help="Seconds every response is held up [default: %default]")
+    parser.add_option("--kbps", type="float", default=0,
+            help="KB per second uploads are limited to, 0 for no limit "
+                 "[default: %default]")
+    parser.add_option("--session", type="float", default=0,
+            help="Seconds a login lasts, 0 for ever [default: %default]")
+    (opts, args) = parser.parse_args()
+
+    server = GR2Server(opts.port, opts.album, opts.images, opts.latency,
+                       opts.kbps, verbose=True, session_seconds=opts.session)
+    print "Serving album %r at %s" % (opts.album, server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+# Microbenchmarks for galleryremote's side of the protocol, the first three
+# without a server:
+#   multipart         building an upload's body and reading it out the way
+#                     httplib sends it, for payloads of 1 MB up to 1 GB
+#   parse_response    Gallery._parse_response() over a fetch-album-images
+#                     response of 10 up to 100k images
+#   fetch_album_images the whole of Gallery.fetch_album_images(), request,
+#                     parsing and building every image's dict, over the same
+#   requests          10 up to 1000 requests over ConnectionPool to a
+#                     gr2server.py on localhost
+#   redirected        the same, each one redirected once
+#   proxied           the same, through gr2server.py standing in for a proxy
+# Each case runs in a process of its own (where there's fork()), so the peak
+# memory is that case's alone. Allocations aren't measured: what's reported is
+# the peak RSS and how much it grew while the case ran, which misses whatever
+# was allocated and freed again below an earlier peak.
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import cookielib
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from galleryremote import Gallery
+from galleryremote.connection import ConnectionPool
+from galleryremote.multipart import multipart
+from gr2server import GR2Server, MOVED
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+MB = 1024 * 1024
+# What httplib reads a file-like body in
+SEND_BLOCK = 8192
+
+PAYLOADS = [1 * MB, 10 * MB, 100 * MB, 1024 * MB]
+ITEMS = [10, 1000, 10000, 100000]
+REQUESTS = [10, 100, 1000]
+
+
+def peak_rss():
+    """
+    This process' peak RSS in bytes, or None
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if os.uname()[0] != 'Darwin':
+        maxrss *= 1024
+    return maxrss
+
+
+def album_response(path, items):
+    """
+    Writes a fetch-album-images response listing items images to path, the
+    way Gallery 2 lays it out
+    """
+    out = open(path, "w")
+    out.write("#__GR2PROTO__\n")
+    for n in xrange(1, items + 1):
+        out.write("image.name.%d=%d\n" % (n, 1000 + n))
+        out.write("image.raw_width.%d=1024\nimage.raw_height.%d=768\n" %
+                  (n, n))
+        out.write("image.resizedName.%d=%d\n" % (n, 2000 + n))
+        out.write("image.resized_width.%d=640\nimage.resized_height.%d=480\n"
+                  % (n, n))
+        out.write("image.thumbName.%d=%d\n" % (n, 3000 + n))
+        out.write("image.thumb_width.%d=150\nimage.thumb_height.%d=113\n"
+                  % (n, n))
+        out.write("image.raw_filesize.%d=524288\n" % n)
+        out.write("image.caption.%d=world-%06d\n" % (n, n))
+        out.write("image.title.%d=world-%06d.png\n" % (n, n))
+        out.write("image.extrafield.Description.%d=world-%06d\n" % (n, n))
+        out.write("image.clicks.%d=0\nimage.hidden.%d=no\n" % (n, n))
+    out.write("image_count=%d\nbaseurl=http://localhost/main.php\n" % items)
+    out.write("status=0\nstatus_text=Fetch-album-images successful.\n")
+    out.close()
+
+
+def payload(path, size):
+    """
+    A file of size bytes at path; sparse, so making a big one is quick
+    """
+    out = open(path, "wb")
+    out.truncate(size)
+    out.close()
+
+
+def run_multipart(path, size):
+    body = multipart("------bench_boundary", {
+            'g2_controller': 'remote:GalleryRemote',
+            'g2_form[protocol_version]': '2.5',
+            'g2_form[cmd]': 'add-item',
+            'g2_form[set_albumName]': '7',
+            'g2_form[userfile_name]': path,
+            'g2_form[caption]': 'bench',
+            'g2_form[extrafield.Description]': 'bench'},
+            ('g2_userfile', path))
+    sent = 0
+    while True:
+        data = body.read(SEND_BLOCK)
+        if not data:
+            break
+        sent += len(data)
+    body.close()
+    if sent != len(body):
+        raise AssertionError("Sent %d of %d bytes" % (sent, len(body)))
+
+
+def run_parse_response(path, items):
+    g = Gallery("http://localhost")
+    response = open(path)
+    count = 0
+    for record in g._parse_response(response, 'image', {}):
+        count += 1
+    response.close()
+    if count != items:
+        raise AssertionError("Parsed %d of %d records" % (count, items))
+
+
+class _Canned(object):
+    # Stands in for Gallery._stream(), answering with the response in path
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, url, body=None, headers=None):
+        return {}, open(self.path)
+
+
+def run_fetch_album_images(path, items):
+    g = Gallery("http://localhost")
+    g._stream = _Canned(path)
+    images = g.fetch_album_images('7')
+    if len(images) != items:
+        raise AssertionError("Got %d of %d images" % (len(images), items))
+
+
+def no_file(path, size):
+    # The server cases don't need anything on disk
+    open(path, "w").close()
+
+
+_server = None
+
+
+def run_requests(path, size, moved=False, proxied=False):
+    # Started once for every run in this process, as shutting it down again
+    # takes longer than the requests do
+    global _server
+    if _server is None:
+        _server = GR2Server()
+        _server.start()
+    _server.redirected = _server.proxied = 0
+
+    # No proxies from the environment, only the one we ask for
+    proxies = {}
+    url = _server.url
+    if proxied:
+        proxies = {'http': _server.url}
+        url = "http://gallery.invalid"
+    if moved:
+        url += MOVED
+    pool = ConnectionPool(url, cookielib.CookieJar(), proxies=proxies)
+    for i in xrange(size):
+        status, reason, msg, data = pool.request('GET',
+                url + "/main.php?g2_form%5Bcmd%5D=fetch-albums")
+        if status != 200 or "album.name.1=7" not in data:
+            raise AssertionError("HTTP %d %s: %r" % (status, reason,
+                                                     data[:80]))
+    pool.close()
+
+    if _server.redirected != (moved and size or 0) or \
+            _server.proxied != (proxied and size or 0):
+        raise AssertionError("%d redirected and %d proxied of %d" %
+                             (_server.redirected, _server.proxied, size))
+
+
+def run_redirected(path, size):
+    run_requests(path, size, moved=True)
+
+
+def run_proxied(path, size):
+    run_requests(path, size, proxied=True)
+
+
+CASES = [
+    ('multipart', PAYLOADS, payload, run_multipart),
+    ('parse_response', ITEMS, album_response, run_parse_response),
+    ('fetch_album_images', ITEMS, album_response, run_fetch_album_images),
+    ('requests', REQUESTS, no_file, run_requests),
+    ('redirected', REQUESTS, no_file, run_redirected),
+    ('proxied', REQUESTS, no_file, run_proxied),
+]
+
+
+def measure(run, path, size, repeat):
+    """
+    Runs run(path, size) repeat times. Returns the quickest run's seconds,
+    and the peak RSS and how much it grew over the runs (None where we can't
+    tell).
+    """
+    best = None
+    before = peak_rss()
+    for i in range(repeat):
+        start = time.time()
+        run(path, size)
+        seconds = time.time() - start
+        if best is None or seconds < best:
+            best = seconds
+    peak = peak_rss()
+    growth = None
+    if peak is not None:
+        growth = peak - before
+    return {'seconds': best, 'peak_rss_bytes': peak,
+            'rss_growth_bytes': growth}
+
+
+def isolated(run, path, size, repeat):
+    """
+    measure() in a child process, so the peak RSS is this case's alone
+    """
+    if not hasattr(os, 'fork'):
+        return measure(run, path, size, repeat)
+
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            result = json.dumps(measure(run, path, size, repeat))
+        except Exception, e:
+            result = json.dumps({'error': "%s: %s" % (e.__class__.__name__,
+                                                      e)})
+        os.write(w, result)
+        os.close(w)
+        os._exit(0)
+
+    os.close(w)
+    data = []
+    while True:
+        chunk = os.read(r, 65536)
+        if not chunk:
+            break
+        data.append(chunk)
+    os.close(r)
+    os.waitpid(pid, 0)
+    return json.loads("".join(data))
+
+
+def describe(size, unit):
+    if unit == 'bytes':
+        return "%d MB" % (size // MB)
+    return "%d items" % size
+
+
+def megabytes(size):
+    if size is None:
+        return "-"
+    return "%.1f" % (size / float(MB))
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] [CASE ...]",
+            description="Cases: %s" % ", ".join(c[0] for c in CASES))
+    parser.add_option("--max-mb", type="int", default=1024,
+            help="Largest multipart payload [default: %default]")
+    parser.add_option("--max-items", type="int", default=100000,
+            help="Longest album [default: %default]")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+            help="Runs of each, the quickest is kept [default: %default]")
+    parser.add_option("--json", dest="json_path",
+            help="Also write the results here, as JSON")
+    (opts, args) = parser.parse_args()
+
+    names = [c[0] for c in CASES]
+    for name in args:
+        if name not in names:
+            parser.error("No case called %s" % name)
+
+    print "%-20s %12s %10s %12s %12s %10s" % ("Case", "size", "seconds",
+            "us/item", "RSS grew MB", "RSS MB")
+
+    work = tempfile.mkdtemp(prefix="mcrender-micro-")
+    results = []
+    try:
+        for name, sizes, setup, run in CASES:
+            if args and name not in args:
+                continue
+            unit = setup is payload and 'bytes' or 'items'
+            limit = unit == 'bytes' and opts.max_mb * MB or opts.max_items
+            for size in sizes:
+                if size > limit:
+                    continue
+                path = os.path.join(work, "%s-%d" % (name, size))
+                setup(path, size)
+                result = isolated(run, path, size, opts.repeat)
+                os.remove(path)
+                result.update({'case': name, 'size': size, 'unit': unit})
+                results.append(result)
+
+                if 'error' in result:
+                    print "%-20s %12s %s" % (name, describe(size, unit),
+                                             result['error'])
+                    continue
+                per_item = unit == 'items' and \
+                           "%.2f" % (result['seconds'] * 1e6 / size) or "-"
+                print "%-20s %12s %10.4f %12s %12s %10s" % (name,
+                        describe(size, unit), result['seconds'], per_item,
+                        megabytes(result['rss_growth_bytes']),
+                        megabytes(result['peak_rss_bytes']))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    if opts.json_path:
+        out = open(opts.json_path, "w")
+        json.dump({'python': sys.version.split()[0], 'results': results},
+                  out, indent=2, sort_keys=True)
+        out.close()
+    if [r for r in results if 'error' in r]:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+# Makes up backups for the benchmark: tarballs of a world with a level.dat and
+# a square of region files centered on chunk 0, 0. The region headers are
+# real, as far as regions.py and chunkindex.py care, and the chunks are random
+# bytes a sector or more long. Each backup after the first re-saves some of
+# the chunks, with new data and a later timestamp, the way a world that's
+# being played on changes between backups.
+
+import os
+import sys
+import time
+import random
+import binascii
+import struct
+import tarfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chunkindex
+from regions import CHUNKS_PER_REGION
+
+SECTOR = 4096
+POOL = 1024 * 1024
+
+
+def region_names(regions):
+    """
+    The regions x regions square of (x, z) region coordinates around the
+    origin
+    """
+    first = -(regions // 2)
+    return [(x, z) for x in range(first, first + regions)
+                   for z in range(first, first + regions)]
+
+
+def area_chunks(regions):
+    """
+    How many chunks wide the square of regions is, for mcobj's -s
+    """
+    return regions * CHUNKS_PER_REGION
+
+
+class World(object):
+    """
+    The state of the made up world: for every region, which chunks are in it
+    and when each was last saved
+    """
+    def __init__(self, regions, chunks, chunk_kb, seed=0):
+        self.random = random.Random(seed)
+        self.chunk_sectors = max(1, int(chunk_kb * 1024 + SECTOR - 1) // SECTOR)
+        # Chunks are cut out of this, so they look like the zlib streams real
+        # chunks are and the backups don't compress to nothing
+        size = POOL + self.chunk_sectors * SECTOR
+        self.pool = binascii.unhexlify("%0*x" % (size * 2,
+                self.random.getrandbits(size * 8)))
+        self.now = int(time.time()) - 86400
+        self.chunks = {}
+        for coords in region_names(regions):
+            present = self.random.sample(range(chunkindex.CHUNKS),
+                                         min(chunks, chunkindex.CHUNKS))
+            self.chunks[coords] = dict((i, self.now) for i in present)
+
+    def change(self, fraction):
+        """
+        Re-saves fraction of the chunks, an hour after the last lot
+        """
+        self.now += 3600
+        for saved in self.chunks.values():
+            for i in self.random.sample(sorted(saved),
+                                        int(len(saved) * fraction)):
+                saved[i] = self.now
+
+    def region(self, coords):
+        """
+        The bytes of the region file at coords
+        """
+        saved = self.chunks[coords]
+        locations = [0] * chunkindex.CHUNKS
+        timestamps = [0] * chunkindex.CHUNKS
+        sector = chunkindex.HEADER_SIZE // SECTOR
+        for i in sorted(saved):
+            locations[i] = (sector << 8) | self.chunk_sectors
+            timestamps[i] = saved[i]
+            sector += self.chunk_sectors
+
+        data = [struct.pack(">%dI" % chunkindex.CHUNKS, *locations),
+                struct.pack(">%dI" % chunkindex.CHUNKS, *timestamps)]
+        for i in sorted(saved):
+            # The same chunk saved at the same time is the same bytes, so
+            # unchanged region files have the same digest from backup to backup
+            start = hash((coords, i, saved[i])) % POOL
+            data.append(self.pool[start:start + self.chunk_sectors * SECTOR])
+        return "".join(data)
+
+
+def _add(tf, name, data, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = mtime
+    info.mode = 0644
+    tf.addfile(info, _Bytes(data))
+
+
+class _Bytes(object):
+    # Just enough of a file for TarFile.addfile(), without copying data into
+    # a StringIO first
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.data) - self.offset
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += len(chunk)
+        return chunk
+
+
+def generate(dest, count, regions=2, chunks=256, chunk_kb=4, changed=0.1,
+             prefix="world", suffix=".tar.gz", seed=0):
+    """
+    Writes count backups into dest, named prefix-0000 and on with suffix
+    (.tar.gz, .tgz or .tar). Returns their paths and how many bytes of
+    region files each one holds.
+    """
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    mode = suffix == ".tar" and "w" or "w:gz"
+
+    world = World(regions, chunks, chunk_kb, seed)
+    paths = []
+    size = 0
+    for n in range(count):
+        if n:
+            world.change(changed)
+        path = os.path.join(dest, "%s-%04d%s" % (prefix, n, suffix))
+        tmp = path + ".tmp"
+        tf = tarfile.open(tmp, mode)
+        try:
+            _add(tf, "world/level.dat", "\0" * 1024, world.now)
+            size = 0
+            for x, z in sorted(world.chunks):
+                data = world.region((x, z))
+                size += len(data)
+                _add(tf, "world/region/r.%d.%d.mca" % (x, z), data, world.now)
+        finally:
+            tf.close()
+        os.rename(tmp, path)
+        paths.append(path)
+    return paths, size
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] DEST")
+    parser.add_option("-n", "--count", type="int", default=10,
+            help="How many backups to make [default: %default]")
+    parser.add_option("--regions", type="int", default=2,
+            help="How many region files wide the world is [default: %default]")
+    parser.add_option("--chunks", type="int", default=256,
+            help="Chunks in each region file, up to 1024 [default: %default]")
+    parser.add_option("--chunk-kb", type="float", default=4,
+            help="Size of every chunk, rounded up to 4KB sectors "
+                 "[default: %default]")
+    parser.add_option("--changed", type="float", default=0.1,
+            help="Fraction of the chunks re-saved between backups "
+                 "[default: %default]")
+    parser.add_option("--suffix", default=".tar.gz",
+            help="[default: %default]")
+    (opts, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Where should the backups go?")
+
+    paths, size = generate(args[0], opts.count, opts.regions, opts.chunks,
+                           opts.chunk_kb, opts.changed, suffix=opts.suffix)
+    print "%d backups with %.1f MB of region files each in %s" % (
+            len(paths), size / (1024.0 * 1024), args[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+import subprocess
+import threading
+import itertools
+import logging
+import heapq
+import json
+import time
+import os
+
+from metrics import wait
+
+
+class BlenderException(Exception):
+    """
+    Raised when Blender couldn't render a frame
+    """
+
+
+class BlenderProcess(object):
+    """
+    One Blender running the render script in --batch mode. Frames are handed
+    over on stdin and answered on stdout, see obj2png.py.
+    """
+    def __init__(self, cmd):
+        self.logger = logging.getLogger('mcrender')
+        self.frames = 0
+        self.rss_mb = 0.0
+        self.started = time.time()
+        # rusage_dict() once it's exited, where there's wait4()
+        self.rusage = None
+        self.proc = subprocess.Popen(cmd + ["--", "--batch"],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+        self.logger.debug("Started blender, pid %d", self.proc.pid)
+        self._read_reply()
+
+    def _read_reply(self):
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                rc = self.proc.wait()
+                raise BlenderException("blender exited with rc = %d" % rc)
+
+            if "OBJ2PNG " in line:
+                return line[line.index("OBJ2PNG ") + 8:].rstrip("\r\n").split(" ", 2)
+
+    def render(self, obj, png, options=None):
+        if not options:
+            self.proc.stdin.write("%s\t%s\n" % (obj, png))
+        else:
+            self.proc.stdin.write("%s\t%s\t%s\n" % (obj, png,
+                                                    json.dumps(options)))
+        self.proc.stdin.flush()
+
+        reply = self._read_reply()
+        self.frames += 1
+        if reply[0] == "OK":
+            self.rss_mb = float(reply[1])
+        else:
+            raise BlenderException("blender couldn't render %s: %s" %
+                                   (obj, " ".join(reply[1:])))
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        # One that died mid-frame has already been waited for, by
+        # _read_reply(), and can't be waited for again
+        if self.proc.returncode is not None:
+            pass
+        elif hasattr(os, 'wait4'):
+            rc, self.rusage = wait(self.proc)
+        else:
+            self.proc.wait()
+        self.logger.debug("Blender %d exited after %d frames, %.0f MB",
+                          self.proc.pid, self.frames, self.rss_mb)
+
+
+class BlenderPool(object):
+    """
+    Keeps up to size Blenders running so each frame doesn't pay for starting
+    one and setting the scene up. Blender leaks memory on every import, so a
+    process is replaced once it's rendered max_frames frames or grown past
+    max_rss_mb (zero means no limit).
+
+    When every Blender is busy, previews are handed the next free one before
+    any full renders that are waiting, and otherwise it's first come, first
+    served.
+    """
+    def __init__(self, cmd, size=1, max_frames=50, max_rss_mb=0,
+                 on_exit=None):
+        self.cmd = cmd
+        # Called with each BlenderProcess once it's been closed
+        self.on_exit = on_exit
+        self.max_frames = max_frames
+        self.max_rss_mb = max_rss_mb
+        self.lock = threading.Condition()
+        # Blenders only get started once there's something for them to do
+        self.idle = [None] * max(1, size)
+        self.everyone = []
+        # (priority, ticket) of everyone waiting for a Blender
+        self.waiting = []
+        self.tickets = itertools.count()
+
+    def _take(self, priority):
+        with self.lock:
+            me = (priority, next(self.tickets))
+            heapq.heappush(self.waiting, me)
+            while not self.idle or self.waiting[0] != me:
+                self.lock.wait()
+            heapq.heappop(self.waiting)
+            # Whoever's next may be able to have one too
+            self.lock.notify_all()
+            return self.idle.pop()
+
+    def _give_back(self, proc):
+        with self.lock:
+            self.idle.append(proc)
+            self.lock.notify_all()
+
+    def _worn_out(self, proc):
+        if not proc.alive():
+            return True
+        if self.max_frames and proc.frames >= self.max_frames:
+            return True
+        if self.max_rss_mb and proc.rss_mb >= self.max_rss_mb:
+            return True
+        return False
+
+    def render(self, obj, png, tile=None, preview=None):
+        """
+        Renders obj into png; both should be absolute paths. With tile, just
+        that tile of a bigger map is rendered, and with preview, a quick draft
+        at that fraction of the size; see obj2png.py. Returns how many MB the
+        Blender that did it is using.
+        """
+        options = dict(tile or {})
+        if preview:
+            options['preview'] = preview
+
+        proc = self._take(0 if preview else 1)
+        try:
+            if proc is None:
+                proc = BlenderProcess(self.cmd)
+                self.everyone.append(proc)
+            proc.render(obj, png, options)
+            return proc.rss_mb
+        finally:
+            try:
+                if proc is not None and self._worn_out(proc):
+                    self.everyone.remove(proc)
+                    old, proc = proc, None
+                    self._close(old)
+            finally:
+                # Whatever happened, the slot has to go back, or everyone
+                # waiting for a Blender waits forever
+                self._give_back(proc)
+
+    def _close(self, proc):
+        proc.close()
+        if self.on_exit is not None:
+            self.on_exit(proc)
+
+    def close(self):
+        for proc in self.everyone:
+            self._close(proc)
+        self.everyone = []
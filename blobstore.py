@@ -0,0 +1,126 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+import os
+import json
+import logging
+import tarfile
+import tempfile
+
+import regions
+from artifacts import link_or_copy, replace
+
+
+class BlobStore(object):
+    """
+    Keeps the files out of every backup we've seen, stored once per distinct
+    content under blobs/ab/abcdef... (their sha1). Most region files don't
+    change from one backup to the next, so a new backup mostly adds a
+    manifest to manifests/ listing which blob each of its files is.
+
+    Getting a snapshot's files back out is then a matter of hard linking
+    blobs, which must never be written to.
+    """
+    def __init__(self, store_dir):
+        self.logger = logging.getLogger('mcrender')
+        self.blob_dir = os.path.join(store_dir, "blobs")
+        self.manifest_dir = os.path.join(store_dir, "manifests")
+
+        for d in [self.blob_dir, self.manifest_dir]:
+            if not os.path.exists(d):
+                os.makedirs(d)
+
+    def _blob(self, sha1):
+        return os.path.join(self.blob_dir, sha1[:2], sha1)
+
+    def _manifest(self, name):
+        return os.path.join(self.manifest_dir, name + ".json")
+
+    def has(self, name):
+        return os.path.exists(self._manifest(name))
+
+    def manifest(self, name):
+        """
+        [[member name, sha1, size, mtime], ...] for the snapshot called name
+        """
+        return json.load(open(self._manifest(name)))['files']
+
+    def ingest(self, name, tarball):
+        """
+        Adds every file in tarball that isn't stored yet and writes the
+        snapshot's manifest. Returns how many bytes were new.
+        """
+        files = []
+        added = 0
+
+        tf = tarfile.open(tarball, 'r|*')
+        try:
+            for member in tf:
+                if not member.isfile() or not regions.safe_name(member.name):
+                    continue
+
+                fd, tmp = tempfile.mkstemp(dir=self.blob_dir, suffix=".tmp")
+                os.close(fd)
+                try:
+                    sha1, head = regions.write_file(tf.extractfile(member),
+                                                    tmp, member.mtime)
+                    blob = self._blob(sha1)
+                    if os.path.exists(blob):
+                        os.remove(tmp)
+                    else:
+                        if not os.path.isdir(os.path.dirname(blob)):
+                            os.makedirs(os.path.dirname(blob))
+                        os.chmod(tmp, 0444)
+                        replace(tmp, blob)
+                        added += member.size
+                finally:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+
+                files.append([member.name, sha1, member.size, member.mtime])
+        finally:
+            tf.close()
+
+        fd, tmp = tempfile.mkstemp(dir=self.manifest_dir)
+        out = os.fdopen(fd, "w")
+        json.dump({'files': files}, out)
+        out.close()
+        replace(tmp, self._manifest(name))
+
+        self.logger.debug("Stored %s, %d of %d bytes were new", name, added,
+                          sum(f[2] for f in files))
+        return added
+
+    def checkout(self, name, dest, bounds):
+        """
+        Links level.dat and the region files covering bounds into dest. Gives
+        back what regions.extract_world() does.
+        """
+        digests = {}
+        headers = {}
+        written = 0
+        for member, sha1, size, mtime in self.manifest(name):
+            if not regions.wanted(member, bounds):
+                continue
+
+            path = os.path.join(dest, *member.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            link_or_copy(self._blob(sha1), path)
+            digests[member] = sha1
+            if regions.region_coords(member) is not None:
+                blob = open(self._blob(sha1), 'rb')
+                try:
+                    headers[member] = blob.read(regions.HEADER_SIZE)
+                finally:
+                    blob.close()
+            written += size
+
+        world = regions.find_world(digests)
+        if world is None:
+            raise ValueError("No level.dat in %s" % name)
+
+        return os.path.normpath(world or '.'), written, \
+               regions.region_digests(digests, world), \
+               regions.region_headers(headers)
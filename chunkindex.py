@@ -0,0 +1,164 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+# Every region file starts with an 8 KiB header: 1024 4-byte chunk locations
+# (3 bytes of sector offset, 1 byte of sector count; all zero when the chunk
+# doesn't exist yet) followed by 1024 4-byte timestamps of when each chunk was
+# last saved. Chunk (x, z) within the region is entry x + 32 * z.
+#
+# Comparing those timestamps between two backups tells us which chunks changed
+# without unpacking a single chunk.
+
+import os
+import json
+import struct
+import logging
+import tarfile
+import tempfile
+
+import regions
+from artifacts import replace
+
+HEADER_SIZE = regions.HEADER_SIZE
+CHUNKS = 1024
+
+
+def read_header(header):
+    """
+    {chunk index: last saved} for the chunks present in a region file header
+    """
+    if len(header) < HEADER_SIZE:
+        return {}
+
+    locations = struct.unpack(">%dI" % CHUNKS, header[:4096])
+    timestamps = struct.unpack(">%dI" % CHUNKS, header[4096:HEADER_SIZE])
+    return dict((i, timestamps[i]) for i in range(CHUNKS) if locations[i])
+
+
+def in_bounds(coords, i, bounds):
+    if bounds is None:
+        return True
+
+    x = coords[0] * regions.CHUNKS_PER_REGION + i % regions.CHUNKS_PER_REGION
+    z = coords[1] * regions.CHUNKS_PER_REGION + i // regions.CHUNKS_PER_REGION
+    return bounds[0] <= x <= bounds[2] and bounds[1] <= z <= bounds[3]
+
+
+def scan_archive(tarball, bounds):
+    """
+    Reads just the headers of the region files covering bounds out of
+    tarball. Returns {region file: {chunk index: last saved}}, leaving out
+    chunks outside bounds.
+    """
+    found = {}
+
+    tf = tarfile.open(tarball, 'r|*')
+    try:
+        for member in tf:
+            if not member.isfile():
+                continue
+            coords = regions.region_coords(member.name)
+            if coords is None or not regions.wanted(member.name, bounds):
+                continue
+
+            header = read_header(tf.extractfile(member).read(HEADER_SIZE))
+            name = "/".join(member.name.split("/")[-2:])
+            found[name] = dict((i, ts) for i, ts in header.iteritems()
+                               if in_bounds(coords, i, bounds))
+    finally:
+        tf.close()
+
+    return found
+
+
+class ChunkIndex(object):
+    """
+    Remembers the chunk timestamps of every snapshot we've looked at, one
+    JSON file per snapshot in index_dir, so each backup only has its headers
+    read once (and again if the bounds change).
+    """
+    def __init__(self, index_dir, bounds):
+        self.logger = logging.getLogger('mcrender')
+        self.index_dir = index_dir
+        self.bounds = bounds and list(bounds)
+
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+
+    def _path(self, name):
+        return os.path.join(self.index_dir, name + ".json")
+
+    def _load(self, name):
+        try:
+            saved = json.load(open(self._path(name)))
+            if saved['bounds'] == self.bounds:
+                return dict((region, dict((int(i), ts) for i, ts in chunks.iteritems()))
+                            for region, chunks in saved['regions'].iteritems())
+        except (IOError, ValueError, KeyError):
+            pass
+        return None
+
+    def _save(self, name, found):
+        fd, tmp = tempfile.mkstemp(dir=self.index_dir)
+        out = os.fdopen(fd, "w")
+        json.dump({'bounds': self.bounds, 'regions': found}, out)
+        out.close()
+        replace(tmp, self._path(name))
+
+    def headers(self, name, tarball):
+        found = self._load(name)
+        if found is not None:
+            return found
+
+        self.logger.debug("Indexing chunks of %s", name)
+        found = scan_archive(tarball, self.bounds)
+        self._save(name, found)
+        return found
+
+    def indexed(self, name):
+        return self._load(name) is not None
+
+    def record(self, name, headers):
+        """
+        Saves what headers() would find for name from the region file
+        headers read while extracting it ({region file: header}, see
+        regions.extract_world()), so it never needs scanning. Returns the
+        same as headers().
+        """
+        found = {}
+        for region, header in headers.iteritems():
+            coords = regions.region_coords(region)
+            if coords is None or not regions.wanted(region, self.bounds):
+                continue
+            found[region] = dict((i, ts) for i, ts in
+                                 read_header(header).iteritems()
+                                 if in_bounds(coords, i, self.bounds))
+        self._save(name, found)
+        return found
+
+    def changes(self, old_name, old_tarball, new_name, new_tarball):
+        """
+        [(region file, chunk index), ...] of the chunks that were added,
+        removed or saved again between two snapshots
+        """
+        old = self.headers(old_name, old_tarball)
+        new = self.headers(new_name, new_tarball)
+
+        changed = []
+        for region in set(old) | set(new):
+            old_chunks = old.get(region, {})
+            new_chunks = new.get(region, {})
+            for i in set(old_chunks) | set(new_chunks):
+                if old_chunks.get(i) != new_chunks.get(i):
+                    changed.append((region, i))
+
+        return sorted(changed)
+
+    def cost(self, name, tarball):
+        """
+        How many chunks mcobj and Blender will have to chew through, which is
+        about as good a guess at how long a snapshot takes as we can make
+        without doing the work
+        """
+        return sum(len(chunks) for chunks in self.headers(name, tarball).values())
@@ -0,0 +1,139 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+import os
+import re
+import json
+import time
+import logging
+import tempfile
+
+from artifacts import replace
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# A directory listed less than this many seconds after it last changed is
+# listed again next time, in case something arrived within the same tick of
+# its (possibly coarse, possibly NFS server's) clock
+SLACK = 60
+
+
+def list_dir(path):
+    """
+    The names of the files in path. scandir hands them out as it reads the
+    directory and mostly knows which are files without a stat; plain listdir
+    gives back directories too.
+    """
+    if scandir is None:
+        return iter(os.listdir(path))
+    return (entry.name for entry in scandir(path) if entry.is_file())
+
+
+class Discovery(object):
+    """
+    Remembers which backups there are in the source directory, with their
+    size and mtime, in a JSON file. The directory is only listed again once
+    its mtime (the cursor) moves, and then only new entries are looked at.
+
+    A backup only counts once it's been the same size for settle seconds,
+    so one that's still being copied in isn't picked up half written.
+    """
+    def __init__(self, path, src_dir, pattern, settle=0):
+        self.logger = logging.getLogger('mcrender')
+        self.path = path
+        self.src_dir = src_dir
+        self.pattern = pattern
+        self.file_re = re.compile(pattern)
+        self.settle = settle
+
+        self.cursor = None
+        self.scanned = 0
+        # {file name: [size, mtime]} of backups we've counted
+        self.seen = {}
+        # Same for ones still settling, plus when we saw them change
+        self.pending = {}
+
+        try:
+            saved = json.load(open(path))
+            if saved['src_dir'] == src_dir and saved['pattern'] == pattern:
+                self.cursor = saved['cursor']
+                self.scanned = saved['scanned']
+                self.seen = saved['seen']
+                self.pending = saved['pending']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def _save(self):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        out = os.fdopen(fd, "w")
+        json.dump({'src_dir': self.src_dir, 'pattern': self.pattern,
+                   'cursor': self.cursor, 'scanned': self.scanned,
+                   'seen': self.seen, 'pending': self.pending}, out)
+        out.close()
+        replace(tmp, self.path)
+
+    def _settled(self, name, now):
+        """
+        Stats a pending backup again. Returns whether it's done changing.
+        """
+        try:
+            st = os.stat(os.path.join(self.src_dir, name))
+        except OSError:
+            del self.pending[name]
+            return False
+
+        size, mtime, since = self.pending[name]
+        if size is not None and [size, mtime] != [st.st_size, st.st_mtime]:
+            since = now
+        self.pending[name] = [st.st_size, st.st_mtime, since]
+        return now - max(since, st.st_mtime) >= self.settle
+
+    def scan(self):
+        """
+        Looks for backups that have arrived since the last scan. Returns
+        their names (without the suffix), sorted.
+        """
+        now = time.time()
+        mtime = os.stat(self.src_dir).st_mtime
+        if mtime != self.cursor or self.scanned - mtime < SLACK:
+            self.logger.debug("Listing %s", self.src_dir)
+            present = set()
+            for name in list_dir(self.src_dir):
+                if not self.file_re.match(name):
+                    continue
+                present.add(name)
+                if name not in self.seen and name not in self.pending:
+                    # A new arrival; it's stat()ed below
+                    self.pending[name] = [None, None, 0]
+
+            for gone in set(self.seen) - present:
+                del self.seen[gone]
+            for gone in set(self.pending) - present:
+                del self.pending[gone]
+
+            self.cursor = mtime
+            self.scanned = now
+
+        arrived = []
+        for name in sorted(self.pending):
+            if self._settled(name, now):
+                self.seen[name] = self.pending.pop(name)[:2]
+                arrived.append(name)
+
+        self._save()
+        if arrived:
+            self.logger.debug("Found %d new backups", len(arrived))
+        return sorted(name.split(".")[0] for name in arrived)
+
+    def names(self):
+        """
+        The names (without the suffix) of every backup we know of
+        """
+        return set(name.split(".")[0] for name in self.seen)
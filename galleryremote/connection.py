@@ -0,0 +1,302 @@
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with it; if not, write to the Free Software Foundation, Inc., 51
+# Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import httplib
+import socket
+import base64
+import threading
+import urlparse
+import urllib
+import urllib2
+import logging
+
+# Like urllib2's HTTPRedirectHandler: a POST answered with one of these is
+# followed as a GET without the body; 307 is only followed for GETs
+REDIRECTS = (301, 302, 303, 307)
+MAX_REDIRECTS = 10
+
+
+class _CookieResponse:
+    """
+    The bits of a urllib2 response cookielib needs to pick cookies out of
+    an httplib response
+    """
+    def __init__(self, msg):
+        self.msg = msg
+
+    def info(self):
+        return self.msg
+
+
+class _PooledResponse:
+    """
+    The body of a response, read straight off the pooled connection it came
+    in on. close() it when done with it to give the connection back.
+    """
+    def __init__(self, pool, conn, response):
+        self.pool = pool
+        self.conn = conn
+        self.response = response
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def __iter__(self):
+        """
+        The body a line at a time, without ever holding much more than a line
+        """
+        partial = ''
+        while True:
+            data = self.response.read(16384)
+            if not data:
+                break
+            lines = (partial + data).split('\n')
+            partial = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if partial:
+            yield partial
+
+    def close(self):
+        if self.conn is None:
+            return
+        # The connection can only take another request once this response has
+        # been read to the end
+        self.pool._release(self.conn, self.response.isclosed() and
+                                      not self.response.will_close)
+        self.conn = None
+
+
+def _origin(url):
+    parts = urlparse.urlsplit(url)
+    return parts.scheme, parts.hostname, parts.port
+
+
+class ConnectionPool:
+    """
+    A small pool of persistent HTTP/1.1 connections, so a run of requests
+    doesn't pay for a new TCP (and SSL) handshake each time. Idle connections
+    are kept per host and reused most recently used first; a connection the
+    server has closed in the meantime is replaced and the request tried
+    again.
+
+    Cookies are kept in cookiejar, redirects are followed and the proxies in
+    $http_proxy, $https_proxy and $no_proxy are used, just like urllib2's
+    default opener would. The pool is safe to use from several threads at
+    once; at most size connections are ever open.
+    """
+
+    def __init__(self, url, cookiejar, size=2, ssl_context=None, timeout=None,
+                 proxies=None):
+        """
+        url - the gallery's URL; connections are opened to whichever hosts
+              requests (and redirects) go to, as they're needed
+        cookiejar - a cookielib.CookieJar for the session's cookies
+        size - most connections to keep open at once
+        ssl_context - an M2Crypto SSL.Context for https, if M2Crypto is around
+        timeout - socket timeout in seconds, None for the system default
+        proxies - {scheme: proxy URL}, by default from the environment
+        """
+        self.cookiejar = cookiejar
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+        if proxies is None:
+            proxies = urllib.getproxies()
+        self.proxies = proxies
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(max(1, size))
+        self.opened = 0
+
+    def _proxy(self, scheme, host):
+        """
+        (host, port, Proxy-Authorization header or None) of the proxy for
+        requests to host, or None to connect straight to it
+        """
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.proxy_bypass(host):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parts = urlparse.urlsplit(proxy)
+        auth = None
+        if parts.username is not None:
+            auth = 'Basic ' + base64.b64encode('%s:%s' % (
+                urllib.unquote(parts.username),
+                urllib.unquote(parts.password or '')))
+        return parts.hostname, parts.port, auth
+
+    def _connect(self, origin):
+        scheme, host, port = origin
+        proxy = self._proxy(scheme, host)
+        if scheme == 'https':
+            if self.ssl_context is not None:
+                from M2Crypto import httpslib
+                if proxy is not None:
+                    # Sent the whole URL, and tunnels to its host itself
+                    conn = httpslib.ProxyHTTPSConnection(
+                            proxy[0], proxy[1], ssl_context=self.ssl_context)
+                else:
+                    conn = httpslib.HTTPSConnection(host, port,
+                                                    ssl_context=self.ssl_context)
+            elif proxy is not None:
+                conn = httplib.HTTPSConnection(proxy[0], proxy[1],
+                                               timeout=self.timeout)
+                conn.set_tunnel(host, port, proxy[2] and
+                                {'Proxy-Authorization': proxy[2]} or None)
+                proxy = None
+            else:
+                conn = httplib.HTTPSConnection(host, port,
+                                               timeout=self.timeout)
+        elif proxy is not None:
+            conn = httplib.HTTPConnection(proxy[0], proxy[1],
+                                          timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=self.timeout)
+        # Which idle list conn goes back on, and whether requests on it go to
+        # a proxy, as the whole URL
+        conn.mcr_origin = origin
+        conn.mcr_proxy = proxy
+        self.opened += 1
+        logging.debug( "Opening connection %d to %s" % (self.opened, host) )
+        return conn
+
+    def _send(self, conn, method, url, body, headers):
+        if conn.mcr_proxy is not None:
+            selector = url
+            if conn.mcr_proxy[2] is not None:
+                headers = dict(headers)
+                headers['Proxy-Authorization'] = conn.mcr_proxy[2]
+        else:
+            parts = urlparse.urlsplit(url)
+            selector = parts.path or '/'
+            if parts.query:
+                selector += '?' + parts.query
+        conn.request(method, selector, body, headers)
+        return conn.getresponse()
+
+    def _release(self, conn, reusable):
+        try:
+            if reusable:
+                self.lock.acquire()
+                try:
+                    self.idle.setdefault(conn.mcr_origin, []).append(conn)
+                finally:
+                    self.lock.release()
+            else:
+                conn.close()
+        finally:
+            self.slots.release()
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Sends a request and reads the whole response.
+        Returns (status, reason, headers, data).
+        body - a string, or something with read() such as a MultipartBody; it
+               has to have a reset() to be sent again after a dropped
+               connection
+        """
+        status, reason, msg, response = self.stream(method, url, body, headers)
+        try:
+            data = response.read()
+        finally:
+            response.close()
+        return status, reason, msg, data
+
+    def stream(self, method, url, body=None, headers=None):
+        """
+        Sends a request like request() does, but leaves the body to be read.
+        Returns (status, reason, headers, response); the response has to be
+        close()d to give its connection back to the pool.
+        """
+        headers = dict(headers or {})
+
+        for i in range(MAX_REDIRECTS + 1):
+            status, reason, msg, response = self._stream(method, url, body,
+                                                         headers)
+            location = msg.getheader('location') or msg.getheader('uri')
+            if status not in REDIRECTS or not location or \
+                    (status == 307 and method != 'GET'):
+                return status, reason, msg, response
+
+            response.read()
+            response.close()
+            url = urlparse.urljoin(url, location)
+            logging.debug( "Redirected to %s" % url )
+            if method == 'POST':
+                method, body = 'GET', None
+                headers = dict((k, v) for k, v in headers.iteritems()
+                               if k.lower() not in ('content-type',
+                                                    'content-length'))
+
+        raise httplib.HTTPException("Redirected more than %d times" %
+                                    MAX_REDIRECTS)
+
+    def _stream(self, method, url, body, headers):
+        headers = dict(headers)
+
+        # Let cookielib decide which cookies go along with this request
+        cookie_req = urllib2.Request(url, headers=headers)
+        self.cookiejar.add_cookie_header(cookie_req)
+        headers.update(cookie_req.unredirected_hdrs)
+
+        origin = _origin(url)
+        self.slots.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                idle = self.idle.get(origin)
+                conn = idle and idle.pop() or None
+            finally:
+                self.lock.release()
+
+            reused = conn is not None
+            if conn is None:
+                conn = self._connect(origin)
+
+            try:
+                response = self._send(conn, method, url, body, headers)
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                # Idle keep-alive connections get closed by the server after a
+                # while; that's only worth a retry if this one had been idle
+                if not reused or not (isinstance(body, (str, type(None))) or
+                                      hasattr(body, 'reset')):
+                    raise
+                if hasattr(body, 'reset'):
+                    body.reset()
+                conn = self._connect(origin)
+                try:
+                    response = self._send(conn, method, url, body, headers)
+                except:
+                    conn.close()
+                    raise
+        except:
+            self.slots.release()
+            raise
+
+        self.cookiejar.extract_cookies(_CookieResponse(response.msg), cookie_req)
+
+        return response.status, response.reason, response.msg, \
+               _PooledResponse(self, conn, response)
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+        finally:
+            self.lock.release()
@@ -29,11 +29,10 @@ USER_AGENT = 'python-galleryremote v. %s' % (__version__)
 
 CA_SYSTEM_DIR = '/etc/ssl/certs'
 
-import urllib2
 import cookielib
 
 try:
-    from M2Crypto import m2urllib2, SSL
+    from M2Crypto import SSL
     M2CRYPTO_AVAILABLE = True
 except:
     M2CRYPTO_AVAILABLE = False
@@ -41,7 +40,13 @@ except:
 import StringIO
 import time
 import logging
+import os
+import socket
+import httplib
+import threading
+import Queue
 from multipart import multipart
+from connection import ConnectionPool
 
 class GalleryException(Exception):
     """
@@ -59,6 +64,79 @@ class NotSupportedException(Exception):
     other version.
     """
 
+# The keys of the dicts fetch_albums() and fetch_album_images() give back,
+# and the protocol field each one comes from
+ALBUM_FIELDS = [
+    ('name', 'name'),
+    ('title', 'title'),
+    ('summary', 'summary'),
+    ('parent', 'parent'),
+    ('resize_size', 'resize_size'),
+    ('perms.add', 'perms.add'),
+    ('perms.write', 'perms.write'),
+    ('perms.del_item', 'perms.del_item'),
+    ('perms.del_alb', 'perms.del_alb'),
+    ('perms.create_sub', 'perms.create_sub'),
+    ('perms.info.extrafields', 'info.extrafields'),
+    ('ownerid', 'ownerid'),
+]
+
+IMAGE_FIELDS = [
+    ('name', 'name'),
+    ('title', 'title'),
+    ('raw_width', 'raw_width'),
+    ('raw_height', 'raw_height'),
+    ('resizedName', 'resizedName'),
+    ('resized_width', 'resized_width'),
+    ('resized_height', 'resized_height'),
+    ('thumbName', 'thumbName'),
+    ('thumb_width', 'thumb_width'),
+    ('thumb_height', 'thumb_height'),
+    ('raw_filesize', 'raw_filesize'),
+    ('caption', 'caption'),
+    ('clicks', 'clicks'),
+    ('capturedate.year', 'capturedate.year'),
+    ('capturedate.mon', 'capturedate.mon'),
+    ('capturedate.mday', 'capturedate.mday'),
+    ('capturedate.hours', 'capturedate.hours'),
+    ('capturedate.minutes', 'capturedate.minutes'),
+    ('capturedate.seconds', 'capturedate.seconds'),
+    ('description', 'extrafield.Description'),
+    ('hidden', 'hidden'),
+]
+
+# Gallery Remote statuses that mean we're not logged in (any more): login
+# missing, and no permission to add, write or view, which is what an expired
+# session is told as it's back to being a guest
+NOT_LOGGED_IN = ['202', '401', '404', '405']
+
+class _InFlight:
+    """
+    Keeps the bytes being uploaded at once under a limit. A file bigger than
+    the limit is let through once nothing else is in flight.
+    """
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, size):
+        self.cond.acquire()
+        try:
+            while self.limit and self.used and self.used + size > self.limit:
+                self.cond.wait()
+            self.used += size
+        finally:
+            self.cond.release()
+
+    def release(self, size):
+        self.cond.acquire()
+        try:
+            self.used -= size
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
 class Gallery:
     """
     The Gallery class implements the Gallery Remote protocol as documented
@@ -79,12 +157,18 @@ class Gallery:
     albums = my_gallery.fetch_albums()
     """
 
-    def __init__(self, url, version=2):
+    def __init__(self, url, version=2, connections=2, on_request=None):
         """
         Create a Gallery for remote access.
         url - base address of the gallery
         version - version of the gallery being connected to (default 2),
                   either 1 for Gallery1 or 2 for Gallery2
+        connections - how many persistent connections to the gallery to keep
+                      open (default 2); they're reused for every request
+        on_request - called as on_request(command, seconds, bytes, error)
+                     after every request, with how long it took from sending
+                     to the end of the response, the size of the request
+                     body, and the exception it failed with or None
         
         gallery-uploader is able to cope with secured connections, thanks to
         M2Crypto. It won't catch any exception, though: handling i.e. unverified
@@ -112,6 +196,7 @@ class Gallery:
                 print "WARNING: M2Crypto missing, gallery-uploader connections will not be secure!"
         
         self.cookiejar = cookielib.CookieJar()
+        self.ssl_context = None
         
         if self.secured:
             self.ssl_context = SSL.Context()
@@ -119,15 +204,58 @@ class Gallery:
             self.ssl_context.set_verify( SSL.verify_peer |
                                          SSL.verify_fail_if_no_peer_cert |
                                          SSL.verify_client_once, 20 )
-            self.opener = m2urllib2.build_opener( self.ssl_context, urllib2.HTTPCookieProcessor(self.cookiejar) )
-        else:
-            self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(self.cookiejar))
+
+        # Every request goes over one of these kept-alive connections, with the
+        # session cookies kept in self.cookiejar
+        self.pool = ConnectionPool( self.url, self.cookiejar, connections,
+                                    self.ssl_context )
 
             
+        self.on_request = on_request
         self.logged_in = 0
+        # What to log in with again when the session expires, see _relogin()
+        self.credentials = None
+        self.logins = 0
+        self.login_lock = threading.Lock()
         self.protocol_version = '2.5'
         self.auth_token = ''
 
+    def _open(self, url, body=None, headers=None):
+        """
+        Send a request over one of the pooled connections, returning the
+        response headers and body.
+        """
+        if body is None:
+            method = 'GET'
+        else:
+            method = 'POST'
+
+        status, reason, info, data = self.pool.request(method, url, body,
+                                                       headers)
+        if status >= 400:
+            raise ConnectionException, "HTTP %d %s from %s" % (status, reason,
+                                                               url)
+        return info, data
+
+    def close(self):
+        """
+        Close the connections to the gallery. They're reopened as needed.
+        """
+        self.pool.close()
+
+    def _stream(self, url, body=None, headers=None):
+        """
+        Like _open, but leaves the body of the response to be read. It has to
+        be close()d when done with.
+        """
+        status, reason, info, response = self.pool.stream('POST', url, body,
+                                                          headers)
+        if status >= 400:
+            response.close()
+            raise ConnectionException, "HTTP %d %s from %s" % (status, reason,
+                                                               url)
+        return info, response
+
     def _do_request(self, request, file_info=None):
         """
         Send a request, encoded as described in the Gallery Remote protocol.
@@ -135,6 +263,22 @@ class Gallery:
         file_info - a tuple with the field name and the filename to be added
           in the body
         """
+        response = {}
+        for record in self._do_request_records(request, None, response,
+                                               file_info):
+            pass
+        return response
+
+    def _do_request_records(self, request, prefix, response, file_info=None,
+                            relogin=True):
+        """
+        Send a request like _do_request, but as a generator of the numbered
+        records in the response (see _parse_response), decoded as they come
+        off the connection. The rest of the response is put in the response
+        dict, and errors reported by the gallery are raised after the last
+        record. A request turned away because the session has expired is
+        sent again after logging in again, unless relogin is False.
+        """
         boundary = '------python-galleryremote_boundary_%d' % int(time.time())
 
         headers = {'User-agent' : USER_AGENT,
@@ -148,21 +292,43 @@ class Gallery:
             logging.debug( "Submitting no auth token" )
         
         enc_request = multipart(boundary, request, file_info)
+        # With the length known up front httplib doesn't need the body as a
+        # string, and sends it a block at a time straight from the file
+        headers['Content-length'] = str(len(enc_request))
         logging.debug( '\n\t\tREQUEST\n' )
         logging.debug( str(request) )
         logging.debug( '\n\t\tHEADERS (OUT)\n' )
         logging.debug( str(headers) )
-        req = urllib2.Request(self.url, enc_request, headers)
-        response = self.opener.open( req )
+        command = request.get('g2_form[cmd]', request.get('cmd'))
+        logins = self.logins
+        size = len(enc_request)
+        start = time.time()
+        try:
+            info, data = self._stream( self.url, enc_request, headers )
+        except Exception, e:
+            self._timed(command, start, size, e)
+            raise
+        finally:
+            enc_request.close()
         
-        info = response.info()
         logging.debug( "\n\t\tINFO (IN)\n" )
         logging.debug( str(info) )
 
-        data = response.read()
+        error = None
+        records = 0
+        try:
+            for record in self._parse_response( data, prefix, response ):
+                records += 1
+                yield record
+        except Exception, e:
+            error = e
+            raise
+        finally:
+            data.close()
+            self._timed(command, start, size, error)
+
         logging.debug( "\n\t\tDATA (IN)\n" )
-        logging.debug( str(data) )
-        response = self._parse_response( data )
+        logging.debug( str(response) )
         
         if 'auth_token' in response:
             self.auth_token = response['auth_token']
@@ -175,48 +341,93 @@ class Gallery:
             # but I didn't test; it was already there and assumed that 'status'
             # _was_ in response -- Pietro Battiston
             if response['status'] != '0':
+                if relogin and not records and command != 'login' and \
+                        self.credentials is not None and \
+                        response['status'] in NOT_LOGGED_IN:
+                    self._relogin(logins)
+                    response.clear()
+                    for record in self._do_request_records(request, prefix,
+                            response, file_info, relogin=False):
+                        yield record
+                    return
                 raise GalleryException, response['status_text']
         else:
             # ... but apparently, in Gallery 2 exceptions response _doesn't_
             # contain 'status' (FIXME: VERIFY!):
             if 'debug_exception' in response:
                 raise GalleryException, response['debug_exception']
-
-        return response
     
-    def _parse_response(self, response):
+    def _timed(self, command, start, size, error):
+        if self.on_request is None:
+            return
+        try:
+            self.on_request(command, time.time() - start, size, error)
+        except Exception:
+            logging.exception( "on_request failed for %s" % command )
+
+    def _parse_response(self, response, prefix=None, scalars=None):
         """
-        Decode the response from a request, returning a request dict
+        Decode the response from a request in a single pass. This is a
+        generator of the numbered records in it: keys of the form
+        prefix.field.N are gathered into one {field: value} dict per N, each
+        handed out once the next one starts (the gallery lists all of an
+        item's keys together). Every other key goes into scalars.
         response - The response from a gallery request, encoded according
-                   to the gallery remote protocol
+                   to the gallery remote protocol; a string, or anything
+                   giving its lines when iterated over
+        prefix - what record keys start with, i.e. 'album' or 'image'; None
+                 leaves every key in scalars
+        scalars - dict for the keys that aren't part of a record
         """
-        myStr = StringIO.StringIO(response)
-        
-        header_found = False
-        
-        for line in myStr:
+        if isinstance(response, basestring):
+            response = StringIO.StringIO(response)
+        if scalars is None:
+            scalars = {}
+
+        lines = iter(response)
+        seen = []
+        for line in lines:
             if '#__GR2PROTO__' in line:
-                header_found = True
                 break
-        
-        if not header_found:
+            if len(seen) < 20:
+                seen.append(line)
+        else:
             # the 1st line should start with #__GR2PROTO__ !
-            raise ConnectionException, "Bad response: \n" + response
-            
-        resDict = {}
-        
-        # This operates still on myStr (on the lines _following_ the header):
-        for myS in myStr:
-            strList = myS.split('=', 2)
-                
-            try:
-                resDict[strList[0]] = strList[1]
-                if resDict[strList[0]].endswith('\n'):
-                    resDict[strList[0]] = resDict[strList[0]][:-1]                    
-            except:
-                resDict[strList[0]] = ''
-        
-        return resDict
+            raise ConnectionException, "Bad response: \n" + ''.join(seen)
+
+        lead = prefix and prefix + '.'
+        index = None
+        record = {}
+
+        # This operates still on lines (on the lines _following_ the header):
+        for line in lines:
+            if line.endswith('\n'):
+                line = line[:-1]
+            key, sep, value = line.partition('=')
+
+            if lead and key.startswith(lead):
+                field, dot, n = key[len(lead):].rpartition('.')
+                if dot and n.isdigit():
+                    if n != index:
+                        if record:
+                            yield record
+                        index = n
+                        record = {}
+                    record[field] = value
+                    continue
+
+            scalars[key] = value
+
+        if record:
+            yield record
+
+    def _record(self, record, fields):
+        """
+        Pick the fields of a record (from _parse_response) out into a dict,
+        with '' for any that are missing.
+        fields - list of (key to use, field in the record) tuples
+        """
+        return dict((key, record.get(field, '')) for key, field in fields)
 
     def _get(self, response, kwd):
         """
@@ -253,6 +464,27 @@ class Gallery:
         
         # as long as it comes back here without an exception, we're ok.
         self.logged_in = True
+        self.credentials = (username, password)
+        self.logins += 1
+
+    def _relogin(self, logins):
+        """
+        Log in again with the last credentials that worked, after the session
+        expired.
+        logins - self.logins when the request that was turned away was sent;
+                 if it's gone up since, another thread has already logged in
+                 again
+        """
+        self.login_lock.acquire()
+        try:
+            if self.logins != logins:
+                return
+            logging.info( "Gallery session expired, logging in again" )
+            self.cookiejar.clear()
+            self.auth_token = ''
+            self.login(*self.credentials)
+        finally:
+            self.login_lock.release()
     
     def fetch_albums(self):
         """
@@ -271,26 +503,10 @@ class Gallery:
                 'g2_form[protocol_version]' : self.protocol_version,
                 'g2_form[cmd]' : 'fetch-albums'
             }
-        response = self._do_request(request)
-        
-        # as long as it comes back here without an exception, we're ok.
         albums = {}
         
-        for x in range(1, int(response['album_count']) + 1):
-            album = {}
-            album['name']                   = self._get(response,'album.name.' + str(x))
-            album['title']                  = self._get(response,'album.title.' + str(x))
-            album['summary']                = self._get(response,'album.summary.' + str(x))
-            album['parent']                 = self._get(response,'album.parent.' + str(x))
-            album['resize_size']            = self._get(response,'album.resize_size.' + str(x))
-            album['perms.add']              = self._get(response,'album.perms.add.' + str(x))
-            album['perms.write']            = self._get(response,'album.perms.write.' + str(x))
-            album['perms.del_item']         = self._get(response,'album.perms.del_item.' + str(x))
-            album['perms.del_alb']          = self._get(response,'album.perms.del_alb.' + str(x))
-            album['perms.create_sub']       = self._get(response,'album.perms.create_sub.' + str(x))
-            album['perms.info.extrafields'] = self._get(response,'album.info.extrafields' + str(x))
-            album['ownerid']                = self._get(response,'album.ownerid' + str(x))
-            
+        for record in self._do_request_records(request, 'album', {}):
+            album = self._record(record, ALBUM_FIELDS)
             albums[album['name']] = album
         
         return albums
@@ -318,33 +534,18 @@ class Gallery:
                 'g2_form[protocol_version]' : self.protocol_version,
                 'g2_form[cmd]' : 'fetch-albums-prune'
             }
-        response = self._do_request(request)
-        
-        # as long as it comes back here without an exception, we're ok.
         albums = {}
         
-        for x in range(1, int(response['album_count']) + 1):
-            album = {}
-            album['name']                   = self._get(response,'album.name.' + str(x))
-            album['title']                  = self._get(response,'album.title.' + str(x))
-            album['summary']                = self._get(response,'album.summary.' + str(x))
-            album['parent']                 = self._get(response,'album.parent.' + str(x))
-            album['resize_size']            = self._get(response,'album.resize_size.' + str(x))
-            album['perms.add']              = self._get(response,'album.perms.add.' + str(x))
-            album['perms.write']            = self._get(response,'album.perms.write.' + str(x))
-            album['perms.del_item']         = self._get(response,'album.perms.del_item.' + str(x))
-            album['perms.del_alb']          = self._get(response,'album.perms.del_alb.' + str(x))
-            album['perms.create_sub']       = self._get(response,'album.perms.create_sub.' + str(x))
-            album['perms.info.extrafields'] = self._get(response,'album.info.extrafields' + str(x))
-            album['ownerid']                = self._get(response,'album.ownerid' + str(x))
-            
+        for record in self._do_request_records(request, 'album', {}):
+            album = self._record(record, ALBUM_FIELDS)
             albums[album['name']] = album
         
         return albums
 
     def add_item(self, album, filename, caption, description):
         """
-        Add a photo to the specified album.
+        Add a photo to the specified album, returning the name / identifier
+        of the new item ('' if the gallery doesn't say).
         album - album name / identifier
         filename - image to upload
         caption - string caption to add to the image
@@ -372,6 +573,93 @@ class Gallery:
             }
             response = self._do_request(request, ('g2_userfile', filename) )
         
+        # The new item's name / identifier, if the gallery told us
+        return self._get(response, 'item_name')
+
+    def add_items(self, album, files, concurrency=2, retries=3, backoff=1.0,
+                  max_bytes=None):
+        """
+        Add several photos to the specified album, up to concurrency of them
+        at once over the pooled connections. Returns one dict per file, in
+        the same order as files:
+          filename - the file, as given
+          item - name / identifier of the new item, as from add_item()
+          error - None if the upload worked, or what went wrong
+          attempts - how many times it was sent
+          bytes - size of the file
+          seconds - how long it took, retries and all
+        album - album name / identifier
+        files - list of (filename, caption, description) tuples
+        concurrency - most uploads at once; beyond the number of connections
+                      the Gallery was created with they just wait their turn
+        retries - how many more times to send a file after a connection
+                  error, waiting backoff, 2 * backoff, ... seconds in between.
+                  Errors reported by the gallery itself aren't retried.
+        max_bytes - most bytes of files being uploaded at once (default no
+                    limit)
+        """
+        results = [None] * len(files)
+        todo = Queue.Queue()
+        for i in range(len(files)):
+            todo.put(i)
+        in_flight = _InFlight(max_bytes)
+
+        def upload(i):
+            filename, caption, description = files[i]
+            result = {'filename': filename, 'item': None, 'error': None,
+                      'attempts': 0, 'bytes': 0, 'seconds': 0.0}
+            start = time.time()
+            try:
+                result['bytes'] = os.path.getsize(filename)
+            except OSError, e:
+                result['error'] = str(e)
+                return result
+
+            in_flight.acquire(result['bytes'])
+            try:
+                while True:
+                    result['attempts'] += 1
+                    try:
+                        result['item'] = self.add_item(album, filename,
+                                                       caption, description)
+                        break
+                    except (ConnectionException, httplib.HTTPException,
+                            socket.error), e:
+                        if result['attempts'] > retries:
+                            result['error'] = str(e) or e.__class__.__name__
+                            break
+                        delay = backoff * 2 ** (result['attempts'] - 1)
+                        logging.debug( "Uploading %s failed (%s), retrying in "
+                                       "%.1fs" % (filename, e, delay) )
+                        time.sleep(delay)
+                    except Exception, e:
+                        result['error'] = str(e) or e.__class__.__name__
+                        break
+            finally:
+                in_flight.release(result['bytes'])
+                result['seconds'] = time.time() - start
+
+            return result
+
+        def work():
+            while True:
+                try:
+                    i = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                results[i] = upload(i)
+
+        threads = [threading.Thread(target=work)
+                       for n in range(max(1, min(concurrency, len(files))))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            # join() with a timeout so Ctrl-C still gets through
+            while t.is_alive():
+                t.join(0.5)
+
+        return results
     
     def album_properties(self, album):
         """
@@ -472,6 +760,15 @@ class Gallery:
         Get the image information for all images in the specified album.
         album - specifies the album from which to obtain image information
         """
+        return list(self.iter_album_images(album))
+
+    def iter_album_images(self, album):
+        """
+        Like fetch_album_images, but a generator handing out each image's
+        information as it's read, so even huge albums are never held in
+        memory all at once.
+        album - specifies the album from which to obtain image information
+        """
         if self.version == 1:
             request = {
                 'protocol_version' : self.protocol_version,
@@ -490,37 +787,8 @@ class Gallery:
                 'g2_form[extrafields]' : 'yes'
             }
         
-        response = self._do_request(request)
-        
-        # as long as it comes back here without an exception, we're ok.
-        images = []
-        
-        for x in range(1, int(response['image_count']) + 1):
-            image = {}
-            image['name']                = self._get(response, 'image.name.' + str(x))
-            image['title']               = self._get(response, 'image.title.' + str(x))
-            image['raw_width']           = self._get(response, 'image.raw_width.' + str(x))
-            image['raw_height']          = self._get(response, 'image.raw_height.' + str(x))
-            image['resizedName']         = self._get(response, 'image.resizedName.' + str(x))
-            image['resized_width']       = self._get(response, 'image.resized_width.' + str(x))
-            image['resized_height']      = self._get(response, 'image.resized_height.' + str(x))
-            image['thumbName']           = self._get(response, 'image.thumbName.' + str(x))
-            image['thumb_width']         = self._get(response, 'image.thumb_width.' + str(x))
-            image['thumb_height']        = self._get(response, 'image.thumb_height.' + str(x))
-            image['raw_filesize']        = self._get(response, 'image.raw_filesize.' + str(x))
-            image['caption']             = self._get(response, 'image.caption.' + str(x))
-            image['clicks']              = self._get(response, 'image.clicks.' + str(x))
-            image['capturedate.year']    = self._get(response, 'image.capturedate.year' + str(x))
-            image['capturedate.mon']     = self._get(response, 'image.capturedate.mon' + str(x))
-            image['capturedate.mday']    = self._get(response, 'image.capturedate.mday' + str(x))
-            image['capturedate.hours']   = self._get(response, 'image.capturedate.hours' + str(x))
-            image['capturedate.minutes'] = self._get(response, 'image.capturedate.minutes' + str(x))
-            image['capturedate.seconds'] = self._get(response, 'image.capturedate.seconds' + str(x))
-            image['description']         = self._get(response, 'image.extrafield.Description.' + str(x))
-            image['hidden']              = self._get(response, 'image.hidden.' + str(x))
-            images.append(image)
-        
-        return images
+        for record in self._do_request_records(request, 'image', {}):
+            yield self._record(record, IMAGE_FIELDS)
     
     def fetch_image(self, image, thumb=True):
          """
@@ -547,7 +815,6 @@ class Gallery:
  
          image_url = self.url + '?g2_view=core.DownloadItem&g2_itemId=%s' % str(image)
  
-         req = urllib2.Request(image_url)
-         response = self.opener.open( req )
+         info, data = self._open( image_url, headers={'User-agent' : USER_AGENT} )
  
-         return response.read()
+         return data
@@ -16,37 +16,131 @@
 #
 # Copyright (C) 2007 Julio Biason
 
+import os
 import mimetypes
 
+BLOCK_SIZE = 64 * 1024
+
+
+def _str(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class MultipartBody(object):
+    """
+    A multipart/form-data body that reads the file being sent in blocks as
+    it's sent, instead of holding it in memory. It behaves enough like a file
+    for urllib2/httplib to send it, and len() gives the Content-Length up
+    front.
+    """
+    def __init__(self, boundary, arguments, file_info, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.file = None
+        self.file_name = None
+        self.file_size = 0
+
+        parts = []
+        for key, value in arguments.iteritems():
+            parts.append('--%s' % boundary)
+            parts.append('Content-disposition: form-data; name="%s"' % key)
+            parts.append('')
+            parts.append(_str(value))
+
+        if file_info is not None:
+            content_type = mimetypes.guess_type(file_info[1])[0] or \
+                    'application/octet-stream'
+
+            parts.append('--%s' % (boundary))
+            parts.append('Content-disposition: form-data; ' + \
+                    'name="%s"; filename="%s"' %
+                    (file_info[0], _str(file_info[1])))
+            parts.append('Content-Type: %s' % content_type)
+            parts.append('')
+            parts.append('')
+
+            self.file_name = file_info[1]
+            self.file_size = os.path.getsize(file_info[1])
+            self.head = '\r\n'.join(parts)
+            self.tail = '\r\n--%s--' % boundary
+        else:
+            parts.append('--%s--' % boundary)
+            self.head = '\r\n'.join(parts)
+            self.tail = ''
+
+        self.length = len(self.head) + self.file_size + len(self.tail)
+        # 0 = head, 1 = file, 2 = tail, 3 = done
+        self.section = 0
+        self.offset = 0
+
+    def __len__(self):
+        return self.length
+
+    def _read_some(self, size):
+        if self.section == 0:
+            data = self.head[self.offset:self.offset + size]
+            self.offset += len(data)
+            if self.offset >= len(self.head):
+                self.section, self.offset = 1, 0
+                if self.file_name is not None:
+                    self.file = open(self.file_name, "rb")
+            return data
+
+        if self.section == 1:
+            data = ''
+            if self.file is not None:
+                data = self.file.read(size)
+            if not data:
+                self.close()
+                self.section, self.offset = 2, 0
+            return data
+
+        if self.section == 2:
+            data = self.tail[self.offset:self.offset + size]
+            self.offset += len(data)
+            if self.offset >= len(self.tail):
+                self.section = 3
+            return data
+
+        return ''
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length
+
+        chunks = []
+        wanted = size
+        while wanted > 0 and self.section < 3:
+            data = self._read_some(wanted)
+            chunks.append(data)
+            wanted -= len(data)
+        return ''.join(chunks)
+
+    def __iter__(self):
+        while True:
+            data = self.read(self.block_size)
+            if not data:
+                break
+            yield data
+
+    def reset(self):
+        """
+        Starts over from the beginning, for sending the body again
+        """
+        self.close()
+        self.section = 0
+        self.offset = 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
 def multipart(boundary, arguments, file_info):
     """
-    Generates the body of a multipart data.
+    Generates the body of a multipart data, as a MultipartBody which can be
+    read() a block at a time.
     """
-    parts = []
-    for key, value in arguments.iteritems():
-        parts.append('--%s' % boundary)
-        parts.append('Content-disposition: form-data; name="%s"' % key)
-        parts.append('')
-        parts.append(value)
-
-    if file_info is not None:
-        content_type = mimetypes.guess_type(file_info[1])[0] or \
-                'application/octet-stream'
-
-        parts.append('--%s' % (boundary))
-        parts.append('Content-disposition: form-data; ' + \
-                'name="%s"; filename="%s"' %
-                (file_info[0], file_info[1]))
-        parts.append('Content-Type: %s' % content_type)
-        parts.append('Content-Transfer-Encoding: base64')
-        parts.append('')
-
-        image = open(file_info[1], "rb")
-        contents = image.read()
-        image.close()
-
-        parts.append(contents)
-
-    parts.append('--%s--' % boundary)
-
-    return '\r\n'.join(parts)
+    return MultipartBody(boundary, arguments, file_info)
@@ -0,0 +1,148 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+# mcobj writes a quad for every visible block face, so a flat field or a wall
+# is thousands of faces where one would do. merge() takes the arrays from
+# objarrays.py and joins up side by side rectangles lying in the same plane,
+# facing the same way and of the same material: first into strips along one
+# axis of the plane, then the strips into rectangles along the other. Both
+# passes are a sort and a comparison of neighbours, so it's all done in NumPy.
+# Faces that aren't axis aligned rectangles are left as they are.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _rectangles(arrays):
+    """
+    Picks out the faces that are axis aligned rectangles. Returns which faces
+    they are and, for each, the axis it faces along, whether it faces the
+    positive (1) or negative (-1) way, where it sits on that axis, and its
+    extent (u0, u1, v0, v1) along the other two axes, in order.
+    """
+    v = arrays['vertices']
+    totals = arrays['loop_totals']
+    quads = numpy.flatnonzero(totals == 4)
+    corners = v[arrays['loops'][arrays['loop_starts'][quads][:, None] +
+                                numpy.arange(4)]]
+
+    lo = corners.min(axis=1)
+    hi = corners.max(axis=1)
+    flat = lo == hi
+    ok = flat.sum(axis=1) == 1
+    normal = flat.argmax(axis=1)
+    u = (normal + 1) % 3
+    w = (normal + 2) % 3
+
+    rows = numpy.arange(len(quads))
+    cu = corners[rows[:, None], numpy.arange(4), u[:, None]]
+    cw = corners[rows[:, None], numpy.arange(4), w[:, None]]
+    lo_u, hi_u = lo[rows, u], hi[rows, u]
+    lo_w, hi_w = lo[rows, w], hi[rows, w]
+
+    # Every corner is on the box, and going round the face each step moves
+    # along just one of the two axes, so it's not a bow tie
+    on_box = ((cu == lo_u[:, None]) | (cu == hi_u[:, None])) & \
+             ((cw == lo_w[:, None]) | (cw == hi_w[:, None]))
+    code = (cu == hi_u[:, None]) * 1 + (cw == hi_w[:, None]) * 2
+    step = code ^ numpy.roll(code, -1, axis=1)
+    ok &= on_box.all(axis=1) & ((step == 1) | (step == 2)).all(axis=1)
+
+    # Which way it faces comes from the winding, (u, w, normal) being right
+    # handed
+    du = corners[rows, 1] - corners[rows, 0]
+    dw = corners[rows, 2] - corners[rows, 1]
+    cross = du[rows, u] * dw[rows, w] - du[rows, w] * dw[rows, u]
+    sign = numpy.where(cross > 0, 1, -1)
+
+    keep = numpy.flatnonzero(ok)
+    return (quads[keep], normal[keep], sign[keep], lo[keep, normal[keep]],
+            lo_u[keep], hi_u[keep], lo_w[keep], hi_w[keep])
+
+
+def _runs(keys, start, end):
+    """
+    Groups the rows with the same keys into runs of rows that follow on from
+    each other (one's start is the previous one's end). Returns the first row
+    of each run, and where each run starts and ends.
+    """
+    order = numpy.lexsort([start] + keys[::-1])
+    if not len(order):
+        return order, start, end
+    start = start[order]
+    end = end[order]
+    new = numpy.zeros(len(order), dtype=bool)
+    new[0] = True
+    for key in keys:
+        key = key[order]
+        new[1:] |= key[1:] != key[:-1]
+    new[1:] |= start[1:] != end[:-1]
+
+    first = numpy.flatnonzero(new)
+    last = numpy.append(first[1:] - 1, len(order) - 1)
+    return order[first], start[first], end[last]
+
+
+def merge(arrays):
+    """
+    A copy of arrays (see objarrays.py) with the rectangles merged. The
+    bounds and center are those of the original mesh.
+    """
+    if not len(arrays['loop_starts']):
+        return dict(arrays)
+
+    faces, normal, sign, plane, u0, u1, w0, w1 = _rectangles(arrays)
+    material = arrays['face_materials'][faces]
+
+    # Strips along u...
+    first, u0, u1 = _runs([normal, sign, plane, material, w0, w1], u0, u1)
+    normal, sign, plane, material = (normal[first], sign[first], plane[first],
+                                     material[first])
+    w0, w1 = w0[first], w1[first]
+    # ...then strips of the same width along w
+    first, w0, w1 = _runs([normal, sign, plane, material, u0, u1], w0, w1)
+    normal, sign, plane, material = (normal[first], sign[first], plane[first],
+                                     material[first])
+    u0, u1 = u0[first], u1[first]
+
+    # Corners in the order that keeps each face facing the same way
+    count = len(normal)
+    rows = numpy.arange(count)[:, None]
+    corner_u = numpy.array([u0, u1, u1, u0]).T
+    corner_w = numpy.array([w0, w0, w1, w1]).T
+    backwards = sign < 0
+    corner_u[backwards] = corner_u[backwards][:, ::-1]
+    corner_w[backwards] = corner_w[backwards][:, ::-1]
+    corners = numpy.empty((count, 4, 3), dtype=numpy.float32)
+    corners[rows, numpy.arange(4), normal[:, None]] = plane[:, None]
+    corners[rows, numpy.arange(4), ((normal + 1) % 3)[:, None]] = corner_u
+    corners[rows, numpy.arange(4), ((normal + 2) % 3)[:, None]] = corner_w
+
+    # Everything else goes through untouched
+    others = numpy.ones(len(arrays['loop_starts']), dtype=bool)
+    others[faces] = False
+    totals = arrays['loop_totals'][others]
+    picked = numpy.repeat(arrays['loop_starts'][others], totals) + \
+             numpy.arange(totals.sum()) - \
+             numpy.repeat(numpy.cumsum(totals) - totals, totals)
+    other_corners = arrays['vertices'][arrays['loops'][picked]]
+
+    vertices, loops = numpy.unique(
+            numpy.concatenate([corners.reshape(-1, 3), other_corners]),
+            axis=0, return_inverse=True)
+
+    merged = dict(arrays)
+    all_totals = numpy.concatenate([numpy.full(count, 4, dtype=numpy.int32),
+                                    totals]).astype(numpy.int32)
+    merged.update({
+        'vertices': vertices.astype(numpy.float32),
+        'loops': loops.astype(numpy.int32),
+        'loop_starts': (numpy.cumsum(all_totals) - all_totals).astype(numpy.int32),
+        'loop_totals': all_totals,
+        'face_materials': numpy.concatenate(
+                [material, arrays['face_materials'][others]]).astype(numpy.int32),
+    })
+    return merged
@@ -0,0 +1,233 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+import os
+import time
+import errno
+import logging
+import sqlite3
+import threading
+
+# What a snapshot goes through, in order
+STAGES = ['copied', 'extracted', 'meshed', 'previewed', 'rendered', 'uploaded']
+
+# The stages that leave something in the scratch directory worth resuming from
+RESUMABLE = ('extracted', 'meshed', 'previewed')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    name     TEXT PRIMARY KEY,
+    stage    TEXT,
+    work_dir TEXT,
+    pid      INTEGER,
+    updated  REAL,
+    error    TEXT
+);
+CREATE TABLE IF NOT EXISTS stages (
+    name     TEXT,
+    stage    TEXT,
+    finished REAL,
+    seconds  REAL,
+    artifact TEXT,
+    PRIMARY KEY (name, stage)
+);
+"""
+
+
+def _alive_nt(pid):
+    # os.kill() on Windows terminates the process whatever the signal, so ask
+    # for its exit code instead
+    import ctypes
+    kernel32 = ctypes.windll.kernel32
+    PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+    STILL_ACTIVE = 259
+    ERROR_ACCESS_DENIED = 5
+
+    handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False,
+                                  pid)
+    if not handle:
+        return kernel32.GetLastError() == ERROR_ACCESS_DENIED
+    try:
+        code = ctypes.c_ulong()
+        if not kernel32.GetExitCodeProcess(handle, ctypes.byref(code)):
+            return False
+        return code.value == STILL_ACTIVE
+    finally:
+        kernel32.CloseHandle(handle)
+
+
+def alive(pid):
+    """
+    Whether there's a process with pid, without disturbing it
+    """
+    if os.name == 'nt':
+        try:
+            return _alive_nt(pid)
+        except (ImportError, AttributeError, OSError):
+            # Assume it's dead: the worst that does is resume a job twice
+            return False
+
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class JobDB(object):
+    """
+    Keeps track of how far every snapshot has got in a SQLite database: the
+    last stage it finished, which scratch directory it's being worked on in
+    and by which process, what each stage produced and how long it took, and
+    what went wrong if it failed.
+
+    A run that dies half way leaves its scratch directories behind. gc()
+    finds them afterwards, keeping the ones holding an extracted map or a
+    mesh so resume() can hand them back out instead of starting over.
+    """
+    def __init__(self, path):
+        self.logger = logging.getLogger('mcrender')
+        self.path = path
+        self.lock = threading.Lock()
+        # Pipeline stages run in their own threads, all sharing this
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def _execute(self, sql, args=()):
+        with self.lock:
+            cursor = self.db.execute(sql, args)
+            rows = cursor.fetchall()
+            self.db.commit()
+            return rows
+
+    def started(self, name, work_dir):
+        """
+        Notes that this process is starting on name afresh in work_dir
+        """
+        self._execute("INSERT OR IGNORE INTO jobs (name) VALUES (?)", (name,))
+        self._execute("UPDATE jobs SET stage = NULL, work_dir = ?, pid = ?, "
+                      "updated = ?, error = NULL WHERE name = ?",
+                      (work_dir, os.getpid(), time.time(), name))
+
+    def finished_stage(self, name, stage, seconds, artifact=None):
+        """
+        Notes that name got through stage in its current scratch directory,
+        taking seconds, and left artifact (a path, or the Gallery item name)
+        """
+        self._execute("INSERT OR IGNORE INTO jobs (name) VALUES (?)", (name,))
+        self._execute("INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)",
+                      (name, stage, time.time(), seconds, artifact))
+        self._execute("UPDATE jobs SET stage = ?, updated = ? WHERE name = ?",
+                      (stage, time.time(), name))
+
+    def failed(self, name, error):
+        self._execute("UPDATE jobs SET error = ?, updated = ? WHERE name = ?",
+                      (error, time.time(), name))
+
+    def done(self, name):
+        """
+        Notes that name's scratch directory is gone
+        """
+        self._execute("UPDATE jobs SET work_dir = NULL, pid = NULL, "
+                      "updated = ? WHERE name = ?", (time.time(), name))
+
+    def release(self, name):
+        """
+        Lets go of name's scratch directory without throwing it away, for
+        whoever carries on with it next (in this process or another) to
+        resume()
+        """
+        self._execute("UPDATE jobs SET pid = NULL, updated = ? WHERE name = ?",
+                      (time.time(), name))
+
+    def waiting(self):
+        """
+        How many scratch directories are being kept for someone to resume()
+        """
+        rows = self._execute("SELECT COUNT(*) FROM jobs WHERE work_dir IS NOT "
+                             "NULL AND pid IS NULL AND stage IN (%s)" %
+                             ", ".join("?" * len(RESUMABLE)), RESUMABLE)
+        return rows[0][0]
+
+    def stage(self, name):
+        """
+        The last stage name got through in its current (or last) scratch
+        directory, or None
+        """
+        rows = self._execute("SELECT stage FROM jobs WHERE name = ?", (name,))
+        return rows and rows[0][0] or None
+
+    def reached(self, name, stage):
+        current = self.stage(name)
+        return current is not None and \
+               STAGES.index(current) >= STAGES.index(stage)
+
+    def artifact(self, name, stage):
+        rows = self._execute("SELECT artifact FROM stages "
+                             "WHERE name = ? AND stage = ?", (name, stage))
+        return rows and rows[0][0] or None
+
+    def resume(self, name):
+        """
+        The scratch directory a dead run left name in, if it's worth carrying
+        on with, otherwise None. The directory is taken over by this process.
+        """
+        rows = self._execute("SELECT work_dir, pid, stage FROM jobs "
+                             "WHERE name = ?", (name,))
+        if not rows:
+            return None
+
+        work_dir, pid, stage = rows[0]
+        if work_dir is None or (pid and alive(pid)) or \
+                stage not in RESUMABLE or \
+                not os.path.isdir(work_dir):
+            return None
+
+        self._execute("UPDATE jobs SET pid = ?, updated = ?, error = NULL "
+                      "WHERE name = ?", (os.getpid(), time.time(), name))
+        return work_dir
+
+    def gc(self, scratch_dir):
+        """
+        Goes through the scratch directories of runs that are no longer
+        around. Returns the ones not worth resuming, which can be deleted;
+        their jobs are marked as done.
+        """
+        owned = {}
+        for name, work_dir, pid, stage in self._execute(
+                "SELECT name, work_dir, pid, stage FROM jobs "
+                "WHERE work_dir IS NOT NULL"):
+            owned[os.path.normpath(work_dir)] = (name, pid, stage)
+
+        garbage = []
+        for entry in os.listdir(scratch_dir):
+            path = os.path.normpath(os.path.join(scratch_dir, entry))
+            if path not in owned:
+                garbage.append(path)
+                continue
+
+            name, pid, stage = owned.pop(path)
+            if pid and pid != os.getpid() and alive(pid):
+                continue
+            if stage in RESUMABLE:
+                self.logger.info("Keeping %s to resume %s from, it was "
+                                 "already %s", path, name, stage)
+                self._execute("UPDATE jobs SET pid = NULL WHERE name = ?",
+                              (name,))
+                continue
+
+            garbage.append(path)
+            self.done(name)
+
+        # Directories that have gone missing
+        for path, (name, pid, stage) in owned.iteritems():
+            if not (pid and alive(pid)):
+                self.done(name)
+
+        return garbage
+
+    def close(self):
+        with self.lock:
+            self.db.close()
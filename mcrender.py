@@ -5,126 +5,924 @@
 # More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
 
 
-import subprocess
 import os
 import sys
 import shutil
 import tarfile
+import tempfile
+import json
 import logging
 import getpass
-import re
+import time
+import signal
+import multiprocessing
+import multiprocessing.pool
+import multiprocessing.queues
+import multiprocessing.util
+import threading
 from optparse import OptionParser, OptionGroup
 import ConfigParser
 
 from galleryremote import Gallery
 from galleryremote.gallery import GalleryException
+from pipeline import Pipeline
+from blenderpool import BlenderPool, BlenderException
+import regions
+from meshcache import MeshCache
+from artifacts import link_or_copy, replace
+from chunkindex import ChunkIndex
+from blobstore import BlobStore
+from albummanifest import AlbumManifest
+from jobdb import JobDB, RESUMABLE
+from discovery import Discovery
+import tiles
+import objarrays
+import greedymesh
+import metrics
+from stitch import stitch
+
+
+class RenderException(Exception):
+    """
+    Raised when a single snapshot can't be turned into an image. The batch
+    carries on with the next snapshot.
+    """
+
+
+def conf_get(config, section, option, default=None):
+    """
+    Like config.get(), but old config.ini files without the option still work
+    """
+    if config.has_option(section, option):
+        return config.get(section, option)
+    return default
+
+
+def conf_getboolean(config, section, option, default=False):
+    if config.has_option(section, option):
+        return config.getboolean(section, option)
+    return default
+
+
+def open_metrics(config, prometheus=True):
+    """
+    A metrics.Metrics writing wherever [metrics] in config says to. Only one
+    process should be writing the Prometheus file.
+    """
+    def path(option):
+        value = conf_get(config, 'metrics', option)
+        if not value:
+            return None
+        return os.path.join(os.getcwd(), value)
+
+    return metrics.Metrics(path('json'), prometheus and path('prometheus') or None)
+
+
+def setup_logging(debug):
+    logger = logging.getLogger('mcrender')
+    logger.propagate = False
+
+    if debug:
+        logging_level = logging.DEBUG
+    else:
+        logging_level = logging.INFO
+
+    # Pool workers forked from the main process already have a handler
+    if not logger.handlers:
+        console_handler = logging.StreamHandler()
+
+        formatter = logging.Formatter('%(asctime)s:%(levelname)8s:%(message)s')
+        console_handler.setFormatter(formatter)
+        logger.addHandler(console_handler)
+    logger.setLevel(logging_level)
+
+    return logger
+
+
+# What the mesh is called inside every scratch dir. mcobj names the .mtl in the
+# .obj after it, so a cached mesh can only be shared if the name never changes
+MESH = "mesh"
+
+
+class Snapshot(object):
+    """
+    Everything we know about one backup while it's being worked on. Each one
+    gets a private scratch directory so several can be worked on at once.
+    """
+    def __init__(self, name, work_dir, previous=None):
+        self.name = name
+        self.work_dir = work_dir
+        # The snapshot before this one in the timelapse
+        self.previous = previous
+        # Where the map ended up inside work_dir, once it's been extracted
+        self.world = None
+        # {region file: sha1} of what was extracted
+        self.regions = {}
+        # How many chunks there are to render, if we know
+        self.cost = None
+        # Whether nothing in the area changed since previous, once we've
+        # looked
+        self.unchanged = None
+        self.to_clean = []
+
+    def path(self, *parts):
+        return os.path.join(self.work_dir, *parts)
+
+    def __str__(self):
+        return self.name
 
 
 class MCRenderer(object):
-    def __init__(self, config, g, album_name):
+    def __init__(self, config, g, album_name, metrics=None):
         self.logger = logging.getLogger('mcrender')
         self.config = config
+        self.metrics = metrics or open_metrics(config)
         self.album_name = album_name
         self.g = g
-        self.to_clean = []
         self.cwd = os.getcwd()
         self.src_dir = config.get('directories', 'source')
         self.img_dir = os.path.join(self.cwd, config.get('directories', 'images'))
         self.obj_dir = os.path.join(self.cwd, config.get('directories', 'objects'))
         self.tgz_dir = os.path.join(self.cwd, config.get('directories', 'raw_backups'))
+        # Whether to keep a copy of each backup in tgz_dir, rather than read it
+        # straight out of src_dir
+        self.copy_backups = conf_getboolean(config, 'directories',
+                                            'copy_backups', False)
+        self.scratch_dir = os.path.join(self.cwd,
+                conf_get(config, 'directories', 'scratch', 'scratch'))
         self.archive_suffix = config.get('directories', 'backup_suffix')
+        # Blender runs inside each snapshot's scratch dir, so the script path
+        # has to survive the change of directory
         self.blender_opts = ["blender"] + \
                             config.get('blender', 'args').split() + \
-                            ["-P", config.get('blender', 'render_script')]
+                            ["-P", os.path.abspath(
+                                config.get('blender', 'render_script'))]
         self.mcobj_opts = ["mcobj"] + config.get('mcobj', 'args').split()
+        self.bounds = regions.mcobj_bounds(self.mcobj_opts[1:])
+        # The area mcobj meshes, without the chunks around it it peeks at
+        self.area = regions.mcobj_bounds(self.mcobj_opts[1:], margin=0)
+        self.tile_grid = int(conf_get(config, 'tiles', 'grid', 1))
+        self.tile_jobs = int(conf_get(config, 'tiles', 'jobs', 2))
+        # Fraction of the full size to preview at first, 0 for no previews
+        self.preview = float(conf_get(config, 'preview', 'scale', 0))
+        # How many previewed maps keep their scratch dir for the full render
+        self.preview_keep = int(conf_get(config, 'preview', 'keep', 4))
+        self.preview_dir = os.path.join(self.cwd,
+                conf_get(config, 'directories', 'previews', 'previews'))
+        # Whether to turn meshes into arrays Blender can load quicker
+        self.arrays = objarrays.numpy is not None and \
+                      conf_getboolean(config, 'mcobj', 'arrays', True)
+        # Whether to merge mcobj's faces into bigger ones, see greedymesh.py
+        self.simplify = conf_getboolean(config, 'mcobj', 'simplify', False)
+        if self.simplify and objarrays.numpy is None:
+            self.logger.warning("Simplifying meshes needs NumPy, leaving "
+                                "them as they are")
+            self.simplify = False
+        # Simplified meshes aren't what mcobj wrote, so they're cached apart
+        self.mesh_opts = self.mcobj_opts + (self.simplify and ["simplify"] or [])
+        self.meshes = MeshCache(self.obj_dir,
+                int(conf_get(config, 'mcobj', 'cache_mb', 0)) * 1024 * 1024)
+        self.album = None
+        if g is not None:
+            self.album = AlbumManifest(os.path.join(self.cwd,
+                    conf_get(config, 'gallery2', 'manifest', 'album.json')),
+                    g, album_name,
+                    int(conf_get(config, 'gallery2', 'manifest_ttl', 3600)))
+        self.skip_unchanged = conf_getboolean(config, 'blender',
+                                              'skip_unchanged', True)
+        self.store = None
+        if conf_get(config, 'directories', 'store'):
+            self.store = BlobStore(os.path.join(self.cwd,
+                    config.get('directories', 'store')))
+        self.chunks = None
+        if conf_getboolean(config, 'mcobj', 'chunk_index', True):
+            self.chunks = ChunkIndex(os.path.join(self.cwd,
+                    conf_get(config, 'directories', 'index', 'index')),
+                    self.bounds)
+        self.previous = {}
+
+        self.blender = None
+        if conf_getboolean(config, 'blender', 'server', True):
+            size = int(conf_get(config, 'pipeline', 'render', 1))
+            if self.tile_grid > 1:
+                size = max(size, self.tile_jobs)
+            self.blender = BlenderPool(self.blender_opts, size,
+                    int(conf_get(config, 'blender', 'max_frames', 50)),
+                    float(conf_get(config, 'blender', 'max_rss_mb', 0)),
+                    self.blender_exited)
 
-        for d in [self.img_dir, self.obj_dir, self.tgz_dir]:
+        if self.tile_grid > 1 and (self.area is None or self.blender is None):
+            self.logger.warning("Tiles need an mcobj area (-s or -rx/-rz) and "
+                                "blender server mode, rendering whole maps")
+            self.tile_grid = 1
+
+        if self.preview and self.blender is None:
+            self.logger.warning("Previews need blender server mode, "
+                                "not making any")
+            self.preview = 0
+
+        dirs = [self.img_dir, self.obj_dir, self.scratch_dir]
+        if self.copy_backups:
+            dirs.append(self.tgz_dir)
+        if self.preview:
+            dirs.append(self.preview_dir)
+        for d in dirs:
             if not os.path.exists(d):
                 os.mkdir(d)
 
-    def copy(self, tarball):
+        self.jobs = JobDB(os.path.join(self.cwd,
+                conf_get(config, 'directories', 'jobs', 'jobs.db')))
+
+    def finished(self, name, stage, seconds, artifact=None, **fields):
+        """
+        Notes that name got through stage, in the job database and the
+        metrics; fields go in the metrics too
+        """
+        self.jobs.finished_stage(name, stage, seconds, artifact)
+        self.metrics.stage(name, stage, seconds, **fields)
+
+    def run(self, snap, program, cmd, cwd):
+        """
+        Runs program, noting how long it took and what it used. Returns the
+        return code.
+        """
+        start = time.time()
+        rc, usage = metrics.run(cmd, cwd)
+        self.metrics.child(snap.name, program, time.time() - start, usage)
+        return rc
+
+    def render_frame(self, snap, obj, image, tile=None, preview=None):
+        start = time.time()
+        rss_mb = self.blender.render(obj, image, tile, preview)
+        self.frame_stats(snap, image, time.time() - start, rss_mb)
+
+    def frame_stats(self, snap, image, seconds, rss_mb=None):
+        """
+        Passes on what obj2png.py said about rendering image, in the
+        .stats.json it left next to it, to the metrics
+        """
+        try:
+            stats = json.load(open(os.path.splitext(image)[0] + ".stats.json"))
+        except (IOError, ValueError):
+            # Not everyone's render_script writes one
+            stats = {}
+        phases = stats.get('phases', {})
+        if phases:
+            self.logger.debug("Blender spent %s for %s", ", ".join(
+                    "%.1fs on %s" % (phases[p], p) for p in sorted(phases)),
+                    os.path.basename(image))
+        self.metrics.frame(snap.name, seconds, rss_mb, **stats)
+
+    def blender_exited(self, proc):
+        self.metrics.child(None, 'blender', time.time() - proc.started,
+                           proc.rusage)
+
+    def set_order(self, victims):
+        """
+        Tells us the order the snapshots go in the timelapse, so each one can
+        be compared to the one before
+        """
+        victims = sorted(victims)
+        self.previous = dict(zip(victims[1:], victims[:-1]))
+
+    def workspace(self, victim):
+        work_dir = self.jobs.resume(victim)
+        if work_dir is not None:
+            self.logger.info("Resuming %s in %s, it was already %s", victim,
+                             work_dir, self.jobs.stage(victim))
+            snap = Snapshot(victim, work_dir, self.previous.get(victim))
+            snap.world = self.jobs.artifact(victim, 'extracted')
+            snap.to_clean.append('extracted')
+            if not self.jobs.reached(victim, 'meshed'):
+                # Whatever mcobj was in the middle of writing
+                for ext in [".obj", ".mtl", ".npz"]:
+                    if os.path.exists(snap.path(MESH + ext)):
+                        os.remove(snap.path(MESH + ext))
+            return snap
+
+        work_dir = tempfile.mkdtemp(prefix=victim + "-", dir=self.scratch_dir)
+        self.jobs.started(victim, work_dir)
+        self.logger.debug("Working on %s in %s", victim, work_dir)
+        return Snapshot(victim, work_dir, self.previous.get(victim))
+
+    def gc(self):
+        """
+        Deletes the scratch directories left behind by runs that died, except
+        the ones holding a map or mesh we can carry on from
+        """
+        for work_dir in self.jobs.gc(self.scratch_dir):
+            self.logger.info("Removing orphaned %s", work_dir)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def have_image(self, snap):
+        return os.path.exists(os.path.join(self.img_dir, snap.name + ".png"))
+
+    def have_preview(self, snap):
+        return os.path.exists(os.path.join(self.preview_dir, snap.name + ".png"))
+
+    def archive(self, victim):
+        """
+        Where to read victim's backup from: our copy if we've made one,
+        otherwise straight from the source directory
+        """
+        tarball = victim + self.archive_suffix
+        if os.path.exists(os.path.join(self.tgz_dir, tarball)):
+            return os.path.join(self.tgz_dir, tarball)
+        return os.path.join(self.src_dir, tarball)
+
+    def copy(self, victim):
         if not os.path.exists(self.src_dir):
-            self.logger.critical("No %s to copy from!", self.src_dir)
-            sys.exit(1)
+            raise RenderException("No %s to copy from!" % self.src_dir)
 
+        tarball = victim + self.archive_suffix
         self.logger.info("Copying %s to %s", tarball, self.tgz_dir)
-        shutil.copy(os.path.join(self.src_dir, tarball), self.tgz_dir)
+        start = time.time()
+        # Copied under a temporary name first, so a copy cut short never
+        # passes for the real thing. Where the filesystem allows, the copy is
+        # just a link to the same blocks
+        fd, tmp = tempfile.mkstemp(dir=self.tgz_dir, suffix=".tmp")
+        os.close(fd)
+        os.remove(tmp)
+        try:
+            link_or_copy(os.path.join(self.src_dir, tarball), tmp)
+            replace(tmp, os.path.join(self.tgz_dir, tarball))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.finished(victim, 'copied', time.time() - start,
+                      os.path.join(self.tgz_dir, tarball),
+                      bytes=os.path.getsize(os.path.join(self.tgz_dir, tarball)))
 
-    def expand(self):
-        tarball = victim + self.archive_suffix
-        fqp_tarball = os.path.join(self.tgz_dir, tarball)
-        if not os.path.exists(fqp_tarball):
-            self.copy(tarball)
-
-        self.logger.debug("Expanding into " + self.cwd)
-        tf = tarfile.open(fqp_tarball)
-        tf.extractall()
-
-        self.to_clean = ['extracted']
-
-    def create_obj(self):
-        obj = os.path.join(self.obj_dir, self.victim + ".obj")
-        mtl = os.path.join(self.obj_dir, self.victim + ".mtl")
-        if os.path.exists(obj) and os.path.exists(mtl):
-            self.logger.debug("Found pre-computed object!")
-            shutil.move(obj, self.cwd)
-            shutil.move(mtl, self.cwd)
+    def expand(self, snap):
+        if 'extracted' in snap.to_clean:
+            return
+
+        if self.store is None and self.copy_backups and \
+                not os.path.exists(os.path.join(self.tgz_dir,
+                                                snap.name + self.archive_suffix)):
+            self.copy(snap.name)
+        # Read where it is, in the source directory unless we've copied it
+        archive = self.archive(snap.name)
+
+        self.logger.debug("Expanding into " + snap.work_dir)
+        start = time.time()
+        try:
+            if (self.store is None or not self.store.has(snap.name)) and \
+                    not os.path.exists(archive):
+                raise RenderException("No %s to read!" % archive)
+            if self.store is not None:
+                if not self.store.has(snap.name):
+                    self.logger.info("Adding %s to the store", snap)
+                    self.store.ingest(snap.name, archive)
+                snap.world, size, snap.regions, headers = \
+                        self.store.checkout(snap.name, snap.work_dir,
+                                            self.bounds)
+            else:
+                snap.world, size, snap.regions, headers = \
+                        regions.extract_world(archive, snap.work_dir,
+                                              self.bounds)
+        except ValueError as e:
+            raise RenderException(str(e))
+        self.logger.debug("Extracted %d bytes of %s", size, snap)
+
+        if self.chunks is not None:
+            # Indexed from the headers read on the way, so the archive is
+            # only read the once
+            try:
+                found = self.chunks.record(snap.name, headers)
+                snap.cost = sum(len(chunks) for chunks in found.values())
+                self.logger.info("%s has %d chunks to render", snap, snap.cost)
+            except (IOError, OSError):
+                self.logger.debug("Couldn't index %s", snap, exc_info=True)
+
+        self.meshes.remember(snap.name, regions.digest(snap.regions))
+        self.finished(snap.name, 'extracted', time.time() - start, snap.world,
+                      bytes=size)
+        snap.to_clean.append('extracted')
+
+    def fetch_map(self, snap):
+        key = self.meshes.lookup(snap.name, self.mesh_opts)
+        if self.have_image(snap) or self.reuse_image(snap) or \
+                self.meshes.has(key):
+            return
+
+        self.expand(snap)
+
+    def to_arrays(self, obj):
+        """
+        Simplifies the OBJ at obj in place if we're doing that, and saves it
+        as arrays too, see objarrays.py. Returns the vertex stats of the mesh
+        mcobj made (like tiles.obj_stats()) and {vertices, faces,
+        faces_before} of what's left for Blender, or None and {} if neither
+        is turned on or it didn't work out, in which case Blender will just
+        import the OBJ.
+        """
+        if not (self.arrays or self.simplify):
+            return None, {}
+
+        start = time.time()
+        try:
+            arrays = objarrays.read_obj(obj)
+            stats = objarrays.stats(arrays)
+            faces = len(arrays['loop_starts'])
+            if self.simplify:
+                arrays = greedymesh.merge(arrays)
+                objarrays.write_obj(arrays, obj)
+                self.logger.info("Simplified %s from %d faces to %d", obj,
+                                 faces, len(arrays['loop_starts']))
+            if self.arrays:
+                objarrays.save(arrays, obj)
+        except (ValueError, IndexError, IOError, OSError) as e:
+            self.logger.warning("Couldn't turn %s into arrays: %s", obj, e)
+            return None, {}
+        self.logger.debug("Turned %s into %d vertices and %d faces in %.1fs",
+                          obj, len(arrays['vertices']),
+                          len(arrays['loop_starts']), time.time() - start)
+        return stats, {'vertices': len(arrays['vertices']),
+                       'faces': len(arrays['loop_starts']),
+                       'faces_before': faces}
+
+    def meshed(self, snap):
+        if self.tile_grid > 1:
+            return os.path.exists(snap.path("tiles.json"))
+        return os.path.exists(snap.path(MESH + ".obj"))
+
+    def create_tiles(self, snap):
+        """
+        Meshes each tile of the area in its own directory, several at once,
+        and works out the camera that fits them all. What there is to render
+        is listed in tiles.json.
+        """
+        self.expand(snap)
+        if self.reuse_image(snap):
+            return
+
+        start = time.time()
+        world = snap.path(snap.world)
+
+        def mesh(tile):
+            (i, j), bounds = tile
+            tile_dir = snap.path("tile-%d-%d" % (i, j))
+            if not tiles.tile_world(world, os.path.join(tile_dir, "world"),
+                                    bounds, self.area):
+                # Nothing's been generated there yet
+                return tile_dir, (0, None, None, None), {}
+            self.logger.debug("Converting tile %d,%d of %s into 3D object",
+                              i, j, snap)
+            rc = self.run(snap, 'mcobj',
+                          self.mcobj_opts + ["-o", MESH + ".obj", "world"],
+                          tile_dir)
+            if rc:
+                raise RenderException("mcobj exited with rc = %d on tile "
+                                      "%d,%d" % (rc, i, j))
+            obj = os.path.join(tile_dir, MESH + ".obj")
+            stats, counts = self.to_arrays(obj)
+            return tile_dir, stats or tiles.obj_stats(obj), counts
+
+        workers = multiprocessing.pool.ThreadPool(self.tile_jobs)
+        try:
+            results = workers.map(mesh, tiles.split(self.area, self.tile_grid))
+        finally:
+            workers.close()
+        meshed = [(tile_dir, stats) for tile_dir, stats, counts in results
+                      if stats[0]]
+        totals = {}
+        for tile_dir, stats, counts in results:
+            for k, v in counts.items():
+                totals[k] = totals.get(k, 0) + v
+        if not meshed:
+            raise RenderException("No tile of %s has anything in it" % snap)
+
+        camera = tiles.camera([stats for tile_dir, stats in meshed])
+        spec = []
+        for tile_dir, (count, sums, lo, hi) in meshed:
+            tile = dict(camera, bounds=[lo, hi])
+            spec.append([tile_dir, tile])
+
+        out = open(snap.path("tiles.json.tmp"), "w")
+        json.dump(spec, out)
+        out.close()
+        replace(snap.path("tiles.json.tmp"), snap.path("tiles.json"))
+
+        # The tiles are only in the scratch directory, which doesn't outlast
+        # the job, so there's nothing to point at
+        self.finished(snap.name, 'meshed', time.time() - start,
+                      tiles=len(spec), **totals)
+
+    def render_tiles(self, snap, out_file, preview=None):
+        """
+        Renders every tile listed in tiles.json, several at once, and stitches
+        them into out_file
+        """
+        spec = json.load(open(snap.path("tiles.json")))
+        name = os.path.splitext(os.path.basename(out_file))[0]
+
+        def render(tile):
+            tile_dir, camera = tile
+            image = os.path.join(tile_dir, name + ".tga")
+            self.render_frame(snap, os.path.join(tile_dir, MESH + ".obj"),
+                              image, camera, preview)
+            return image, os.path.join(tile_dir, name + ".json")
+
+        workers = multiprocessing.pool.ThreadPool(self.tile_jobs)
+        try:
+            rendered = workers.map(render, spec)
+        finally:
+            workers.close()
+
+        self.logger.debug("Stitching %d tiles of %s", len(rendered), snap)
+        stitch(rendered, out_file)
+
+    def create_obj(self, snap):
+        if self.have_image(snap) or self.meshed(snap):
+            return
+
+        if self.tile_grid > 1:
+            return self.create_tiles(snap)
+
+        key = self.meshes.lookup(snap.name, self.mesh_opts)
+        if not self.meshes.has(key):
+            self.expand(snap)
+            key = self.meshes.lookup(snap.name, self.mesh_opts)
+
+        if self.reuse_image(snap):
+            return
+
+        start = time.time()
+        counts = {}
+        if self.meshes.fetch(key, snap.path(MESH)):
+            self.logger.debug("Found pre-computed object for %s!", snap)
+            if not os.path.exists(snap.path(MESH + ".npz")):
+                # Cached before there were arrays
+                stats, counts = self.to_arrays(snap.path(MESH + ".obj"))
         else:
-            if not os.path.exists(os.path.join(self.cwd, self.victim)):
-                self.expand()
+            self.expand(snap)
+
+            self.logger.debug("Converting %s into 3D object", snap)
+            rc = self.run(snap, 'mcobj',
+                          self.mcobj_opts + ["-o", MESH + ".obj", snap.world],
+                          snap.work_dir)
+            if rc:
+                raise RenderException("mcobj exited with rc = %d" % rc)
+
+            stats, counts = self.to_arrays(snap.path(MESH + ".obj"))
+            self.meshes.store(key, snap.path(MESH))
+
+        self.finished(snap.name, 'meshed', time.time() - start,
+                      self.meshes.path(key), **counts)
+
+    def unchanged(self, snap):
+        """
+        Whether anything in the area we render changed since the previous
+        snapshot. Either both have been meshed and got the same key, or the
+        chunk index says no chunk in the area was saved in between.
+        """
+        if snap.unchanged is None:
+            snap.unchanged = self._unchanged(snap)
+        return snap.unchanged
+
+    def _unchanged(self, snap):
+        key = self.meshes.lookup(snap.name, self.mesh_opts)
+        if key is not None and \
+                key == self.meshes.lookup(snap.previous, self.mesh_opts):
+            return True
+
+        if self.chunks is None:
+            return False
+
+        if not self.chunks.indexed(snap.name) and not self.meshes.has(key):
+            # Without a mesh to reuse it'll be extracted if anything changed,
+            # and that indexes it too: cheaper than going through the archive
+            # once to index it and again to extract it
+            self.expand(snap)
+
+        try:
+            changes = self.chunks.changes(snap.previous,
+                                          self.archive(snap.previous),
+                                          snap.name, self.archive(snap.name))
+        except (IOError, OSError, tarfile.TarError):
+            self.logger.debug("Couldn't compare %s to %s", snap,
+                              snap.previous, exc_info=True)
+            return False
+
+        self.logger.debug("%d chunks changed between %s and %s",
+                          len(changes), snap.previous, snap)
+        return not changes
+
+    def reuse_image(self, snap):
+        """
+        If nothing changed since the previous snapshot, its image is used for
+        this frame too and each reused frame is noted in unchanged.txt in the
+        images directory. Returns False if there were changes, or if there's
+        no image to reuse (yet).
+        """
+        same_as = snap.previous
+        if not self.skip_unchanged or same_as is None:
+            return False
+
+        src = os.path.join(self.img_dir, same_as + ".png")
+        if not os.path.exists(src) or not self.unchanged(snap):
+            return False
+
+        self.logger.info("No changes between %s and %s, reusing its image",
+                         same_as, snap)
+        final_file = os.path.join(self.img_dir, snap.name + ".png")
+        # Linked in under a name upload_backlog() won't pick up, then renamed
+        # into place
+        fd, tmp = tempfile.mkstemp(dir=self.img_dir, suffix=".tmp")
+        os.close(fd)
+        os.remove(tmp)
+        try:
+            link_or_copy(src, tmp)
+            replace(tmp, final_file)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        manifest = open(os.path.join(self.img_dir, "unchanged.txt"), "a")
+        manifest.write("%s %s\n" % (snap.name, same_as))
+        manifest.close()
+        self.finished(snap.name, 'rendered', 0, final_file, reused=same_as)
+        return True
+
+    def render_image(self, snap):
+        if self.have_image(snap) or self.reuse_image(snap):
+            return
 
-            self.logger.debug("Converting map into 3D object")
-            rc = subprocess.call(self.mcobj_opts + ["-o", self.obj_file,
-                                                    self.victim])
+        if not self.meshed(snap):
+            self.create_obj(snap)
+            if self.have_image(snap):
+                return
+
+        self.logger.info("Converting %s into PNG", snap)
+        start = time.time()
+        if self.tile_grid > 1:
+            self.render_tiles(snap, snap.path(MESH + ".png"))
+        elif self.blender is not None:
+            self.render_frame(snap, snap.path(MESH + ".obj"),
+                              snap.path(MESH + ".png"))
+        else:
+            rc = self.run(snap, 'blender',
+                          self.blender_opts + [snap.path(MESH + ".obj")],
+                          snap.work_dir)
             if rc:
-                self.logger.critical("mcobj exited with rc = " + rc)
-                sys.exit(rc)
-
-        self.to_clean.append('obj_files')
-
-    def render_image(self):
-        self.obj_file = self.victim + ".obj"
-        self.fqpn_obj_file = os.path.join(self.obj_dir, self.obj_file)
-        if not os.path.exists(os.path.join(self.cwd, self.obj_file)):
-            self.create_obj()
-
-        self.logger.info("Converting 3D object into PNG")
-        rc = subprocess.call(self.blender_opts + [self.obj_file])
-        if rc:
-            self.logger.critical("blender exited with rc = " + rc)
-            sys.exit(rc)
+                raise RenderException("blender exited with rc = %d" % rc)
+            self.frame_stats(snap, snap.path(MESH + ".png"), time.time() - start)
+
+        final_file = os.path.join(self.img_dir, snap.name + ".png")
+        shutil.move(snap.path(MESH + ".png"), final_file)
+        self.finished(snap.name, 'rendered', time.time() - start, final_file,
+                      bytes=os.path.getsize(final_file))
+
+    def preview_image(self, snap):
+        """
+        Renders a quick draft of snap into the previews directory: smaller,
+        and without ambient occlusion, but framed just like the full render.
+        Blender renders previews before any full renders that are waiting.
+        """
+        if not self.preview or self.have_preview(snap) or \
+                self.have_image(snap) or self.reuse_image(snap):
+            return
+
+        if not self.meshed(snap):
+            self.create_obj(snap)
+            if self.have_image(snap):
+                return
+
+        self.logger.info("Previewing %s", snap)
+        start = time.time()
+        draft = snap.path(MESH + "-preview.png")
+        if self.tile_grid > 1:
+            self.render_tiles(snap, draft, self.preview)
         else:
-            shutil.move(self.victim + ".png", self.img_dir)
+            self.render_frame(snap, snap.path(MESH + ".obj"), draft,
+                              preview=self.preview)
 
-    def upload_image(self):
-        self.to_clean = []
-        current_images = [img['title'] for img in
-                              self.g.fetch_album_images(self.album_name)]
+        final_file = os.path.join(self.preview_dir, snap.name + ".png")
+        shutil.move(draft, final_file)
+        self.finished(snap.name, 'previewed', time.time() - start, final_file,
+                      bytes=os.path.getsize(final_file))
 
-        img_file = self.victim + ".png"
-        if img_file in current_images:
+    def try_preview(self, snap):
+        """
+        preview_image(), but a preview that fails doesn't stop the full render
+        from being tried
+        """
+        try:
+            self.preview_image(snap)
+        except (RenderException, BlenderException):
+            self.logger.warning("Couldn't preview %s", snap, exc_info=True)
+
+    def upload_image(self, snap):
+        img_file = snap.name + ".png"
+        if img_file in self.album:
             self.logger.info("%s already in Gallery!", img_file)
-            self.cleanup()
             return
 
         final_file = os.path.join(self.img_dir, img_file)
-        if not os.path.exists(final_file):
-            self.render_image()
+        self.render_image(snap)
+
+        self.logger.debug("Uploading %s", img_file)
+        start = time.time()
+        item = self.g.add_item(self.album_name, final_file, snap.name, snap.name)
+        self.album.add(img_file, item)
+        self.finished(snap.name, 'uploaded', time.time() - start, item,
+                      bytes=os.path.getsize(final_file))
 
-        self.logger.debug("Uploading")
-        self.g.add_item(album_name, final_file, self.victim, self.victim)
+    def upload_backlog(self):
+        """
+        Uploads every image in img_dir that isn't in Gallery yet, several at
+        a time. Returns {map name: error} for the ones that didn't make it.
+        """
+        backlog = sorted(f for f in os.listdir(self.img_dir)
+                             if f.endswith(".png") and f not in self.album)
+        if not backlog:
+            return {}
 
-        self.cleanup()
+        self.logger.info("Uploading %d finished images", len(backlog))
+        max_mb = int(conf_get(self.config, 'gallery2', 'upload_max_mb', 0))
+        report = self.g.add_items(self.album_name,
+                [(os.path.join(self.img_dir, f), f[:-4], f[:-4]) for f in backlog],
+                concurrency=int(conf_get(self.config, 'gallery2', 'uploads', 2)),
+                retries=int(conf_get(self.config, 'gallery2', 'upload_retries', 3)),
+                max_bytes=max_mb * 1024 * 1024 or None)
 
-    def cleanup(self):
-        if 'extracted' in self.to_clean:
+        failures = {}
+        for img_file, result in zip(backlog, report):
+            if result['error'] is None:
+                self.logger.debug("Uploaded %s in %.1fs (%d attempts)", img_file,
+                                  result['seconds'], result['attempts'])
+                self.album.add(img_file, result['item'])
+                self.finished(img_file[:-4], 'uploaded', result['seconds'],
+                              result['item'], bytes=result['bytes'],
+                              attempts=result['attempts'])
+            else:
+                failures[img_file[:-4]] = result['error']
+                self.jobs.failed(img_file[:-4], result['error'])
+        return failures
+
+    def process(self, victim, upload=True, preview=False, last=True):
+        """
+        Takes victim all the way through to Gallery, or to the images
+        directory without upload, or just to the previews directory with
+        preview. last is whether that's the end of it, or something else
+        (say, the upload) is still to be done with it after this; a failure
+        is the end of it, unless it's only the preview
+        """
+        snap = self.workspace(victim)
+        try:
+            if preview:
+                self.try_preview(snap)
+            elif upload:
+                self.upload_image(snap)
+            else:
+                self.render_image(snap)
+        except Exception as e:
+            self.jobs.failed(victim, str(e) or e.__class__.__name__)
+            self.cleanup(snap, str(e) or e.__class__.__name__,
+                         finished=not preview)
+            raise
+        # Anything else (say, Ctrl-C) leaves the scratch dir to resume from
+        if preview and self.jobs.stage(victim) in RESUMABLE and \
+                self.jobs.waiting() < self.preview_keep:
+            # The full render carries on from the same map and mesh
+            self.jobs.release(victim)
+            return
+        # Past that, the full render starts afresh, from the mesh cache
+        self.cleanup(snap, finished=last)
+
+    def pipeline(self, upload=True, on_done=None):
+        """
+        Builds a Pipeline that overlaps the stages of consecutive maps. How many
+        of each stage run at once, and how many maps may wait in front of each
+        stage, come from the [pipeline] section of the config.
+        """
+        def workers(stage):
+            return int(conf_get(self.config, 'pipeline', stage, 1))
+
+        depth = int(conf_get(self.config, 'pipeline', 'queue_depth', 1))
+
+        p = Pipeline(on_done)
+        p.add_stage('extract', self.fetch_map, workers('extract'), depth)
+        p.add_stage('mesh', self.create_obj, workers('mesh'), depth)
+        if self.preview:
+            p.add_stage('preview', self.try_preview, workers('preview'), depth)
+        p.add_stage('render', self.render_image, workers('render'), depth)
+        if upload:
+            p.add_stage('upload', self.upload_image, workers('upload'), depth)
+
+        return p
+
+    def cleanup(self, snap, error=None, finished=True):
+        """
+        Throws snap's scratch directory away. Unless finished, there's more
+        to do with snap after this, so it's not counted as done yet.
+        """
+        if 'extracted' in snap.to_clean:
             self.logger.debug("Cleaning up expanded map")
-            shutil.rmtree(os.path.join(self.cwd, victim))
 
-        if 'obj_files' in self.to_clean:
-            self.logger.debug("Cleaning up OBJ/MTL files")
-            shutil.move(victim + ".obj", self.obj_dir)
-            shutil.move(victim + ".mtl", self.obj_dir)
+        shutil.rmtree(snap.work_dir, ignore_errors=True)
+        self.jobs.done(snap.name)
+        if finished:
+            self.metrics.done(snap.name, error)
+
+    def close(self):
+        if self.blender is not None:
+            self.blender.close()
+        self.jobs.close()
+        self.metrics.close()
+
+
+# Each pool worker gets its own renderer; only the main process talks to Gallery
+_worker = None
+
+_uploading = False
+
+def _init_worker(config, debug, order, uploading=False, leftovers=None):
+    global _worker, _uploading
+    setup_logging(debug)
+    # The main process writes the Prometheus file
+    _worker = MCRenderer(config, None, None, open_metrics(config, False))
+    _worker.set_order(order)
+    # Whether the main process uploads what we render, and so finishes it
+    _uploading = uploading
+    # Blender is only reaped, and its CPU time and memory only counted, once
+    # the renderer is closed, as the worker exits
+    multiprocessing.util.Finalize(_worker, _close_worker, (leftovers,),
+                                  exitpriority=10)
+
+def _close_worker(leftovers):
+    _worker.close()
+    if leftovers is not None:
+        # For the main process to merge() after join()ing the pool
+        leftovers.put(_worker.metrics.take())
+
+def _render_worker(victim):
+    try:
+        _worker.process(victim, upload=False, last=not _uploading)
+    except Exception as e:
+        _worker.logger.exception("Rendering %s failed", victim)
+        return victim, str(e) or e.__class__.__name__, _worker.metrics.take()
+    return victim, None, _worker.metrics.take()
+
+def _preview_worker(victim):
+    try:
+        _worker.process(victim, upload=False, preview=True, last=False)
+    except Exception as e:
+        _worker.logger.exception("Previewing %s failed", victim)
+        return victim, str(e) or e.__class__.__name__, _worker.metrics.take()
+    return victim, None, _worker.metrics.take()
+
+def watch(renderer, discovery, backlog, interval, upload=True, on_done=None):
+    """
+    Puts backlog through the pipeline, then keeps looking for new backups
+    every interval seconds and putting them through too, until we get a
+    SIGTERM or SIGINT. Whatever's already in the pipeline is finished off
+    before returning the names of all the backups that were started on.
+    """
+    logger = logging.getLogger('mcrender')
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        logger.info("Got signal %d, finishing what's in progress", signum)
+        stopping.set()
+
+    handlers = dict((sig, signal.signal(sig, stop))
+                    for sig in [signal.SIGTERM, signal.SIGINT])
+
+    pipeline = renderer.pipeline(upload, on_done)
+    pipeline.start()
+    started = []
+    try:
+        todo = list(backlog)
+        while not stopping.is_set():
+            for victim in todo:
+                if stopping.is_set():
+                    break
+                logger.info("Starting on " + victim)
+                snap = renderer.workspace(victim)
+                # An untimed put() can't be interrupted by signals on Python 2
+                while not pipeline.put(snap, timeout=0.5):
+                    if stopping.is_set():
+                        # Left for the next run to resume or clear away
+                        renderer.jobs.release(victim)
+                        break
+                else:
+                    started.append(victim)
+
+            stopping.wait(interval)
+            if stopping.is_set():
+                break
+
+            todo = discovery.scan()
+            if todo:
+                renderer.set_order(discovery.names())
+    finally:
+        pipeline.close()
+        for sig, handler in handlers.iteritems():
+            signal.signal(sig, handler)
+
+    return started
 
 # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
 # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
@@ -141,74 +939,177 @@ if __name__ == "__main__":
     parser.add_option("-r", "--render_only", dest="render_only",
             default=False, action="store_true",
             help="If you just want to render, and not upload, use this flag.")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+            default=1,
+            help="How many maps to render at once [default: %default]")
+    parser.add_option("-p", "--pipeline", dest="pipeline",
+            default=False, action="store_true",
+            help="Overlap extracting, meshing, rendering and uploading of "
+                 "consecutive maps; see [pipeline] in the config.")
+    parser.add_option("-w", "--watch", dest="watch",
+            default=False, action="store_true",
+            help="Keep running, putting new backups through the pipeline as "
+                 "they show up; see [watch] in the config. Stop with SIGTERM "
+                 "or Ctrl-C.")
 
     (opts, args) = parser.parse_args()
 
+    if opts.watch and (args or opts.jobs > 1):
+        parser.error("--watch works out what to do itself, and always uses "
+                     "the pipeline")
+
     if not os.path.exists(opts.conf_file):
         parser.error("Config file (%s) doesn't exist!" % opts.conf_file)
 
     conf = ConfigParser.ConfigParser()
     conf.read(opts.conf_file)
 
-    logger = logging.getLogger('mcrender')
-    logger.propagate = False
-
-    if opts.debug:
-        logging_level = logging.DEBUG
-    else:
-        logging_level = logging.INFO
-
-    console_handler = logging.StreamHandler()
-
-    formatter = logging.Formatter('%(asctime)s:%(levelname)8s:%(message)s')
-    console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
-    logger.setLevel(logging_level)
+    logger = setup_logging(opts.debug)
 
+    stats = open_metrics(conf)
+    g = None
+    album_name = None
     if conf.getboolean('gallery2', 'enabled'):
         logger.debug("Logging into gallery")
-        g = Gallery(conf.get('gallery2', 'url'))
+        g = Gallery(conf.get('gallery2', 'url'),
+                    connections=int(conf_get(conf, 'gallery2', 'uploads', 2)),
+                    on_request=stats.request)
         g.login(conf.get('gallery2', 'user'),
                 conf.get('gallery2', 'password'))
 
-    logger.debug("Finding our album")
-    albums = g.fetch_albums_prune()
-    our_album = conf.get('gallery2', 'albumname').lower()
-    candidate_albums = [k for k,v in albums.iteritems()
-                            if v['title'].lower() == our_album]
+        logger.debug("Finding our album")
+        albums = g.fetch_albums_prune()
+        our_album = conf.get('gallery2', 'albumname').lower()
+        candidate_albums = [k for k,v in albums.iteritems()
+                                if v['title'].lower() == our_album]
 
-    if not candidate_albums:
-        logger.critical("Couldn't find a %s album!", our_album)
-        sys.exit(1)
+        if not candidate_albums:
+            logger.critical("Couldn't find a %s album!", our_album)
+            sys.exit(1)
+
+        album_name = candidate_albums[0]
+    elif not opts.render_only:
+        logger.info("Gallery is disabled, only rendering")
+        opts.render_only = True
 
-    album_name = candidate_albums[0]
+    renderer = MCRenderer(conf, g, album_name, stats)
+    renderer.gc()
+    failures = {}
+
+    if not opts.render_only:
+        # Images rendered by an earlier --render_only run, or whose upload
+        # failed, go up before anything new is started
+        failures = renderer.upload_backlog()
 
     if args:
-        to_work = args
+        to_work = [a for a in args if a not in failures]
+        order = args
     else:
-        file_re = re.compile(conf.get('directories', 'backup_regex'))
-        candidates = set(f.split(".")[0] for f in
-                             os.listdir(conf.get('directories', 'source'))
-                                if re.match(file_re, f))
-        logger.debug("Found %d candidates", len(candidates))
-        finished = set(img['title'].replace('.png', '') for img in
-                           g.fetch_album_images(album_name))
+        discovery = Discovery(os.path.join(os.getcwd(),
+                conf_get(conf, 'directories', 'discovery', 'discovery.json')),
+                conf.get('directories', 'source'),
+                conf.get('directories', 'backup_regex'),
+                int(conf_get(conf, 'directories', 'backup_settle', 0)))
+        arrived = discovery.scan()
+        candidates = discovery.names()
+        logger.debug("Found %d candidates, %d of them new", len(candidates),
+                     len(arrived))
+        finished = set()
+        if renderer.album is not None:
+            finished = set(title.replace('.png', '') for title in
+                               renderer.album.titles())
         logger.debug("Found %d finished images", len(finished))
-        to_work = sorted(list(candidates - finished))
+        to_work = sorted(list(candidates - finished - set(failures)))
+        order = candidates
 
-    if len(to_work) == 0:
+    if len(to_work) == 0 and not failures and not opts.watch:
         logger.info("All caught up, nothing to do!")
+        renderer.close()
         sys.exit(0)
 
     logger.info("Have %d maps to work on: %s", len(to_work), ", ".join(to_work))
 
-    renderer = MCRenderer(conf, g, album_name)
-    if opts.render_only:
-        method = renderer.render_image
+    renderer.set_order(order)
+
+    if opts.jobs > 1:
+        # Renders happen in the pool, uploads stay here as results come back
+        leftovers = multiprocessing.queues.SimpleQueue()
+        pool = multiprocessing.Pool(opts.jobs, _init_worker,
+                                    (conf, opts.debug, order,
+                                     not opts.render_only, leftovers))
+        if renderer.preview:
+            # Every map is previewed before any full render is started
+            for victim, error, totals in pool.imap_unordered(_preview_worker,
+                                                             to_work):
+                stats.merge(totals)
+                if error is None:
+                    logger.info("Finished previewing " + victim)
+        for victim, error, totals in pool.imap_unordered(_render_worker, to_work):
+            stats.merge(totals)
+            if error is not None:
+                failures[victim] = error
+                continue
+
+            logger.info("Finished rendering " + victim)
+            if not opts.render_only:
+                try:
+                    renderer.process(victim)
+                except Exception as e:
+                    logger.exception("Uploading %s failed", victim)
+                    failures[victim] = str(e) or e.__class__.__name__
+        pool.close()
+        pool.join()
+        while not leftovers.empty():
+            stats.merge(leftovers.get())
+    elif opts.pipeline or opts.watch:
+        lock = threading.Lock()
+
+        def finished_map(snap, stage, error):
+            if error is None:
+                logger.info("Finished with " + snap.name)
+            else:
+                with lock:
+                    failures[snap.name] = "%s: %s" % (stage, str(error) or
+                                                      error.__class__.__name__)
+                renderer.jobs.failed(snap.name, failures[snap.name])
+                if opts.watch:
+                    logger.error("%s failed: %s", snap, failures[snap.name])
+            renderer.cleanup(snap, failures.get(snap.name))
+
+        if opts.watch:
+            to_work = watch(renderer, discovery, to_work,
+                            float(conf_get(conf, 'watch', 'interval', 60)),
+                            not opts.render_only, finished_map)
+        else:
+            pipeline = renderer.pipeline(not opts.render_only, finished_map)
+            pipeline.start()
+            for victim in to_work:
+                pipeline.put(renderer.workspace(victim))
+            pipeline.close()
     else:
-        method = renderer.upload_image
+        if renderer.preview:
+            for victim in to_work:
+                try:
+                    renderer.process(victim, upload=False, preview=True,
+                                     last=False)
+                except Exception:
+                    logger.exception("Previewing %s failed", victim)
+        for victim in to_work:
+            logger.info("Starting on " + victim)
+            try:
+                renderer.process(victim, upload=not opts.render_only)
+            except Exception as e:
+                logger.exception("Working on %s failed", victim)
+                failures[victim] = str(e) or e.__class__.__name__
+
+    renderer.close()
+    if g is not None:
+        g.close()
 
-    for victim in to_work:
-        logger.info("Starting on " + victim)
-        renderer.victim = victim
-        method()
+    total = len(set(to_work) | set(failures))
+    logger.info("Done with %d of %d maps", total - len(failures), total)
+    for victim in sorted(failures):
+        logger.error("%s failed: %s", victim, failures[victim])
+
+    if failures:
+        sys.exit(1)
@@ -0,0 +1,138 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+import os
+import hashlib
+import logging
+import tempfile
+
+from artifacts import link_or_copy, replace
+
+EXTENSIONS = [".obj", ".mtl"]
+# Kept alongside when there is one, see objarrays.py
+OPTIONAL = [".npz"]
+
+
+class MeshCache(object):
+    """
+    Keeps mcobj's output around, filed under a digest of what went into it:
+    the region files it read and the arguments it was run with. Snapshots
+    where nothing changed get the same key and share one copy of the mesh.
+
+    Every use of a mesh touches it, and once the cache grows past max_bytes
+    (zero means no limit) the least recently used meshes are thrown out.
+    The region digest of every snapshot seen is remembered in names/, so a
+    snapshot that's been meshed before doesn't need extracting to find it.
+    """
+    def __init__(self, cache_dir, max_bytes=0):
+        self.logger = logging.getLogger('mcrender')
+        self.cache_dir = cache_dir
+        self.names_dir = os.path.join(cache_dir, "names")
+        self.max_bytes = max_bytes
+
+        if not os.path.exists(self.names_dir):
+            os.makedirs(self.names_dir)
+
+    def key(self, region_digest, opts):
+        h = hashlib.sha1(region_digest)
+        for opt in opts:
+            h.update("\0" + opt)
+        return h.hexdigest()
+
+    def _path(self, key, ext):
+        return os.path.join(self.cache_dir, key + ext)
+
+    def path(self, key):
+        """
+        Where the OBJ of the mesh filed under key is kept
+        """
+        return self._path(key, ".obj")
+
+    def lookup(self, name, opts):
+        """
+        The key the snapshot called name would be meshed under with opts, if
+        we've seen it before
+        """
+        try:
+            region_digest = open(os.path.join(self.names_dir, name)).read().strip()
+        except IOError:
+            return None
+        return self.key(region_digest, opts)
+
+    def remember(self, name, region_digest):
+        fd, tmp = tempfile.mkstemp(dir=self.names_dir)
+        os.write(fd, region_digest + "\n")
+        os.close(fd)
+        replace(tmp, os.path.join(self.names_dir, name))
+
+    def has(self, key):
+        return key is not None and \
+               all(os.path.exists(self._path(key, ext)) for ext in EXTENSIONS)
+
+    def fetch(self, key, dest):
+        """
+        Links the cached mesh into dest + ".obj"/".mtl" (and ".npz", if it
+        has one). Returns False if there's no such mesh (any more).
+        """
+        if not self.has(key):
+            return False
+
+        try:
+            for ext in EXTENSIONS:
+                os.utime(self._path(key, ext), None)
+                link_or_copy(self._path(key, ext), dest + ext)
+            for ext in OPTIONAL:
+                if os.path.exists(self._path(key, ext)):
+                    link_or_copy(self._path(key, ext), dest + ext)
+        except (IOError, OSError):
+            # Evicted out from under us
+            for ext in EXTENSIONS + OPTIONAL:
+                if os.path.exists(dest + ext):
+                    os.remove(dest + ext)
+            return False
+
+        return True
+
+    def store(self, key, src):
+        """
+        Files src + ".obj"/".mtl" (and ".npz", if it's there) away under key
+        """
+        for ext in EXTENSIONS + [e for e in OPTIONAL if os.path.exists(src + e)]:
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            os.close(fd)
+            os.remove(tmp)
+            link_or_copy(src + ext, tmp)
+            replace(tmp, self._path(key, ext))
+
+        self.evict()
+
+    def evict(self):
+        if not self.max_bytes:
+            return
+
+        meshes = {}
+        total = 0
+        for f in os.listdir(self.cache_dir):
+            key, ext = os.path.splitext(f)
+            if ext not in EXTENSIONS + OPTIONAL:
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, f))
+            except OSError:
+                continue
+            size, used = meshes.get(key, (0, 0))
+            meshes[key] = (size + st.st_size, max(used, st.st_mtime))
+            total += st.st_size
+
+        for key in sorted(meshes, key=lambda k: meshes[k][1]):
+            if total <= self.max_bytes:
+                break
+
+            self.logger.debug("Evicting mesh %s", key)
+            for ext in EXTENSIONS + OPTIONAL:
+                try:
+                    os.remove(self._path(key, ext))
+                except OSError:
+                    pass
+            total -= meshes[key][0]
@@ -0,0 +1,238 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+import subprocess
+
+from artifacts import replace
+
+
+def rusage_dict(usage):
+    """
+    The parts of a resource.struct_rusage worth keeping: CPU seconds and the
+    peak RSS in bytes (Linux counts ru_maxrss in KB, OS X in bytes)
+    """
+    maxrss = usage.ru_maxrss
+    if os.uname()[0] != 'Darwin':
+        maxrss *= 1024
+    return {'user': usage.ru_utime, 'system': usage.ru_stime,
+            'maxrss': maxrss}
+
+
+def run(cmd, cwd=None):
+    """
+    Like subprocess.call(), but returns (rc, rusage) where rusage is
+    rusage_dict() of the child, from wait4(), or None where there's no wait4
+    """
+    proc = subprocess.Popen(cmd, cwd=cwd)
+    if not hasattr(os, 'wait4'):
+        # Windows
+        return proc.wait(), None
+    return wait(proc)
+
+
+def wait(proc):
+    """
+    Waits for the subprocess.Popen proc to exit with wait4(). Returns its
+    return code and rusage_dict().
+    """
+    pid, status, usage = os.wait4(proc.pid, 0)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return proc.returncode, rusage_dict(usage)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for k, v in sorted(labels.items()))
+
+
+class Metrics(object):
+    """
+    Collects what every stage of every snapshot took. Each event is appended
+    to json_path (if set) as a line of JSON, and running totals are written
+    to prom_path (if set) in Prometheus' text format, for node_exporter's
+    textfile collector to pick up, every time a snapshot is finished with.
+
+    Events have a "time", an "event" (stage, child, frame, request or done)
+    and whatever else goes with it; see the methods below.
+    """
+    def __init__(self, json_path=None, prom_path=None):
+        self.logger = logging.getLogger('mcrender')
+        self.json_path = json_path
+        self.prom_path = prom_path
+        self.lock = threading.Lock()
+        # {(metric name, sorted labels): value}
+        self.counters = {}
+        self.gauges = {}
+        self.out = None
+        if json_path is not None:
+            self.out = open(json_path, "a")
+
+    def _emit(self, event, **fields):
+        fields['event'] = event
+        fields['time'] = time.time()
+        line = json.dumps(fields, sort_keys=True) + "\n"
+        with self.lock:
+            if self.out is not None:
+                self.out.write(line)
+                self.out.flush()
+
+    def _add(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def _set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def _max(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = max(self.gauges.get(key, 0), value)
+
+    def stage(self, snapshot, stage, seconds, **fields):
+        """
+        snapshot got through stage in seconds. fields can have bytes (copied,
+        extracted or uploaded), vertices, faces and so on.
+        """
+        self._emit('stage', snapshot=snapshot, stage=stage, seconds=seconds,
+                   **fields)
+        self._add('mcrender_stage_seconds_total', seconds, stage=stage)
+        self._add('mcrender_stage_runs_total', 1, stage=stage)
+        if fields.get('bytes'):
+            self._add('mcrender_bytes_total', fields['bytes'], stage=stage)
+        for count in ['vertices', 'faces']:
+            if fields.get(count) is not None:
+                self._set('mcrender_mesh_%s' % count, fields[count])
+
+    def child(self, snapshot, program, seconds, rusage):
+        """
+        A run of program (mcobj, blender) for snapshot (or None, for a
+        Blender that rendered several) finished, taking seconds of wall time
+        and rusage_dict() of resources
+        """
+        self._emit('child', snapshot=snapshot, program=program,
+                   seconds=seconds, **(rusage or {}))
+        self._add('mcrender_child_runs_total', 1, program=program)
+        self._add('mcrender_child_wall_seconds_total', seconds, program=program)
+        if rusage:
+            self._add('mcrender_child_cpu_seconds_total',
+                      rusage['user'] + rusage['system'], program=program)
+            self._max('mcrender_child_max_rss_bytes', rusage['maxrss'],
+                      program=program)
+
+    def frame(self, snapshot, seconds, rss_mb=None, **fields):
+        """
+        Blender rendered a frame of snapshot, and was using rss_mb afterwards
+        if it's one that's kept running. fields are what obj2png.py said about
+        it: phases, {phase: seconds}, the mesh's dimensions, vertices and
+        faces, and the resolution.
+        """
+        self._emit('frame', snapshot=snapshot, seconds=seconds, rss_mb=rss_mb,
+                   **fields)
+        self._add('mcrender_frames_total', 1)
+        if rss_mb is not None:
+            self._max('mcrender_child_max_rss_bytes', rss_mb * 1024 * 1024,
+                      program='blender')
+        for phase, spent in fields.get('phases', {}).items():
+            self._add('mcrender_blender_phase_seconds_total', spent,
+                      phase=phase)
+
+    def request(self, command, seconds, size, error):
+        """
+        A request to Gallery, see Gallery's on_request
+        """
+        self._emit('request', command=command, seconds=seconds, bytes=size,
+                   error=error and (str(error) or error.__class__.__name__))
+        self._add('mcrender_gallery_request_seconds_total', seconds,
+                  command=command)
+        self._add('mcrender_gallery_requests_total', 1, command=command)
+        if error is not None:
+            self._add('mcrender_gallery_request_errors_total', 1,
+                      command=command)
+
+    def done(self, snapshot, error=None):
+        """
+        Everything's been done with snapshot that's going to be
+        """
+        self._emit('done', snapshot=snapshot, error=error)
+        self._add('mcrender_snapshots_total', 1,
+                  result=error is None and "ok" or "failed")
+        self._set('mcrender_last_snapshot_timestamp_seconds', time.time())
+        self.write_prometheus()
+
+    def take(self):
+        """
+        Hands over the totals so far, and starts again from nothing; for
+        passing them from a worker process to the one writing the Prometheus
+        file, see merge()
+        """
+        with self.lock:
+            totals = (self.counters, self.gauges)
+            self.counters = {}
+            self.gauges = {}
+        return totals
+
+    def merge(self, totals):
+        counters, gauges = totals
+        with self.lock:
+            for key, value in counters.iteritems():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, value in gauges.iteritems():
+                if key[0].endswith('_max_rss_bytes'):
+                    value = max(self.gauges.get(key, 0), value)
+                self.gauges[key] = value
+
+    def write_prometheus(self):
+        if self.prom_path is None:
+            return
+
+        with self.lock:
+            lines = []
+            for kind, values in [('counter', self.counters),
+                                 ('gauge', self.gauges)]:
+                seen = set()
+                for (name, labels), value in sorted(values.items()):
+                    if name not in seen:
+                        lines.append("# TYPE %s %s" % (name, kind))
+                        seen.add(name)
+                    lines.append("%s%s %r" % (name, _labels(dict(labels)),
+                                              float(value)))
+
+        # Written whole and renamed into place, so the collector never sees
+        # half of it
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.prom_path) or ".",
+                                   suffix=".tmp")
+        try:
+            # Readable by whoever's running node_exporter (there's no
+            # fchmod() on Windows, nor any need for it)
+            if hasattr(os, 'fchmod'):
+                os.fchmod(fd, 0644)
+            os.write(fd, "\n".join(lines) + "\n")
+            os.close(fd)
+            replace(tmp, self.prom_path)
+        except OSError:
+            self.logger.warning("Couldn't write %s", self.prom_path,
+                                exc_info=True)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def close(self):
+        self.write_prometheus()
+        with self.lock:
+            if self.out is not None:
+                self.out.close()
+                self.out = None
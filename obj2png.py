@@ -2,23 +2,421 @@
 #   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
 # More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
 
+# Run as either:
+#   blender -b -P obj2png.py foo.obj
+# to render foo.obj into foo.png and exit, or as:
+#   blender -b -P obj2png.py -- --batch [foo.obj bar.obj ...]
+# to set the scene up once and then render every OBJ given. Without any OBJs
+# on the command line, lines of "foo.obj<TAB>foo.png" are read from stdin until
+# it's closed, and every frame is answered with a line starting with "OBJ2PNG".
+#
+# A line can also have a third, JSON, field of options: "preview" renders a
+# quick draft at that fraction of the full size, see setup_camera(), and the
+# rest describe one tile of a big map to render instead, see render_tile().
+# OBJs given on the command line are previewed with --preview=0.25 and so on.
+#
+# If there's a foo.npz next to foo.obj (see objarrays.py) and this Blender has
+# NumPy, the mesh is built straight from its arrays instead of importing the
+# OBJ, which is a lot quicker for big areas. The arrays are mapped straight out
+# of the .npz rather than read into memory, see map_npz().
+#
+# Every frame also gets a foo.stats.json next to foo.png with how long each
+# part of it took and what was rendered, see Phases.
+
 import sys
 import os
 import math
+import json
+import time
+import itertools
+import struct
+import zipfile
 
 import bpy
 from mathutils import *
+from bpy_extras.object_utils import world_to_camera_view
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 scene = bpy.context.scene
 
-print("\nConfiguring lighting")
-scene.objects.unlink(scene.objects["Lamp"])
-lights = scene.world.light_settings
-lights.use_ambient_occlusion = True         # def = False
-#lights.samples = 10                         # def = 5
 
-print("\nPulling Weighted Companion Cube")
-scene.objects.unlink(scene.objects["Cube"])
+class Phases(object):
+    """
+    Times each part of a frame, and writes the times out, along with the size
+    of the mesh and the picture, once the frame's done
+    """
+    # How long setup_scene() took, reported with the first frame only
+    scene_setup = None
+
+    def __init__(self):
+        self.times = {}
+        if Phases.scene_setup is not None:
+            self.times['scene_setup'] = Phases.scene_setup
+            Phases.scene_setup = None
+        self.last = time.time()
+
+    def lap(self, phase):
+        """
+        Puts the time since the last lap down to phase
+        """
+        now = time.time()
+        self.times[phase] = self.times.get(phase, 0) + now - self.last
+        self.last = now
+
+    def write(self, out_f, our_mesh, **extra):
+        mesh = our_mesh.data
+        faces = getattr(mesh, 'polygons', None) or mesh.faces
+        stats = dict(extra, phases=self.times,
+                     dimensions=list(our_mesh.dimensions),
+                     vertices=len(mesh.vertices), faces=len(faces),
+                     resolution=[scene.render.resolution_x,
+                                 scene.render.resolution_y])
+        sidecar = open(os.path.splitext(out_f)[0] + ".stats.json", "w")
+        json.dump(stats, sidecar)
+        sidecar.close()
+
+
+def setup_scene():
+    start = time.time()
+    print("\nConfiguring lighting")
+    scene.objects.unlink(scene.objects["Lamp"])
+    lights = scene.world.light_settings
+    lights.use_ambient_occlusion = True         # def = False
+    #lights.samples = 10                         # def = 5
+
+    print("\nPulling Weighted Companion Cube")
+    scene.objects.unlink(scene.objects["Cube"])
+    Phases.scene_setup = time.time() - start
+
+
+def map_npz(npz):
+    """
+    The arrays in npz, memory-mapped instead of read in, so big meshes are
+    paged in as Blender copies them rather than held twice. numpy.load()
+    can't map an .npz, but objarrays.py doesn't compress them, so every
+    array is a plain .npy sitting somewhere in the zip. Anything else is
+    just loaded.
+    """
+    arrays = {}
+    with zipfile.ZipFile(npz) as zf, open(npz, "rb") as f:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                return numpy.load(npz)
+
+            # The local file header has its own name and extra field lengths
+            f.seek(info.header_offset)
+            name_len, extra_len = struct.unpack("<HH", f.read(30)[26:30])
+            start = info.header_offset + 30 + name_len + extra_len
+            f.seek(start)
+            version = numpy.lib.format.read_magic(f)
+            if version == (1, 0):
+                header = numpy.lib.format.read_array_header_1_0(f)
+            else:
+                header = numpy.lib.format.read_array_header_2_0(f)
+            shape, fortran, dtype = header
+            if dtype.hasobject:
+                return numpy.load(npz)
+
+            name = os.path.splitext(info.filename)[0]
+            if not shape or 0 in shape:
+                # mmap won't map nothing
+                f.seek(start)
+                arrays[name] = numpy.lib.format.read_array(f)
+            else:
+                arrays[name] = numpy.memmap(npz, dtype=dtype, mode="r",
+                                            offset=f.tell(), shape=shape,
+                                            order="F" if fortran else "C")
+    return arrays
+
+
+def load_arrays(npz):
+    arrays = map_npz(npz)
+    mesh = bpy.data.meshes.new("Mesh")
+
+    # Y up, like the OBJ importer does it
+    v = arrays['vertices']
+    co = numpy.empty_like(v)
+    co[:, 0] = v[:, 0]
+    co[:, 1] = -v[:, 2]
+    co[:, 2] = v[:, 1]
+    mesh.vertices.add(len(co))
+    mesh.vertices.foreach_set("co", co.ravel())
+
+    mesh.loops.add(len(arrays['loops']))
+    mesh.loops.foreach_set("vertex_index", arrays['loops'])
+    mesh.polygons.add(len(arrays['loop_starts']))
+    mesh.polygons.foreach_set("loop_start", arrays['loop_starts'])
+    mesh.polygons.foreach_set("loop_total", arrays['loop_totals'])
+    mesh.polygons.foreach_set("material_index", arrays['face_materials'])
+
+    for name, color in zip(arrays['materials'], arrays['colors']):
+        if isinstance(name, bytes):
+            name = name.decode("utf-8")
+        material = bpy.data.materials.new(name)
+        material.diffuse_color = [float(c) for c in color[:3]]
+        if color[3] < 1:
+            material.use_transparency = True
+            material.alpha = float(color[3])
+        mesh.materials.append(material)
+
+    mesh.update(calc_edges=True)
+    our_mesh = bpy.data.objects.new("Mesh", mesh)
+    scene.objects.link(our_mesh)
+    return our_mesh, arrays
+
+
+def load(in_f):
+    """
+    Brings in_f into the scene. Returns the object, and the arrays it was
+    built from, or None if it had to be imported.
+    """
+    npz = os.path.splitext(in_f)[0] + ".npz"
+    if numpy is not None and os.path.exists(npz):
+        return load_arrays(npz)
+
+    bpy.ops.import_scene.obj('EXEC_DEFAULT', filepath=in_f)
+    our_mesh = [k for k in scene.objects.keys() if k.startswith("Mesh")][0]
+    return scene.objects[our_mesh], None
+
+
+def set_format(file_format):
+    # Newer Blenders keep the output format in image_settings
+    settings = getattr(scene.render, 'image_settings', scene.render)
+    settings.file_format = file_format
+
+
+def setup_camera(base_dimension, preview=None):
+    # NOTE: Most of the values below were determined experimentally. If you want
+    # to change them it'll probably take some trial and error.
+    print("\nConfiguring camera")
+    camera = scene.objects["Camera"]
+    camera.data.type = 'ORTHO'
+    camera.data.ortho_scale = 2 * base_dimension
+    camera.data.shift_x = 0
+    camera.data.shift_y = 0
+    camera.location = Vector((20, -20, 29))
+    # NOTE: The blender GUI shows degrees by default, but this method takes radians!
+    camera.rotation_euler = Euler((math.pi * 45.0 / 180,
+                                   math.pi *  0.0 / 180,
+                                   math.pi * 45.0 / 180), 'XYZ')
+
+    print("\nConfiguring renderer")
+    # A preview is the same picture, just smaller and without the expensive
+    # lighting. The camera doesn't change, so the framing is the same.
+    scale = preview or 1.0
+    scene.world.light_settings.use_ambient_occlusion = not preview
+    # These next two settings make it such that:
+    # 1) A minecraft lock is always the same size, pixel wise
+    # 2) The output file is "wide-screen"
+    scene.render.resolution_x = int(1.42 * 93 * base_dimension * scale)
+    scene.render.resolution_y = int(93 * base_dimension * scale)
+    scene.render.resolution_percentage = 100    # 50 is default
+    scene.render.color_mode = 'RGBA'
+    scene.render.file_quality = 100             # 90 is defaultscene.render.
+    if preview:
+        scene.render.parts_x = 8
+        scene.render.parts_y = 8
+    else:
+        scene.render.parts_x = 128              # 8 is default
+        scene.render.parts_y = 128              # 8 is default
+    set_format('PNG')
+
+    return camera
+
+
+def render(in_f, out_f, preview=None):
+    print("\nLoading and centering %s" % in_f)
+    phases = Phases()
+
+    our_mesh, arrays = load(in_f)
+    phases.lap('import')
+    if arrays is None:
+        bpy.ops.object.origin_set(type='ORIGIN_GEOMETRY', center='MEDIAN')
+        our_mesh.location = Vector((0, 0, 0))
+
+        # The size of the mesh we imported is the basic dimension of many of
+        # our calculations later on. Store it for easier use later
+        base_dimension = our_mesh.dimensions.x
+    else:
+        # The arrays already know where the middle is and how big it all is
+        our_mesh.location = -from_obj(arrays['center'])
+        base_dimension = float(arrays['hi'][0] - arrays['lo'][0])
+    phases.lap('origin_set')
+
+    setup_camera(base_dimension, preview)
+    phases.lap('camera')
+
+    print("\nRendering...")
+    bpy.ops.render.render()
+    phases.lap('render')
+
+    print("\nSaving image...")
+    bpy.data.images['Render Result'].save_render(filepath=out_f)
+    phases.lap('save')
+    phases.write(out_f, our_mesh, arrays=arrays is not None, preview=preview)
+
+
+def from_obj(v):
+    # The OBJ importer turns Y up into Blender's Z up
+    return Vector((v[0], -v[2], v[1]))
+
+
+def render_tile(in_f, out_f, tile, preview=None):
+    """
+    Renders the part of the whole map's frame that one tile of it covers,
+    as an uncompressed TGA (quick for mcrender to stitch back together).
+    The camera is set up as render() would for the whole map, so tiles
+    line up; tile has what's needed for that, in OBJ coordinates:
+      shift - how far to move the tile, centering the whole map
+      base - how wide the whole map is
+      bounds - [[x, y, z], [x, y, z]] corners of this tile's box
+    Where the tile landed in the frame goes in out_f's .json sidecar: x, y,
+    width and height in pixels, the full_width and full_height of the frame,
+    and the depth of the tile from the camera, to stack them in the right
+    order. Tiles entirely outside the frame have no width and no image.
+    """
+    print("\nLoading tile %s" % in_f)
+    phases = Phases()
+
+    our_mesh, arrays = load(in_f)
+    phases.lap('import')
+    our_mesh.location = from_obj(tile['shift'])
+    camera = setup_camera(tile['base'], preview)
+    scene.update()
+
+    width = scene.render.resolution_x
+    height = scene.render.resolution_y
+    xs = []
+    ys = []
+    depths = []
+    for corner in itertools.product(*zip(*tile['bounds'])):
+        x, y, depth = world_to_camera_view(scene, camera,
+                                           from_obj(corner) + our_mesh.location)
+        xs.append(x * width)
+        ys.append((1 - y) * height)
+        depths.append(depth)
+
+    x0 = max(0, int(math.floor(min(xs))))
+    x1 = min(width, int(math.ceil(max(xs))))
+    y0 = max(0, int(math.floor(min(ys))))
+    y1 = min(height, int(math.ceil(max(ys))))
+    info = {'x': x0, 'y': y0, 'width': max(0, x1 - x0),
+            'height': max(0, y1 - y0), 'full_width': width,
+            'full_height': height, 'depth': sum(depths) / len(depths)}
+
+    if info['width'] and info['height']:
+        # Narrow the camera down to just the tile's pixels. The ortho scale
+        # and shifts are both in terms of the bigger side of the frame
+        size = max(info['width'], info['height'])
+        camera.data.ortho_scale *= size / float(max(width, height))
+        camera.data.shift_x = (x0 + info['width'] / 2.0 - width / 2.0) / size
+        camera.data.shift_y = (height / 2.0 - y0 - info['height'] / 2.0) / size
+        scene.render.resolution_x = info['width']
+        scene.render.resolution_y = info['height']
+        set_format('TARGA_RAW')
+        phases.lap('camera')
+
+        print("\nRendering tile...")
+        bpy.ops.render.render()
+        phases.lap('render')
+        bpy.data.images['Render Result'].save_render(filepath=out_f)
+        phases.lap('save')
+    else:
+        phases.lap('camera')
+
+    sidecar = open(os.path.splitext(out_f)[0] + ".json", "w")
+    json.dump(info, sidecar)
+    sidecar.close()
+    phases.write(out_f, our_mesh, arrays=arrays is not None, preview=preview,
+                 tile=True)
+
+
+def clear():
+    """
+    Throws away everything the last import brought in, so the next frame
+    starts from the same scene and the memory can be reused.
+    """
+    for obj in list(scene.objects):
+        if obj.type == 'MESH':
+            scene.objects.unlink(obj)
+            bpy.data.objects.remove(obj)
+
+    for collection in [bpy.data.meshes, bpy.data.materials,
+                       bpy.data.textures, bpy.data.images]:
+        for thing in list(collection):
+            if thing.users == 0:
+                collection.remove(thing)
+
+
+def rss_mb():
+    try:
+        statm = open("/proc/self/statm").read().split()
+        return int(statm[1]) * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024)
+    except (IOError, OSError, ValueError):
+        import resource
+        # Peak rather than current, but it's the best we've got off Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def reply(*words):
+    # Blender's own output can leave a line half-written, so start a fresh one
+    sys.stdout.write("\nOBJ2PNG %s\n" % " ".join(str(w) for w in words))
+    sys.stdout.flush()
+
+
+def serve(jobs):
+    for in_f, out_f, options in jobs:
+        options = options or {}
+        try:
+            if 'bounds' in options:
+                render_tile(in_f, out_f, options, options.get('preview'))
+            else:
+                render(in_f, out_f, options.get('preview'))
+        except Exception as e:
+            reply("FAIL", str(e).replace("\n", " ") or e.__class__.__name__)
+        else:
+            reply("OK", "%.1f" % rss_mb(), out_f)
+        clear()
+
+
+def stdin_jobs():
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        line = line.rstrip("\n")
+        if not line:
+            continue
+
+        fields = line.split("\t")
+        if len(fields) > 2:
+            yield fields[0], fields[1], json.loads(fields[2])
+        else:
+            yield fields[0], fields[1], None
+
+
+if "--" in sys.argv:
+    script_args = sys.argv[sys.argv.index("--") + 1:]
+else:
+    script_args = []
+
+if "--batch" in script_args:
+    setup_scene()
+    objs = [os.path.abspath(a) for a in script_args if a.endswith(".obj")]
+    options = {}
+    for a in script_args:
+        if a.startswith("--preview="):
+            options['preview'] = float(a[len("--preview="):])
+    if objs:
+        serve((o, o.replace(".obj", ".png"), options) for o in objs)
+    else:
+        reply("READY")
+        serve(stdin_jobs())
+    sys.exit(0)
 
 # On Windows paths are separated with \'s
 # but the rest of blender doesn't like that so much
@@ -29,53 +427,13 @@ if not input_file.endswith(".obj"):
     sys.exit(1)
 
 output_file = input_file.replace(".obj", ".png")
-    
+
 if os.path.exists(os.path.join(work_dir, output_file)):
     print("%s already done, skipping" % input_file)
     sys.exit(2)
 
-in_f = os.path.join(work_dir, input_file)
-out_f = os.path.join(work_dir, output_file)
-print("\nLoading and centering %s" % input_file)
-
-bpy.ops.import_scene.obj('EXEC_DEFAULT', filepath=in_f)
-our_mesh = [k for k in scene.objects.keys() if k.startswith("Mesh")][0]
-bpy.ops.object.origin_set(type='ORIGIN_GEOMETRY', center='MEDIAN')
-scene.objects[our_mesh].location = Vector((0, 0, 0))
-
-# The size of the mesh we imported is the basic dimension of many of our
-# calculations later on. Store it for easier use later
-base_dimension = scene.objects[our_mesh].dimensions.x
-
-# NOTE: Most of the values below were determined experimentally. If you want
-# to change them it'll probably take some trial and error.
-print("\nConfiguring camera")
-camera = scene.objects["Camera"]
-camera.data.type = 'ORTHO'
-camera.data.ortho_scale = 2 * base_dimension
-camera.location = Vector((20, -20, 29))
-# NOTE: The blender GUI shows degrees by default, but this method takes radians!
-camera.rotation_euler = Euler((math.pi * 45.0 / 180,
-                               math.pi *  0.0 / 180,
-                               math.pi * 45.0 / 180), 'XYZ')
-
-print("\nConfiguring renderer")
-# These next two settings make it such that:
-# 1) A minecraft lock is always the same size, pixel wise
-# 2) The output file is "wide-screen"
-scene.render.resolution_x = 1.42 * 93 * base_dimension
-scene.render.resolution_y = 93 * base_dimension
-scene.render.resolution_percentage = 100    # 50 is default
-scene.render.color_mode = 'RGBA'
-scene.render.file_quality = 100             # 90 is defaultscene.render.
-scene.render.parts_x = 128                  # 8 is default
-scene.render.parts_y = 128                  # 8 is default
-
-print("\nRendering...")
-bpy.ops.render.render()
-
-print("\nSaving image...")
-bpy.data.images['Render Result'].save_render(filepath=out_f)
+setup_scene()
+render(os.path.join(work_dir, input_file), os.path.join(work_dir, output_file))
 
 # Just process one file, due to memory leaks
 sys.exit(0)
@@ -0,0 +1,200 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+# Blender's OBJ importer spends longer parsing mcobj's text than rendering big
+# areas takes. This parses an OBJ (and its MTL) once into flat arrays, saved as
+# an uncompressed .npz next to it, that obj2png.py maps into memory and hands
+# straight to a Blender mesh. Everything is in the OBJ's own coordinates:
+#   vertices        float32 (n, 3)
+#   loops           int32, the vertex of every corner of every face, in order
+#   loop_starts     int32, where each face's corners start in loops
+#   loop_totals     int32, how many corners each face has
+#   face_materials  int32, index into materials for each face
+#   materials       the material names, in the order they were first used
+#   colors          float32 (m, 4), each material's Kd and d from the MTL
+#   lo, hi, center  float32 (3,), the bounding box and mean of the vertices
+#
+# NumPy is optional; without it there are no .npz files and Blender imports
+# the OBJ as it always has.
+
+import os
+import array
+
+from artifacts import replace
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def npz_path(obj_path):
+    return os.path.splitext(obj_path)[0] + ".npz"
+
+
+def _index(word, count):
+    # "v", "v/vt" or "v/vt/vn", 1 based, or negative to count back from the end
+    i = int(word.split("/", 1)[0])
+    if i < 0:
+        return count + i
+    return i - 1
+
+
+def _to_numpy(a, dtype):
+    # frombuffer() won't take an empty buffer
+    if not len(a):
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.frombuffer(a, dtype=dtype)
+
+
+def read_mtl(path):
+    """
+    {material name: [r, g, b, alpha]} out of an MTL file
+    """
+    colors = {}
+    current = None
+    for line in open(path):
+        words = line.split()
+        if not words:
+            continue
+        if words[0] == "newmtl":
+            current = [0.8, 0.8, 0.8, 1.0]
+            colors[" ".join(words[1:])] = current
+        elif current is None:
+            continue
+        elif words[0] == "Kd":
+            current[:3] = [float(c) for c in words[1:4]]
+        elif words[0] == "d":
+            current[3] = float(words[1])
+    return colors
+
+
+def read_obj(path):
+    """
+    The arrays described at the top of this file, as a dict, for the OBJ at
+    path. Raises ValueError if it doesn't make sense.
+    """
+    vertices = array.array('f')
+    loops = array.array('i')
+    loop_starts = array.array('i')
+    loop_totals = array.array('i')
+    face_materials = array.array('i')
+    materials = []
+    material_index = {}
+    mtllib = None
+    current = 0
+    count = 0
+
+    for line in open(path):
+        if line.startswith("v "):
+            words = line.split()
+            vertices.extend([float(words[1]), float(words[2]), float(words[3])])
+            count += 1
+        elif line.startswith("f "):
+            words = line.split()[1:]
+            loop_starts.append(len(loops))
+            loop_totals.append(len(words))
+            for word in words:
+                i = _index(word, count)
+                if not 0 <= i < count:
+                    raise ValueError("%s: face uses vertex %s of %d" %
+                                     (path, word, count))
+                loops.append(i)
+            face_materials.append(current)
+        elif line.startswith("usemtl"):
+            name = line[len("usemtl"):].strip()
+            if name not in material_index:
+                material_index[name] = len(materials)
+                materials.append(name)
+            current = material_index[name]
+        elif line.startswith("mtllib"):
+            mtllib = line[len("mtllib"):].strip()
+
+    if not count:
+        raise ValueError("%s has no vertices" % path)
+    if not materials:
+        materials.append("")
+
+    colors = {}
+    if mtllib is not None:
+        mtl = os.path.join(os.path.dirname(path), mtllib)
+        if os.path.exists(mtl):
+            colors = read_mtl(mtl)
+
+    v = _to_numpy(vertices, numpy.float32).reshape(-1, 3)
+    return {
+        'vertices': v,
+        'loops': _to_numpy(loops, numpy.int32),
+        'loop_starts': _to_numpy(loop_starts, numpy.int32),
+        'loop_totals': _to_numpy(loop_totals, numpy.int32),
+        'face_materials': _to_numpy(face_materials, numpy.int32),
+        'materials': numpy.array(materials),
+        'colors': numpy.array([colors.get(m, [0.8, 0.8, 0.8, 1.0])
+                                   for m in materials], dtype=numpy.float32),
+        'lo': v.min(axis=0),
+        'hi': v.max(axis=0),
+        # In double precision, float32 sums drift over millions of vertices
+        'center': v.mean(axis=0, dtype=numpy.float64).astype(numpy.float32),
+    }
+
+
+def save(arrays, obj_path):
+    """
+    Saves arrays next to the OBJ at obj_path, under the same name with .npz
+    on the end
+    """
+    dest = npz_path(obj_path)
+    # numpy.savez() adds .npz to names that don't already end in it
+    tmp = dest + ".tmp.npz"
+    numpy.savez(tmp, **arrays)
+    replace(tmp, dest)
+
+
+def convert(obj_path):
+    """
+    Saves the arrays for the OBJ at obj_path next to it, and returns them
+    """
+    arrays = read_obj(obj_path)
+    save(arrays, obj_path)
+    return arrays
+
+
+def write_obj(arrays, path):
+    """
+    Writes arrays back out as an OBJ at path, using the MTL of the same name.
+    Faces are grouped by material.
+    """
+    tmp = path + ".tmp"
+    out = open(tmp, "w")
+    try:
+        out.write("mtllib %s\n" % (os.path.splitext(os.path.basename(path))[0] +
+                                   ".mtl"))
+        # 9 significant digits are enough to read back the same float32
+        numpy.savetxt(out, arrays['vertices'], fmt="v %.9g %.9g %.9g")
+
+        loops = arrays['loops'] + 1
+        starts = arrays['loop_starts']
+        totals = arrays['loop_totals']
+        for m, name in enumerate(arrays['materials']):
+            mine = arrays['face_materials'] == m
+            if not mine.any():
+                continue
+            if name:
+                out.write("usemtl %s\n" % name)
+            for total in numpy.unique(totals[mine]):
+                corners = starts[mine & (totals == total)][:, None] + \
+                          numpy.arange(total)
+                numpy.savetxt(out, loops[corners], fmt="f" + " %d" * total)
+    finally:
+        out.close()
+    replace(tmp, path)
+
+
+def stats(arrays):
+    """
+    The arrays' vertices summed up the way tiles.obj_stats() does
+    """
+    v = arrays['vertices']
+    return (len(v), v.sum(axis=0, dtype=numpy.float64).tolist(),
+            arrays['lo'].tolist(), arrays['hi'].tolist())
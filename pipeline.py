@@ -0,0 +1,105 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+import threading
+import logging
+import Queue
+
+# Tells a stage worker there's nothing more coming
+_STOP = object()
+
+
+class Stage(object):
+    def __init__(self, name, func, workers, depth):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = Queue.Queue(depth)
+        self.threads = []
+
+
+class Pipeline(object):
+    """
+    Pushes items through a series of stages. Every stage has its own worker
+    threads and a bounded queue in front of it, so while one item is in a later
+    stage the next ones are already being worked on by the earlier stages.
+    Once a queue is full the stage feeding it waits, which keeps the number of
+    items sitting around between stages (and their scratch space) bounded.
+
+    on_done(item, stage, error) is called once per item, either after the last
+    stage (stage and error are None) or with the name of the stage that failed
+    and the exception it raised. Items that fail don't go any further.
+    """
+    def __init__(self, on_done=None):
+        self.logger = logging.getLogger('mcrender')
+        self.stages = []
+        self.on_done = on_done
+
+    def add_stage(self, name, func, workers=1, depth=1):
+        self.stages.append(Stage(name, func, max(1, workers), max(1, depth)))
+
+    def start(self):
+        for i, stage in enumerate(self.stages):
+            if i + 1 < len(self.stages):
+                following = self.stages[i + 1]
+            else:
+                following = None
+
+            for n in range(stage.workers):
+                t = threading.Thread(target=self._work,
+                                     args=(stage, following),
+                                     name="%s-%d" % (stage.name, n))
+                t.daemon = True
+                t.start()
+                stage.threads.append(t)
+
+    def put(self, item, timeout=None):
+        """
+        Blocks while the first stage's queue is full, for at most timeout
+        seconds if it's given. Returns whether item went in.
+        """
+        try:
+            self.stages[0].queue.put(item, True, timeout)
+        except Queue.Full:
+            return False
+        return True
+
+    def close(self):
+        """
+        Waits for everything that's been put() to make it through
+        """
+        for stage in self.stages:
+            for t in stage.threads:
+                stage.queue.put(_STOP)
+            for t in stage.threads:
+                # join() with a timeout so Ctrl-C still gets through
+                while t.is_alive():
+                    t.join(0.5)
+
+    def _work(self, stage, following):
+        while True:
+            item = stage.queue.get()
+            if item is _STOP:
+                break
+
+            try:
+                stage.func(item)
+            except Exception as e:
+                self.logger.exception("%s stage failed on %s", stage.name, item)
+                self._done(item, stage.name, e)
+                continue
+
+            if following is None:
+                self._done(item, None, None)
+            else:
+                following.queue.put(item)
+
+    def _done(self, item, stage, error):
+        if self.on_done is None:
+            return
+
+        try:
+            self.on_done(item, stage, error)
+        except Exception:
+            self.logger.exception("Finishing off %s failed", item)
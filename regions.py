@@ -0,0 +1,214 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+# Minecraft keeps the overworld in region/r.X.Z.mca (or .mcr for pre-Anvil
+# worlds), each file holding 32x32 chunks of 16x16 blocks. mcobj only looks at
+# the chunks inside the area it's been asked for, so that's all we need to pull
+# out of a backup.
+
+import os
+import re
+import hashlib
+import tarfile
+import posixpath
+
+REGION_RE = re.compile(r'^r\.(-?\d+)\.(-?\d+)\.mc[ar]$')
+DIMENSION_RE = re.compile(r'^DIM-?\d+$')
+
+CHUNKS_PER_REGION = 32
+# The chunk locations and timestamps at the start of every region file, see
+# chunkindex.py
+HEADER_SIZE = 8192
+
+# Flags mcobj understands for picking the area to convert, all in chunks
+_FLAG_RE = re.compile(r'^--?(s|rx|rz|cx|cz)(?:=(-?\d+))?$')
+
+
+def mcobj_bounds(args, margin=1):
+    """
+    Works out which chunks mcobj is going to look at from its arguments.
+    Returns (xmin, zmin, xmax, zmax) in chunks, inclusive, or None when
+    there's no limit. margin extra chunks are kept on every side since mcobj
+    peeks at neighbouring chunks to decide which faces are visible.
+    """
+    values = {'cx': 0, 'cz': 0}
+    i = 0
+    while i < len(args):
+        m = _FLAG_RE.match(args[i])
+        if m:
+            flag, value = m.groups()
+            if value is None and i + 1 < len(args):
+                i += 1
+                value = args[i]
+            values[flag] = int(value)
+        i += 1
+
+    if 's' in values:
+        width = height = values['s']
+    elif 'rx' in values and 'rz' in values:
+        width, height = values['rx'], values['rz']
+    else:
+        return None
+
+    return (values['cx'] - width // 2 - margin,
+            values['cz'] - height // 2 - margin,
+            values['cx'] + (width + 1) // 2 + margin,
+            values['cz'] + (height + 1) // 2 + margin)
+
+
+def region_bounds(bounds):
+    """
+    The regions (xmin, zmin, xmax, zmax), inclusive, covering chunk bounds
+    """
+    return tuple(c // CHUNKS_PER_REGION for c in bounds)
+
+
+def region_coords(name):
+    """
+    (x, z) of an overworld region file, or None if name isn't one
+    """
+    parts = name.split('/')
+    if len(parts) < 2 or parts[-2] != 'region':
+        return None
+    if len(parts) > 2 and DIMENSION_RE.match(parts[-3]):
+        return None
+
+    m = REGION_RE.match(parts[-1])
+    if not m:
+        return None
+    return int(m.group(1)), int(m.group(2))
+
+
+def wanted(name, bounds):
+    """
+    Whether the archive member called name is needed to render the chunks in
+    bounds (None meaning all of them)
+    """
+    if posixpath.basename(name) == 'level.dat':
+        return True
+
+    coords = region_coords(name)
+    if coords is None:
+        return False
+    if bounds is None:
+        return True
+
+    xmin, zmin, xmax, zmax = region_bounds(bounds)
+    return xmin <= coords[0] <= xmax and zmin <= coords[1] <= zmax
+
+
+def digest(digests):
+    """
+    Boils a {region file: sha1} dict down to one digest for the lot
+    """
+    h = hashlib.sha1()
+    for name in sorted(digests):
+        h.update("%s %s\n" % (name, digests[name]))
+    return h.hexdigest()
+
+
+def safe_name(name):
+    """
+    Whether an archive member can be written out without escaping the
+    directory it's written into
+    """
+    return not (name.startswith('/') or '..' in name.split('/'))
+
+
+def write_file(fileobj, path, mtime, keep=0):
+    """
+    Copies fileobj out to path. Returns the sha1 of what was written and its
+    first keep bytes.
+    """
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    h = hashlib.sha1()
+    head = ''
+    out = open(path, 'wb')
+    try:
+        while True:
+            data = fileobj.read(1024 * 1024)
+            if not data:
+                break
+            if len(head) < keep:
+                head += data[:keep - len(head)]
+            h.update(data)
+            out.write(data)
+    finally:
+        out.close()
+    os.utime(path, (mtime, mtime))
+    return h.hexdigest(), head
+
+
+def find_world(names):
+    """
+    The directory holding the outermost level.dat out of a list of archive
+    member names, or None if there isn't one
+    """
+    worlds = [posixpath.dirname(n) for n in names
+                  if posixpath.basename(n) == 'level.dat']
+    if not worlds:
+        return None
+    return min(worlds, key=lambda w: (w.count('/'), len(w)))
+
+
+def region_digests(digests, world):
+    """
+    Picks the region files out of a {member name: sha1} dict, keyed by their
+    path inside world so the same map in a differently named backup gives
+    the same digests
+    """
+    found = {}
+    for name, sha1 in digests.iteritems():
+        if region_coords(name) is not None:
+            found[posixpath.relpath(name, world or '.')] = sha1
+    return found
+
+
+def region_headers(headers):
+    """
+    Renames the region files in an {archive member: header} dict the way
+    chunkindex.py knows them, by the last two parts of their names
+    """
+    return dict(("/".join(name.split("/")[-2:]), header)
+                for name, header in headers.iteritems())
+
+
+def extract_world(tarball, dest, bounds):
+    """
+    Streams through tarball once, writing out just level.dat and the region
+    files covering bounds. Returns the path of the world (the directory
+    holding level.dat) relative to dest, how many bytes were written, a
+    {region file: sha1} dict of the region files, see region_digests(), and
+    their headers, see region_headers().
+    """
+    written = 0
+    digests = {}
+    headers = {}
+
+    tf = tarfile.open(tarball, 'r|*')
+    try:
+        for member in tf:
+            name = member.name
+            if not member.isfile() or not safe_name(name) or \
+                    not wanted(name, bounds):
+                continue
+
+            path = os.path.join(dest, *name.split('/'))
+            keep = region_coords(name) is not None and HEADER_SIZE or 0
+            digests[name], head = write_file(tf.extractfile(member), path,
+                                             member.mtime, keep)
+            if keep:
+                headers[name] = head
+            written += member.size
+    finally:
+        tf.close()
+
+    world = find_world(digests)
+    if world is None:
+        raise ValueError("No level.dat in %s" % tarball)
+
+    return os.path.normpath(world or '.'), written, \
+           region_digests(digests, world), region_headers(headers)
@@ -0,0 +1,163 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+# Puts tiles rendered by obj2png.py back together into one PNG, a row at a
+# time, so neither the tiles nor the whole image ever have to be in memory.
+
+import re
+import zlib
+import json
+import struct
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# Runs of fully opaque and of partly transparent pixels, in a string of alphas
+_RUNS_RE = re.compile('(\xff+)|([^\x00\xff]+)')
+
+
+class TGAReader(object):
+    """
+    Hands out the rows of an uncompressed 24 or 32 bit TGA as RGBA, top row
+    first
+    """
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        header = self.f.read(18)
+        (id_length, colormap_type, image_type, self.width, self.height,
+         self.bpp, descriptor) = struct.unpack('<BBB5x4xHHBB', header)
+        if image_type != 2 or colormap_type != 0 or self.bpp not in (24, 32):
+            raise ValueError("%s isn't an uncompressed true colour TGA" % path)
+
+        self.top_down = bool(descriptor & 0x20)
+        self.offset = 18 + id_length
+        self.row_bytes = self.width * self.bpp // 8
+
+    def row(self, y):
+        if not self.top_down:
+            y = self.height - 1 - y
+        self.f.seek(self.offset + y * self.row_bytes)
+        data = self.f.read(self.row_bytes)
+
+        rgba = bytearray(self.width * 4)
+        step = self.bpp // 8
+        rgba[0::4] = data[2::step]
+        rgba[1::4] = data[1::step]
+        rgba[2::4] = data[0::step]
+        if step == 4:
+            rgba[3::4] = data[3::4]
+        else:
+            rgba[3::4] = '\xff' * self.width
+        return rgba
+
+    def close(self):
+        self.f.close()
+
+
+class PNGWriter(object):
+    """
+    Writes an 8 bit RGBA PNG a row at a time
+    """
+    def __init__(self, path, width, height, level=6):
+        self.f = open(path, 'wb')
+        self.width = width
+        self.height = height
+        self.z = zlib.compressobj(level)
+        self.pending = []
+        self.pending_bytes = 0
+
+        self.f.write(PNG_SIGNATURE)
+        self._chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        self.f.write(struct.pack('>I', len(data)))
+        self.f.write(kind)
+        self.f.write(data)
+        self.f.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    def _add(self, data):
+        if data:
+            self.pending.append(data)
+            self.pending_bytes += len(data)
+        if self.pending_bytes >= 256 * 1024:
+            self._chunk('IDAT', ''.join(self.pending))
+            self.pending = []
+            self.pending_bytes = 0
+
+    def write_row(self, row):
+        # Every row gets filter type 0, none
+        self._add(self.z.compress('\x00'))
+        self._add(self.z.compress(bytes(row)))
+
+    def close(self):
+        self.pending.append(self.z.flush())
+        self._chunk('IDAT', ''.join(self.pending))
+        self._chunk('IEND', '')
+        self.f.close()
+
+
+def over(dst, x, src):
+    """
+    Lays the RGBA pixels in src over those in dst starting at pixel x. Fully
+    opaque runs are copied straight across; only the partly transparent
+    pixels on the edges of things are blended.
+    """
+    alpha = bytes(src[3::4])
+    for m in _RUNS_RE.finditer(alpha):
+        a, b = m.span()
+        if m.group(1):
+            dst[(x + a) * 4:(x + b) * 4] = src[a * 4:b * 4]
+            continue
+
+        for i in range(a, b):
+            s = i * 4
+            d = (x + i) * 4
+            sa = src[s + 3]
+            da = dst[d + 3]
+            if not da:
+                dst[d:d + 4] = src[s:s + 4]
+                continue
+
+            # Straight (not premultiplied) alpha, scaled up by 255
+            keep = da * (255 - sa)
+            oa = sa * 255 + keep
+            for c in range(3):
+                dst[d + c] = (src[s + c] * sa * 255 + dst[d + c] * keep) // oa
+            dst[d + 3] = oa // 255
+
+
+def stitch(tiles, out_path):
+    """
+    Stitches tiles into out_path. tiles is a list of (image, sidecar) paths
+    as written by obj2png.py's render_tile(); the tiles furthest from the
+    camera are laid down first so nearer ones end up on top.
+    """
+    placed = []
+    width = height = None
+    for image, sidecar in tiles:
+        info = json.load(open(sidecar))
+        width, height = info['full_width'], info['full_height']
+        if info['width'] and info['height']:
+            placed.append((-info['depth'], info, image))
+    if width is None:
+        raise ValueError("No tiles to stitch")
+
+    placed.sort()
+    readers = []
+    try:
+        for depth, info, image in placed:
+            readers.append((info, TGAReader(image)))
+
+        out = PNGWriter(out_path, width, height)
+        try:
+            for y in range(height):
+                row = bytearray(width * 4)
+                for info, reader in readers:
+                    if info['y'] <= y < info['y'] + info['height']:
+                        over(row, info['x'], reader.row(y - info['y']))
+                out.write_row(row)
+        finally:
+            out.close()
+    finally:
+        for info, reader in readers:
+            reader.close()
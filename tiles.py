@@ -0,0 +1,134 @@
+# MCRender by David Gadling is licensed under a
+#   Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported License.
+# More details available at http://creativecommons.org/licenses/by-nc-sa/3.0/
+
+# Big areas can be too much for one mcobj and one Blender, so they can be cut
+# into a grid of tiles instead. Every tile gets its own copy of the world where
+# the region file headers only point at that tile's chunks, so mcobj (run with
+# the same arguments as for the whole area) only meshes that tile, and places
+# it exactly where it would be in the whole mesh. Each tile is then rendered
+# through the same camera as the whole map would be, see obj2png.py, and the
+# pieces are stitched back together, see stitch.py.
+
+import os
+import shutil
+import struct
+import posixpath
+
+import regions
+import chunkindex
+from artifacts import link_or_copy
+
+
+def split(bounds, grid):
+    """
+    Cuts chunk bounds (xmin, zmin, xmax, zmax), inclusive, into a grid x grid
+    list of ((i, j), tile bounds), leaving out tiles with no chunks in them
+    """
+    def cuts(lo, hi):
+        size = hi - lo + 1
+        edges = [lo + size * k // grid for k in range(grid + 1)]
+        return [(edges[k], edges[k + 1] - 1) for k in range(grid)]
+
+    tiles = []
+    for i, (xmin, xmax) in enumerate(cuts(bounds[0], bounds[2])):
+        for j, (zmin, zmax) in enumerate(cuts(bounds[1], bounds[3])):
+            if xmin <= xmax and zmin <= zmax:
+                tiles.append(((i, j), (xmin, zmin, xmax, zmax)))
+    return tiles
+
+
+def tile_world(world, dest, tile, area):
+    """
+    Builds a copy of the extracted world in world under dest with only the
+    chunks for tile (and those outside area) left in its region files.
+    level.dat and anything else are linked, not copied. Returns how many
+    region files have any of the tile's chunks in them.
+
+    Anything already under dest, from a run that died part way, is thrown
+    away first: its files may be links to the originals, which mustn't be
+    written into.
+    """
+    if os.path.exists(dest):
+        shutil.rmtree(dest)
+
+    found = 0
+    for dirpath, dirnames, filenames in os.walk(world):
+        rel = os.path.relpath(dirpath, world)
+        out_dir = os.path.normpath(os.path.join(dest, rel))
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+
+        for filename in filenames:
+            src = os.path.join(dirpath, filename)
+            out = os.path.join(out_dir, filename)
+            coords = regions.region_coords(
+                    posixpath.join(*(rel.split(os.sep) + [filename])))
+            if coords is None:
+                link_or_copy(src, out)
+                continue
+
+            header = open(src, 'rb').read(chunkindex.HEADER_SIZE)
+            if len(header) < chunkindex.HEADER_SIZE:
+                continue
+            locations = list(struct.unpack(">%dI" % chunkindex.CHUNKS,
+                                           header[:4096]))
+            # Chunks outside the area stay, mcobj only looks at those to see
+            # which faces of the chunks on the edge are hidden
+            mine = False
+            for i in range(chunkindex.CHUNKS):
+                if chunkindex.in_bounds(coords, i, tile):
+                    mine = mine or bool(locations[i])
+                elif chunkindex.in_bounds(coords, i, area):
+                    locations[i] = 0
+            if not any(locations):
+                continue
+            if mine:
+                found += 1
+
+            shutil.copyfile(src, out)
+            patched = open(out, 'r+b')
+            try:
+                patched.write(struct.pack(">%dI" % chunkindex.CHUNKS, *locations))
+            finally:
+                patched.close()
+
+    return found
+
+
+def obj_stats(path):
+    """
+    (vertex count, [x, y, z] sums, [x, y, z] minimums, [x, y, z] maximums)
+    of the vertices in an OBJ file
+    """
+    count = 0
+    sums = [0.0, 0.0, 0.0]
+    lo = [float('inf')] * 3
+    hi = [float('-inf')] * 3
+
+    for line in open(path):
+        if not line.startswith('v '):
+            continue
+        v = [float(c) for c in line.split()[1:4]]
+        count += 1
+        for k in range(3):
+            sums[k] += v[k]
+            if v[k] < lo[k]:
+                lo[k] = v[k]
+            if v[k] > hi[k]:
+                hi[k] = v[k]
+
+    return count, sums, lo, hi
+
+
+def camera(stats):
+    """
+    What obj2png.py needs to frame every tile the way it would frame the whole
+    mesh, out of obj_stats() of each tile: the shift that puts the median of
+    all the vertices at the origin, and the width of the whole lot
+    """
+    count = sum(s[0] for s in stats)
+    lo = [min(s[2][k] for s in stats) for k in range(3)]
+    hi = [max(s[3][k] for s in stats) for k in range(3)]
+    shift = [-sum(s[1][k] for s in stats) / count for k in range(3)]
+    return {'shift': shift, 'base': hi[0] - lo[0]}